@@ -0,0 +1,199 @@
+"""Benchmarks derived from the deployment logs in data/ and data-backup/.
+
+    python bench.py [LOG_OR_DIR ...]          # table and scaling exponents
+    python bench.py --save [LOG_OR_DIR ...]   # store the results as the baseline
+    python bench.py --check [LOG_OR_DIR ...]  # exit 1 on regressions
+
+Logs are named `<algo>-<n>.log`, e.g. `cowo-144.log`, and may hold runs of
+other board sizes as well: only boards of n cells are taken from each file.
+Each "[board] --> round" line marks a completed round. Log timestamps have
+one second resolution, so per-round percentiles are coarse on fast runs,
+seconds per round over the whole run is the robust figure.
+"""
+
+import argparse
+import dataclasses
+import itertools
+import json
+import math
+import pathlib
+import re
+import statistics
+import sys
+
+HERE = pathlib.Path(__file__).parent
+DATA = (HERE.parent / "data", HERE.parent / "data-backup")
+BASELINE = HERE / "baseline.json"
+# Boards are text, or tagged wire formats that start with the number of cells
+LINE = re.compile(r" (\d\d):(\d\d):(\d\d) .*\[(?:([01.]+)|[bs]1:(\d+):[^\]]*)\](?: --> (\d+))?")
+
+
+@dataclasses.dataclass
+class Run:
+    algo: str
+    n: int
+    path: pathlib.Path
+    rounds: int  # completed rounds
+    seconds_per_round: float
+    p50: float  # round latency percentiles, seconds
+    p95: float
+    p99: float
+    warmup: float  # from the first board of this size to the first completed round
+
+    @property
+    def key(self) -> str:
+        return f"{self.algo}-{self.n}"
+
+    @property
+    def throughput(self) -> float:
+        """Cell updates per second."""
+        return self.n / self.seconds_per_round if self.seconds_per_round else math.inf
+
+
+def find_logs(*where: pathlib.Path) -> list[tuple[str, int, pathlib.Path]]:
+    """Log files under the directories, or the files themselves."""
+    rv = []
+    for p in where:
+        for path in sorted(p.glob("*.log")) if p.is_dir() else [p]:
+            if m := re.fullmatch(r"(?P<algo>.*)-(?P<n>[0-9]+)[.]log", path.name):
+                rv.append((m["algo"], int(m["n"]), path))
+    return rv
+
+
+def events(path: pathlib.Path):
+    """Yield (seconds, board size, completed round or None) from a log."""
+    day = last = 0
+    with path.open(errors="replace") as f:
+        for line in f:
+            if not (m := LINE.search(line)):
+                continue
+            hh, mm, ss, board, size, round_ = m.groups()
+            t = int(hh) * 3600 + int(mm) * 60 + int(ss)
+            if t + day < last - 12 * 3600:
+                day += 24 * 3600  # past midnight
+            last = t + day
+            yield last, len(board) if board else int(size), int(round_) if round_ else None
+
+
+def completions(path: pathlib.Path, n: int) -> tuple[int | None, list[tuple[int, int]]]:
+    """First time a board of n cells shows up, and (time, round) of the longest run.
+
+    A round going backwards means the board was reset, which starts a new run.
+    Each round is counted once, the coordinator may log it more than once.
+    """
+    first = None
+    segments: list[list[tuple[int, int]]] = [[]]
+    for t, size, round_ in events(path):
+        if size != n:
+            continue
+        if first is None:
+            first = t
+        if round_ is None:
+            continue
+        segment = segments[-1]
+        if segment and round_ < segment[-1][1]:
+            segments.append(segment := [])
+        if not segment or round_ > segment[-1][1]:
+            segment.append((t, round_))
+    return first, max(segments, key=len)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def measure(algo: str, n: int, path: pathlib.Path) -> Run | None:
+    """Benchmark figures for the log, None without at least two completed rounds."""
+    first, done = completions(path, n)
+    if first is None or len(done) < 2:
+        return None
+    latencies = [
+        (t1 - t0) / (r1 - r0) for (t0, r0), (t1, r1) in itertools.pairwise(done)
+    ]
+    (t0, r0), (t1, r1) = done[0], done[-1]
+    return Run(
+        algo=algo,
+        n=n,
+        path=path,
+        rounds=r1 - r0,
+        seconds_per_round=(t1 - t0) / (r1 - r0),
+        p50=percentile(latencies, 50),
+        p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99),
+        warmup=t0 - first,
+    )
+
+
+def scaling(runs: list[Run]) -> dict[str, float]:
+    """Exponent b in seconds per round ~ n**b for each algorithm."""
+    rv = {}
+    for algo in sorted({r.algo for r in runs}):
+        points = [
+            (math.log(r.n), math.log(r.seconds_per_round))
+            for r in runs
+            if r.algo == algo and r.seconds_per_round > 0
+        ]
+        if len({x for x, _ in points}) >= 2:
+            rv[algo] = statistics.linear_regression(*zip(*points)).slope
+    return rv
+
+
+def regressions(runs: list[Run], baseline: dict, tolerance: float) -> list[str]:
+    """Runs slower than the baseline for the same algorithm and size.
+
+    Percentiles get one second of slack for the log timestamp resolution.
+    """
+    rv = []
+    for run in runs:
+        if not (base := baseline.get(run.key)):
+            continue
+        if run.seconds_per_round > base["seconds_per_round"] * (1 + tolerance):
+            rv.append(
+                f"{run.key}: {run.seconds_per_round:.2f}s per round,"
+                f" baseline {base['seconds_per_round']:.2f}s ({run.path})"
+            )
+        if run.p95 > base["p95"] * (1 + tolerance) + 1:
+            rv.append(f"{run.key}: p95 {run.p95:.2f}s, baseline {base['p95']:.2f}s ({run.path})")
+    return rv
+
+
+def summary(run: Run) -> dict:
+    rv = dataclasses.asdict(run)
+    del rv["algo"], rv["n"], rv["path"]
+    return {**rv, "throughput": run.throughput}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", type=pathlib.Path, default=DATA)
+    parser.add_argument("--baseline", type=pathlib.Path, default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store results as the baseline")
+    parser.add_argument("--check", action="store_true", help="compare with the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    runs = [r for log in find_logs(*args.paths) if (r := measure(*log))]
+    runs.sort(key=lambda r: (r.algo, r.n))
+    print(f"{'algo':10} {'n':>4} {'rounds':>6} {'s/round':>8} {'cells/s':>8}"
+          f" {'p50':>6} {'p95':>6} {'p99':>6} {'warmup':>7}")
+    for r in runs:
+        print(f"{r.algo:10} {r.n:4} {r.rounds:6} {r.seconds_per_round:8.2f} {r.throughput:8.2f}"
+              f" {r.p50:6.1f} {r.p95:6.1f} {r.p99:6.1f} {r.warmup:7.0f}")
+    for algo, exponent in scaling(runs).items():
+        print(f"{algo}: seconds per round ~ n**{exponent:.2f}")
+
+    if args.save:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update({r.key: summary(r) for r in runs})
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+    if args.check:
+        baseline = json.loads(args.baseline.read_text())
+        if problems := regressions(runs, baseline, args.tolerance):
+            print("\n".join(["Regressions:", *problems]))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
+import abc
+import concurrent.futures
+import io
+import itertools
+import math
 import pathlib
 import re
+import struct
+import sys
+import zlib
 
 import numpy as np
-from PIL import Image
+from PIL import GifImagePlugin, Image
+
+import wire
 
 
 def find_files(where):
@@ -10,31 +20,59 @@ def find_files(where):
     for p in pathlib.Path(where).glob("*.log"):
         try:
             m = re.fullmatch(r'(?P<algo>.*)-(?P<n>[0-9]+)[.]log', p.name)
-            rv.append((m["algo"], m["n"], p))
+            rv.append((m["algo"], int(m["n"]), p))
         except Exception as e: print(p.name, e)
     return rv
 
-def process_file(path, n):
+def records(path, n):
+    """Lazily yield (seconds, board) for boards of n cells, line by line.
+
+    Boards logged in a tagged wire format, e.g. sparse, are decoded to text.
+    """
+    pattern = re.compile(
+        fr' (?P<time>\d{{2}}:\d{{2}}:\d{{2}}) .* \[(?P<board>[01.]{{{n}}}|[bs]1:{n}:[^\]]*)\]'
+    )
     starttime = None
-    rv = []
-    for line in path.read_text().split("\n"):
-        if "Reset" in line: continue
-        m = re.search(fr' (?P<time>\d{{2}}:\d{{2}}:\d{{2}}) .* \[(?P<board>[01.]{{{n}}})\]', line)
-        if not m: continue
-        # Unit tests collapse relation events, the board is filled all at once
-        if "WARNING" not in line and "." in m["board"]: continue
-        hh,mm,ss = map(int, m["time"].split(":"))
-        abstime = hh*3600 + mm*60 + ss
-        if starttime is None: starttime = abstime
-        time = abstime - starttime
-        rv.append((time, m["board"]))
-    interpolated = [rv[-1][0] * i * 10 // len(rv) for i in range(len(rv))]
-    return [(i, b) for i, (_, b) in zip(interpolated, rv)]
+    with open(path, errors="replace") as f:
+        for line in f:
+            if "]" not in line or "Reset" in line: continue
+            m = pattern.search(line)
+            if not m: continue
+            # Unit tests collapse relation events, the board is filled all at once
+            if "WARNING" not in line and "." in m["board"]: continue
+            hh,mm,ss = map(int, m["time"].split(":"))
+            abstime = hh*3600 + mm*60 + ss
+            if starttime is None: starttime = abstime
+            board = m["board"]
+            yield abstime - starttime, board if board[0] in "01." else wire.decode(board)
+
+def board_width(path, n):
+    """Width of the last board of n cells the leader logged, square if none.
+
+    A ragged board's last row is short, n cells fill it at least in part.
+    """
+    pattern = re.compile(r'Topology version \d+: (?P<width>\d+)x(?P<height>\d+) board')
+    rv = math.isqrt(n)
+    with open(path, errors="replace") as f:
+        for line in f:
+            if "Topology" not in line: continue
+            m = pattern.search(line)
+            if m and int(m["width"]) * (int(m["height"]) - 1) < n <= int(m["width"]) * int(m["height"]):
+                rv = int(m["width"])
+    return rv
+
+def process_file(path, n):
+    """Boards with times spread evenly over the run, in tenths of the real time.
+
+    Reads the log twice rather than holding it, the first pass finds the length.
+    """
+    count = end = 0
+    for count, (end, _) in enumerate(records(path, n), 1): pass
+    for i, (_, b) in enumerate(records(path, n)):
+        yield end * i * 10 // count, b
 
 CONV = {
-    (".", "0"): 0,
-    (".", "."): tuple,  # not allowed
-    (".", "1"): 255,
+    # (".", x) never happens, the first board is complete
     ("0", "0"): 0,
     ("0", "."): 100,
     ("0", "1"): 255,
@@ -42,14 +80,22 @@ CONV = {
     ("1", "."): 155,
     ("1", "1"): 255,
 }
+# Board characters to rows/columns of GRAY
+CODES = np.zeros(256, np.uint8)
+CODES[[ord("0"), ord("1"), ord(".")]] = [0, 1, 2]
+GRAY = np.zeros((2, 3), np.uint8)
+for (a, b), v in CONV.items():
+    GRAY["01".index(a), "01.".index(b)] = 255 - v
 
 def grayblack(data):
+    """Frames as flat uint8 arrays, pending cells shaded by their first value."""
     last = None
     for d in data:
+        codes = CODES[np.frombuffer(d.encode(), np.uint8)]
         if last is None:
             assert "." not in d
-            last = d
-        yield bytes(255 - CONV[it] for it in zip(last, d))
+            last = codes
+        yield GRAY[last, codes]
 
 
 def expand_contract(data):
@@ -70,14 +116,175 @@ def expand_contract(data):
         return
 
 
-def save_gif(data, path):
-    side = int(len(data[0]) ** 0.5)
-    frames = [Image.frombytes("L", (side, side), frame).resize((side*10, side*10), resample=0) for frame in data]
-    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0, disposal=2)
+class Writer(abc.ABC):
+    """Writes frames as they come, holding one to merge identical ones."""
+
+    longest = None  # ms a single frame can be shown for
+
+    def __init__(self, path, duration=100, scale=1):
+        self.f = open(path, "wb")
+        self.duration = duration
+        self.scale = scale
+        self.pending = None
+        self.count = 0
+
+    def write(self, frame):
+        if self.pending is not None and np.array_equal(frame, self.pending):
+            self.count += 1
+            return
+        self.flush()
+        self.pending, self.count = frame, 1
+
+    def flush(self):
+        if self.pending is not None:
+            frame = self.pending.repeat(self.scale, 0).repeat(self.scale, 1)
+            while self.count:
+                n = min(self.count, self.longest // self.duration) if self.longest else self.count
+                self.emit(frame, n)
+                self.count -= n
+            self.pending = None
+
+    @abc.abstractmethod
+    def emit(self, frame, count):
+        """Write the frame, shown for count frame durations."""
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GifWriter(Writer):
+    longest = 655350  # 16 bit centiseconds
+
+    def emit(self, frame, count):
+        im = Image.fromarray(frame, "L")
+        if not self.f.tell():
+            header, _ = GifImagePlugin.getheader(im, info={"loop": 0, "optimize": False})
+            self.f.write(b"".join(header))
+        duration = self.duration * count
+        self.f.write(b"".join(GifImagePlugin.getdata(im, duration=duration, disposal=2)))
+
+    def close(self):
+        self.flush()
+        self.f.write(b";")
+        self.f.close()
+
+
+class ApngWriter(Writer):
+    """Grayscale APNG, the frame count is patched in on close."""
+
+    longest = 65535  # 16 bit ms
+
+    def __init__(self, path, duration=100, scale=1):
+        super().__init__(path, duration, scale)
+        self.frames = self.sequence = 0
+
+    def chunk(self, kind, data):
+        self.f.write(struct.pack(">I", len(data)) + kind + data)
+        self.f.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    def emit(self, frame, count):
+        h, w = frame.shape
+        if not self.frames:
+            self.f.write(b"\x89PNG\r\n\x1a\n")
+            self.chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 0, 0, 0, 0))
+            self.actl = self.f.tell()
+            self.chunk(b"acTL", struct.pack(">II", 0, 0))
+        delay = self.duration * count
+        fctl = struct.pack(">IIIIIHHBB", self.sequence, w, h, 0, 0, delay, 1000, 0, 0)
+        self.chunk(b"fcTL", fctl)
+        # Filter type 0 at the start of each row
+        data = zlib.compress(np.insert(frame, 0, 0, axis=1).tobytes())
+        if self.frames:
+            self.chunk(b"fdAT", struct.pack(">I", self.sequence + 1) + data)
+            self.sequence += 2
+        else:
+            self.chunk(b"IDAT", data)
+            self.sequence += 1
+        self.frames += 1
+
+    def close(self):
+        self.flush()
+        if self.frames:
+            self.chunk(b"IEND", b"")
+            self.f.seek(self.actl)
+            self.chunk(b"acTL", struct.pack(">II", self.frames, 0))
+        self.f.close()
+
+
+class NpyWriter(Writer):
+    """Raw (frames, height, width) stack, every frame, shape patched in on close."""
+
+    def __init__(self, path, duration=100, scale=1):
+        super().__init__(path, duration, scale)
+        self.shape = None
+
+    def header(self, shape):
+        f = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            f, {"descr": "|u1", "fortran_order": False, "shape": shape}
+        )
+        return f.getvalue()
+
+    def emit(self, frame, count):
+        if self.shape is None:
+            self.shape = [0, *frame.shape]
+            # Room for the largest frame count
+            self.f.write(self.header((10**12, *frame.shape)))
+            self.reserved = self.f.tell()
+        for _ in range(count):
+            self.f.write(frame.tobytes())
+        self.shape[0] += count
+
+    def close(self):
+        self.flush()
+        if self.shape:
+            header = self.header(tuple(self.shape))
+            assert len(header) == self.reserved
+            self.f.seek(0)
+            self.f.write(header)
+        self.f.close()
+
+
+WRITERS = {"gif": GifWriter, "apng": ApngWriter, "npy": NpyWriter}
+
+def save(data, path, width=None, scale=10):
+    """Stream flat frames to a .gif, .apng or .npy file, npy is not scaled.
+
+    Frames are width cells wide, square by default, the short last row of
+    a ragged board is padded with dead cells.
+    Returns the number of frames, nothing is written without any.
+    """
+    data = iter(data)
+    if (first := next(data, None)) is None:
+        return 0
+    width = width or math.isqrt(len(first))
+    kind = pathlib.Path(path).suffix[1:]
+    count = 0
+    with WRITERS[kind](path, scale=1 if kind == "npy" else scale) as writer:
+        for count, frame in enumerate(itertools.chain([first], data), 1):
+            frame = np.pad(frame, (0, -len(frame) % width), constant_values=GRAY[0, 0])
+            writer.write(frame.reshape(-1, width))
+    return count
+
+save_gif = save
+
+def render(job):
+    k, n, p, kinds = job
+    width = board_width(p, n)
+    for kind in kinds:
+        frames = save(grayblack(expand_contract(process_file(p, n))), f"{k}-{n}.{kind}", width)
+    return k, n, frames
 
 if __name__ == "__main__":
-    for k, n, p in find_files("../data"):
-        print("fyi", k, n)
-        frames = tuple(grayblack(expand_contract(process_file(p, n))))
-        save_gif(frames, f"{k}-{n}.gif")
-        # for b in frames: print(b)
+    # Logs are independent, extraction scales with cores rather than total size
+    kinds = sys.argv[1:] or ["gif"]
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        for k, n, frames in pool.map(render, [(*f, kinds) for f in find_files("../data")]):
+            print("fyi", k, n, frames)
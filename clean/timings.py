@@ -1,25 +1,20 @@
-import re
+import pathlib
+
+import bench
+
 
 def time(fname, n):
-    lines = open(fname).readlines()
-    frob = [m.groups() for m in filter(None, [re.search(fr"(?P<time>\d\d:\d\d:\d\d).*\[[01]{{{n}}}\] --> (?P<round>\d+)", l) for l in lines])]
-    if not frob: return
-    hh,mm,ss = map(int, frob[0][0].split(":"))
-    start = hh * 3600 + mm * 60 + ss
-    startr = int(frob[0][1])
-    hh,mm,ss = map(int, frob[-1][0].split(":"))
-    end = hh * 3600 + mm * 60 + ss
-    endr = int(frob[-1][1])
-    # print(frob[0])
-    # print(frob[-1])
-    # print((end - start) / (endr - startr))
-    return (end - start) / (endr - startr)
+    """Seconds per round for boards of n cells in the log, None if there are none."""
+    run = bench.measure("", n, pathlib.Path(fname))
+    return run.seconds_per_round if run else None
+
 
 if __name__ == "__main__":
     import sys
+
     fname = sys.argv[1]
-    for i in range(21):
-        t = time(fname, i**2)
+    sizes = sorted({n for _, n, r in bench.events(pathlib.Path(fname)) if r is not None})
+    for n in sizes:
+        t = time(fname, n)
         if t is None: continue
-        print(i**2, t)
-
+        print(n, t)
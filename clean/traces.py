@@ -0,0 +1,140 @@
+"""Aggregate the charms' per-hook trace records.
+
+    python traces.py TRACE_OR_DIR ...        # e.g. each unit's hook-trace.jsonl
+    python traces.py --top 20 traces/
+
+Records come from the `trace` config option, see `dispatch.py` in the charms,
+directories are searched for `*.jsonl` files. Reported:
+
+* hooks per generation, over the rounds the records span, and per unit:
+  the event amplification, a lock-step board needs about one useful hook
+  per cell per generation
+* the units that spent the most time in hooks
+* per hook, how often it ran, was skipped or did nothing, and where the
+  time went: import, model load and the handler
+"""
+
+import argparse
+import collections
+import json
+import math
+import pathlib
+
+STAGES = ("import", "load", "handler", "total")
+
+
+def find_traces(*where: pathlib.Path) -> list[pathlib.Path]:
+    rv = []
+    for p in where:
+        rv.extend(sorted(p.rglob("*.jsonl")) if p.is_dir() else [p])
+    return rv
+
+
+def records(paths: list[pathlib.Path]):
+    """Yield the trace records, skipping lines cut short by a killed hook."""
+    for path in paths:
+        with path.open() as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def amplification(traces: list[dict]) -> dict[str, float] | None:
+    """Hooks per generation, None without records for at least two rounds."""
+    rounds = [r["round"] for r in traces if isinstance(r.get("round"), int)]
+    if not rounds or (generations := max(rounds) - min(rounds)) < 1:
+        return None
+    units = len({r["unit"] for r in traces})
+    hooks = len(traces) / generations
+    return {
+        "generations": generations,
+        "units": units,
+        "hooks": hooks,
+        "useful": sum(r["useful"] for r in traces) / generations,
+        "skipped": sum(r["skipped"] for r in traces) / generations,
+        "per_unit": hooks / units,
+    }
+
+
+def hot_spots(traces: list[dict]) -> list[dict]:
+    """Per unit totals, the most time spent in hooks first."""
+    units: dict[str, dict] = collections.defaultdict(
+        lambda: {"hooks": 0, "skipped": 0, "useful": 0, "seconds": 0.0, "read": 0, "written": 0}
+    )
+    for r in traces:
+        u = units[r["unit"]]
+        u["hooks"] += 1
+        u["skipped"] += r["skipped"]
+        u["useful"] += r["useful"]
+        u["seconds"] += r["total"]
+        u["read"] += r["read"]
+        u["written"] += r["written"]
+    return sorted(
+        ({"unit": name, **u} for name, u in units.items()), key=lambda u: -u["seconds"]
+    )
+
+
+def breakdown(traces: list[dict]) -> list[dict]:
+    """Per hook counts, mean stage times and p95 of the total, in seconds."""
+    hooks = collections.defaultdict(list)
+    for r in traces:
+        hooks[r["hook"]].append(r)
+    rv = []
+    for hook, rs in sorted(hooks.items()):
+        row = {
+            "hook": hook,
+            "count": len(rs),
+            "skipped": sum(r["skipped"] for r in rs),
+            "noop": sum(not r["useful"] and not r["skipped"] for r in rs),
+        }
+        for stage in STAGES:
+            times = [r[stage] for r in rs if r.get(stage) is not None]
+            row[stage] = sum(times) / len(times) if times else None
+        row["p95"] = percentile([r["total"] for r in rs], 95)
+        rv.append(row)
+    return rv
+
+
+def ms(seconds: float | None) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", type=pathlib.Path)
+    parser.add_argument("--top", type=int, default=10, help="hot spots to list")
+    args = parser.parse_args()
+
+    traces = list(records(find_traces(*args.paths)))
+    print(f"{len(traces)} hooks")
+    if amp := amplification(traces):
+        print(
+            f"{amp['generations']} generations, {amp['units']} units:"
+            f" {amp['hooks']:.1f} hooks per generation ({amp['per_unit']:.2f} per unit),"
+            f" {amp['useful']:.1f} useful, {amp['skipped']:.1f} skipped"
+        )
+
+    print(f"\n{'unit':16} {'hooks':>6} {'skipped':>7} {'useful':>6} {'seconds':>8}"
+          f" {'read':>9} {'written':>8}")
+    for u in hot_spots(traces)[: args.top]:
+        print(f"{u['unit']:16} {u['hooks']:6} {u['skipped']:7} {u['useful']:6}"
+              f" {u['seconds']:8.2f} {u['read']:9} {u['written']:8}")
+
+    print(f"\n{'hook':28} {'count':>6} {'skipped':>7} {'no-op':>6}"
+          f" {'import':>7} {'load':>7} {'handler':>7} {'total':>7} {'p95':>7}  (ms)")
+    for h in breakdown(traces):
+        print(f"{h['hook']:28} {h['count']:6} {h['skipped']:7} {h['noop']:6}"
+              f" {ms(h['import']):>7} {ms(h['load']):>7} {ms(h['handler']):>7}"
+              f" {ms(h['total']):>7} {ms(h['p95']):>7}")
+
+
+if __name__ == "__main__":
+    main()
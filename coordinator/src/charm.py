@@ -3,132 +3,460 @@
 # See LICENSE file for licensing details.
 """Juju's Game of Life."""
 
+# The dispatch filter and the resident hand-off run before the other imports,
+# ops alone takes longer to import than a skipped or served hook needs.
+# ruff: noqa: E402
+import dispatch
+
+dispatch.exit_if_irrelevant()
+import resident
+
+resident.exit_if_served()
+
 import json
 import logging
-from typing import cast
+from collections.abc import Mapping
+from typing import Any, cast
 
 import ops
 
+import cycles
+import databag
+import wire
+from topology import Topology, offsets
+
+dispatch.profile("imports")
+
 INIT = "0001110001010101111110001110010101010101001010101000111101010111" * 99
 
 
 class JGOLCoordinatorCharm(ops.CharmBase):
     """Juju's Game of Life."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
+        resident.ensure(bool(self.config.get("resident")))
+        dispatch.set_profiling(bool(self.config.get("profile-startup")))
+        dispatch.set_tracing(bool(self.config.get("trace")))
+        self.read = databag.Reader()
+        # Completion of the current round, see `board_state`
+        self._stored.set_default(progress="", reported=[], missing=-1)
+        # Recent board hashes, see `cycles`
+        self._stored.set_default(history={})
         framework.observe(self.on["world"].relation_joined, self.god)
         framework.observe(self.on["world"].relation_changed, self.god)
         framework.observe(self.on["world"].relation_departed, self.god)
         framework.observe(self.on.config_changed, self.god)
+        framework.observe(self.on.leader_elected, self.god)
+        framework.observe(self.on.fast_forward_action, self.fast_forward)
+        dispatch.profile("init")
 
     def god(self, _event: ops.EventBase):
         """Play God with the cells."""
         self.unit.status = ops.ActiveStatus()
         if not self.unit.is_leader():
+            # leader-elected is not filtered and will bring us back
+            hooks = [f"world-relation-{e}" for e in ("joined", "changed", "departed")]
+            dispatch.write_rules([{"hooks": hooks}])
             return
 
         try:
             world = self.model.get_relation("world")
             assert world, "Waiting for peer relation to come up"
 
+            app_data = databag.Batch(self.read(world, self.app))
             run = bool(cast(bool | None, self.config.get("run")))
+            previous = app_data.get("topology")
+            reporter = None
+            if isinstance(_event, ops.RelationChangedEvent) and _event.unit and previous:
+                # Units come and go with joined/departed, config with config-changed
+                reporter = _event.unit.name
+                topology = Topology.loads(previous)
+            else:
+                units = [unit.name for unit in world.units]
+                topology = Topology.grid(units, **self.layout()).successor(
+                    Topology.loads(previous) if previous else None, units
+                )
+                if unused := topology.unused(units):
+                    logging.warning("Units don't fit the board: %s", " ".join(unused))
+                dispatch.write_rules(
+                    [
+                        {
+                            "hooks": ["world-relation-changed"],
+                            "relation_ids": [world.id],
+                            "remote_units": list(topology.cells),
+                        }
+                    ]
+                )
 
-            cells = sorted(unit.name for unit in world.units)
-            neighbours = neighbourhood(cells)
-            assert len(neighbours) <= len(INIT), "Initial map is too small"
-
-            cells = cells[: len(neighbours)]
-
-            curr_round = json.loads(world.data[self.app].get("round", "0"))
-            board, next_round = self.board_state(world, cells, curr_round)
+            curr_round = json.loads(app_data.get("round", "0"))
+            dispatch.annotate(round=curr_round)
+            board, next_round = self.board_state(world, topology, curr_round, reporter)
+            encoding = self.encoding(topology)
+            shown = show(board, topology, encoding)
+            if reporter and "delta" in app_data:
+                self.resync(world, app_data, reporter, curr_round, encoding)
 
-            # co->wo: round, map, board
+            # co->wo: round, topology, board
             # wo->co: round, value
-            world.data[self.app]["map"] = json.dumps(neighbours)
+            if (descriptor := topology.dumps()) != previous:
+                app_data["topology"] = descriptor
+                logging.warning(
+                    "Topology version %d: %dx%d board",
+                    topology.version,
+                    topology.board_width,
+                    topology.board_height,
+                )
             if not run:
                 # Reset the board
-                world.data[self.app]["board"] = INIT[: len(neighbours)]
-                world.data[self.app]["round"] = json.dumps(0)
+                initial = topology.trim(seed(topology.board_size))
+                self.publish(app_data, initial, 0, encoding, True)
+                app_data["round"] = json.dumps(0)
+                app_data.pop("active", None)
                 if next_round == 0:
-                    self.app.status = ops.ActiveStatus(msg := f"Reset [{board}]")
+                    self.app.status = ops.ActiveStatus(msg := f"Reset [{shown}]")
                     logging.warning(msg)
                 else:
                     # None -> inconsistent map, wait for some units
                     # int, !=0 -> map is consistent but not reset, wait for all units
                     self.app.status = ops.WaitingStatus(
-                        msg := f"Resetting... [{board}]"
+                        msg := f"Resetting... [{shown}]"
                     )
                     logging.warning(msg)
                     # FIXME we could compare the map to initial...
             elif next_round is not None:
-                # All units completed this step, kick off the next round
-                world.data[self.app]["round"] = json.dumps(next_round)
-                self.app.status = ops.ActiveStatus(
-                    msg := f"{curr_round}: [{board}] --> {next_round}"
-                )
-                world.data[self.app]["board"] = board
-                world.data[self.app]["round"] = json.dumps(next_round)
-                logging.warning(msg)
+                # All units completed this step
+                self.complete(world, app_data, topology, board, shown, curr_round, next_round)
             else:
-                curr_round = json.loads(world.data[self.app].get("round", "0"))
+                curr_round = json.loads(app_data.get("round", "0"))
                 # Still waiting for some units
-                self.app.status = ops.ActiveStatus(msg := f"{curr_round}: [{board}]")
+                self.app.status = ops.ActiveStatus(msg := f"{curr_round}: [{shown}]")
                 logging.warning(msg)
+            app_data.commit()
         except Exception as e:
             self.app.status = ops.BlockedStatus(repr(e))
 
+    def fast_forward(self, event: ops.ActionEvent):
+        """Jump the board ahead without running the cells."""
+        world = self.model.get_relation("world")
+        if not self.unit.is_leader():
+            event.fail("Not the leader")
+        elif not world or "topology" not in self.read(world, self.app):
+            event.fail("Waiting for workers")
+        elif not self.config.get("run"):
+            event.fail("Not running")
+        elif (generations := int(event.params["generations"])) < 0:
+            event.fail("Can't go back in time")
+        else:
+            app_data = databag.Batch(self.read(world, self.app))
+            topology = Topology.loads(app_data["topology"])
+            encoding = self.encoding(topology)
+            board = current_board(app_data)
+            if event.params.get("engine") == "hashlife":
+                import hashlife
+
+                plain = (topology.shape, topology.radius) == ("moore", 1)
+                if topology.wrap or topology.holes or not plain:
+                    event.fail("Hashlife only plays Moore radius 1 without wrap or holes")
+                    return
+                board = hashlife.advance(board, topology.board_width, generations)
+            else:
+                board = reference(board, topology, generations)
+            round_ = json.loads(app_data.get("round", "0")) + generations
+            self.publish(app_data, board, round_, encoding, True)
+            app_data["round"] = json.dumps(round_)
+            app_data.pop("active", None)
+            app_data.commit()
+            event.set_results({"round": round_, "population": board.count("1")})
+
+    def verify(self, world: ops.Relation, topology: Topology, board: str) -> str:
+        """Compare the round result with the reference engine, describe the mismatch."""
+        previous = current_board(self.read(world, self.app))
+        if len(previous) != len(board):
+            return ""  # topology changed mid-run
+        expected = reference(previous, topology)
+        if diff := sum(a != b for a, b in zip(board, expected)):
+            logging.error("Diverged from reference: [%s]", expected)
+            return f", {diff} cells diverged"
+        return ""
+
+    def idle(self, app_data: databag.Batch, board: str) -> bool:
+        """Whether no cell would step on to `board`, a still life under `activity-mask`.
+
+        With every cell outside the mask none would report, the round would never end.
+        """
+        return bool(self.config.get("activity-mask")) and board == current_board(app_data)
+
+    def still(
+        self, app_data: databag.Batch, topology: Topology, board: str
+    ) -> dict[int, str]:
+        """Publish the `active` mask for the next round, return the other cells' values.
+
+        A cell whose reach didn't change from the current board to `board`
+        would compute the value it has, so it doesn't, the value stays.
+        Without `activity-mask`, or a current board, every cell is active.
+        """
+        previous = current_board(app_data)
+        if not self.config.get("activity-mask") or len(previous) != len(board):
+            app_data.pop("active", None)
+            return {}
+        changed = [i for i, (a, b) in enumerate(zip(previous, board)) if a != b]
+        active = topology.active(changed)
+        if len(active) == len(topology.cells):
+            app_data.pop("active", None)
+            return {}
+        mask = "".join("1" if i in active else "0" for i in range(len(topology.cells)))
+        app_data["active"] = wire.encode(mask, "auto")
+        values = topology.tiles(board)
+        return {i: values[i] for i in range(len(topology.cells)) if i not in active}
+
+    def publish(
+        self,
+        app_data: databag.Batch,
+        board: str,
+        round_: int,
+        encoding: str,
+        keyframe: bool = False,
+    ):
+        """Send the board for the round, the caller sends the round itself.
+
+        With `keyframe-interval` set, between keyframes the board goes out as
+        a delta against the last one, unless that's no smaller. Anyone can
+        rebuild the board from the app databag alone, a new leader included.
+        """
+        interval = int(cast(int, self.config.get("keyframe-interval", 0)))
+        if interval and not keyframe and "keyframe" in app_data:
+            since = round_ - json.loads(app_data["keyframe"])
+            base = wire.decode(app_data["board"])
+            if 0 < since < interval and len(base) == len(board):
+                change = wire.delta(base, board)
+                if len(change) < len(app_data["board"]) // 2:
+                    app_data["delta"] = change
+                    return
+        app_data["board"] = wire.encode(board, encoding)
+        app_data.pop("delta", None)
+        if interval:
+            app_data["keyframe"] = json.dumps(round_)
+        else:
+            app_data.pop("keyframe", None)
+
+    def resync(
+        self,
+        world: ops.Relation,
+        app_data: databag.Batch,
+        reporter: str,
+        curr_round: int,
+        encoding: str,
+    ):
+        """Send the board whole if the reporting worker can't rebuild it from the delta."""
+        resync = self.read(world, self.model.get_unit(reporter)).get("resync")
+        if resync == json.dumps(curr_round):
+            logging.warning("Keyframe for %s", reporter)
+            self.publish(app_data, current_board(app_data), curr_round, encoding, True)
+
+    def complete(
+        self,
+        world: ops.Relation,
+        app_data: databag.Batch,
+        topology: Topology,
+        board: str,
+        shown: str,
+        curr_round: int,
+        next_round: int,
+    ):
+        """Kick off the next round, unless the board cycles and `on-cycle` says halt.
+
+        A board that stays the same under `activity-mask` halts too.
+        """
+        period = self.cycle(topology, board, next_round)
+        idle = self.idle(app_data, board)
+        if idle or (period and self.on_cycle() == "halt"):
+            # Nothing new will come of it, leave the workers idle
+            self.app.status = ops.ActiveStatus(
+                msg := f"{curr_round}: [{shown}] {cycles.describe(1 if idle else period)}, halted"
+            )
+            logging.warning(msg)
+            return
+        note = f", {cycles.describe(period)}" if period else ""
+        if period and self.on_cycle() == "skip":
+            limit = int(cast(int, self.config.get("cycle-skip", 1000)))
+            if skip := cycles.jump(period, limit):
+                # The same board comes up again a whole number of periods on
+                next_round += skip
+                cycles.shift(self._stored.history, skip)
+                note += f", skipped {skip}"
+        # Nobody has reported for it yet, cells in still regions sit it out
+        still = self.still(app_data, topology, board)
+        self._stored.progress = f"{topology.digest}:{next_round}"
+        self._stored.reported = [still.get(i) for i in range(len(topology.cells))]
+        self._stored.missing = len(topology.cells) - len(still)
+        if still:
+            note += f", {len(topology.cells) - len(still)} active"
+        if self.config.get("verify"):
+            shown += self.verify(world, topology, board)
+        self.app.status = ops.ActiveStatus(
+            msg := f"{curr_round}: [{shown}] --> {next_round}{note}"
+        )
+        self.publish(app_data, board, next_round, self.encoding(topology))
+        app_data["round"] = json.dumps(next_round)
+        logging.warning(msg)
+
+    def cycle(self, topology: Topology, board: str, round_: int) -> int:
+        """Record the round's board, return the period it repeats with or 0.
+
+        Always 0 with `cycle-history` unset, periods longer than it go unnoticed.
+        """
+        size = int(cast(int, self.config.get("cycle-history", 0)))
+        if size <= 0:
+            return 0
+        return cycles.History(self._stored.history, size, topology.digest).add(round_, board)
+
+    def on_cycle(self) -> str:
+        """Return what to do about a board that cycles: report, halt or skip."""
+        action = str(self.config.get("on-cycle", "report"))
+        if action not in ("report", "halt", "skip"):
+            raise ValueError(f"Unknown on-cycle action: {action}")
+        return action
+
+    def encoding(self, topology: Topology) -> str:
+        """Board wire format, tile mode needs at least bits."""
+        encoding = str(self.config.get("board-encoding", "text"))
+        if topology.tile > 1 and encoding == "text":
+            return "bits"
+        return encoding
+
+    def layout(self) -> dict[str, Any]:
+        """Board layout and neighbourhood options from charm config."""
+        return {
+            "width": int(cast(int, self.config.get("width", 0))),
+            "height": int(cast(int, self.config.get("height", 0))),
+            "layout": str(self.config.get("layout", "square")),
+            "wrap": bool(self.config.get("wrap", False)),
+            "shape": str(self.config.get("neighbourhood", "moore")),
+            "radius": int(cast(int, self.config.get("radius", 1))),
+            "tile": int(cast(int, self.config.get("tile", 1))),
+        }
+
     def board_state(
-        self, world: ops.Relation, cells: list[str], curr_round: int
+        self,
+        world: ops.Relation,
+        topology: Topology,
+        curr_round: int,
+        reporter: str | None = None,
     ) -> tuple[str, int | None]:
         """Determine if all units have completed the current round.
 
         Returns current map, e.g. "...00..101...." and the target round.
+        In tile mode each unit reports its whole tile as its value.
+
+        Each cell's report for the current round is kept in unit-local state
+        with the number still missing. When `reporter` changed its data, only
+        that unit is read, otherwise, or for another round or topology, all.
+        Cells outside the `active` mask count with their value on the board.
         """
-        active_rounds = set()
-        board = ""
-        for cell in cells:
-            try:
-                data = world.data[self.model.get_unit(cell)]
-                round_ = int(data.get("round", "-1"))
-                value = data.get("value", ".")
-                active_rounds.add(round_)
-                board += value if round_ == curr_round else "."
-            except Exception as e:
-                raise ValueError(f"{cell}: {e}")
-
-        if not active_rounds:
-            return "." * len(cells), None
-
-        completed = len(active_rounds) == 1 and max(active_rounds) >= 0
-        return board, max(active_rounds) + 1 if completed else None
-
-
-def neighbourhood(cells: list[str]) -> dict[str, list[str]]:
-    """Compute the map of neighbours {unit/1: [unit/3, unit/4, ...], ...}."""
-    # Square N x N map
-    N = int(len(cells) ** 0.5)  # noqa: N806
-    cells = cells[: N * N]
-
-    rv: dict[int, set[int]] = {i: set() for i in range(len(cells))}
-    for index in range(len(cells)):
-        mey, mex = divmod(index, N)
-        # FIXME this can be more elegant if I used slices
-        for y in (-1, 0, 1):
-            for x in (-1, 0, 1):
-                ny = mey + y
-                nx = mex + x
-                if ny < 0 or ny >= N:
-                    continue
-                if nx < 0 or nx >= N:
-                    continue
-                if (ny, nx) == (mey, mex):
-                    continue
-                neighbour = ny * N + nx
-                rv[index].add(neighbour)
-
-    return {cells[k]: sorted(cells[vv] for vv in v) for k, v in rv.items()}
+        key = f"{topology.digest}:{curr_round}"
+        app_data = self.read(world, self.app)
+        if reporter is None or self._stored.progress != key:
+            still = {}
+            if "active" in app_data:
+                mask = wire.decode(app_data["active"])
+                values = topology.tiles(current_board(app_data))
+                still = {i: values[i] for i, a in enumerate(mask) if a == "0"}
+            reported = [
+                still[i] if i in still else self.report(world, topology, c, curr_round)
+                for i, c in enumerate(topology.cells)
+            ]
+            self._stored.progress = key
+            self._stored.reported = reported
+            self._stored.missing = reported.count(None)
+        elif (index := topology.index(reporter)) is not None and active(app_data, index):
+            before = self._stored.reported[index]
+            after = self.report(world, topology, reporter, curr_round)
+            self._stored.reported[index] = after
+            self._stored.missing += (after is None) - (before is None)
+
+        pending = "." * topology.tile**2
+        board = topology.assemble([v or pending for v in self._stored.reported])
+        # Reports for other rounds, e.g. from before a fast-forward, don't count
+        completed = self._stored.missing == 0 and bool(topology.cells)
+        return board, curr_round + 1 if completed else None
+
+    def report(
+        self, world: ops.Relation, topology: Topology, cell: str, curr_round: int
+    ) -> str | None:
+        """Return the cell's value or tile for this round, None if it hasn't reported.
+
+        A cell that moved on the grid may still have its value for the old
+        position up, `at` tells them apart.
+        """
+        try:
+            data = self.read(world, self.model.get_unit(cell))
+            round_ = int(data.get("round", "-1"))
+            value = data.get("value")
+            at = json.loads(data.get("at", "null"))
+        except Exception as e:
+            raise ValueError(f"{cell}: {e}")
+        if round_ != curr_round or value is None:
+            return None
+        if at is not None and at != topology.index(cell):
+            return None  # stepped at its previous position, it'll report again
+        return value if topology.tile == 1 else wire.decode(value)
+
+
+def reference(board: str, topology: Topology, generations: int = 1) -> str:
+    """Step the whole board in-process with the NumPy engine.
+
+    A ragged board is stepped one generation at a time, the holes stay dead.
+    """
+    import life  # numpy is only needed for fast-forward and verification
+
+    if topology.holes and generations > 1:
+        for _ in range(generations):
+            board = reference(board, topology)
+        return board
+    return topology.trim(
+        life.to_string(
+            life.advance(
+                life.from_string(board, topology.board_width),
+                generations,
+                topology.wrap,
+                offsets(topology.shape, topology.radius),
+            )
+        )
+    )
+
+
+def seed(size: int) -> str:
+    """Return the initial board of the given size, INIT repeated as needed."""
+    return (INIT * (size // len(INIT) + 1))[:size]
+
+
+def current_board(app_data: Mapping[str, str]) -> str:
+    """Return the board of the current round, the keyframe and the delta if any."""
+    board = wire.decode(app_data.get("board", ""))
+    if "delta" in app_data:
+        board = wire.apply(board, app_data["delta"])
+    return board
+
+
+def active(app_data: Mapping[str, str], index: int) -> bool:
+    """Whether the cell steps this round, see `JGOLCoordinatorCharm.still`."""
+    return "active" not in app_data or bool(wire.Board(app_data["active"])[index])
+
+
+def show(board: str, topology: Topology, encoding: str) -> str:
+    """Format the board for the status line and log, as on the wire if that's compact."""
+    if encoding in ("sparse", "auto") and "." not in board:
+        return wire.encode(board, encoding)
+    return board if topology.tile == 1 else summary(board)
+
+
+def summary(board: str) -> str:
+    """Short description of a board too large for the status line."""
+    return f"{board.count('1')} live, {board.count('.')} pending of {len(board)}"
 
 
 if __name__ == "__main__":
-    ops.main(JGOLCoordinatorCharm)
+    resident.main(lambda: ops.main(JGOLCoordinatorCharm))
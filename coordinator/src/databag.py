@@ -0,0 +1,145 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Relation data writes that only send real changes.
+
+This module is shared between the charms, keep the copies identical.
+
+A hook collects its writes to a databag in a `Batch`, which reads through to
+the databag, and commits them once at the end:
+
+    with databag.Batch(world.data[self.unit]) as data:
+        data["value"] = "1"
+        data["round"] = "42"
+
+Keys set to the value they already hold, or set again later in the hook,
+never reach `relation-set`; whatever did change goes in a single call.
+A hook that raises commits nothing. Every write the remote units see costs
+them a relation-changed, so writes are counted per hook in
+`databag-stats.json`:
+
+    {"world-relation-changed": {"writes": 120, "suppressed": 100, "commits": 10}}
+
+"writes" are the keys the charm set or deleted, "suppressed" the ones that
+weren't sent, "commits" the `relation-set` calls made.
+
+Bytes written, and read through a `Reader`, go to the hook trace, see `dispatch`.
+"""
+
+import json
+import os
+from collections.abc import Iterator, Mapping, MutableMapping
+from typing import TYPE_CHECKING
+
+import dispatch
+
+if TYPE_CHECKING:
+    import ops
+
+STATS = "databag-stats.json"
+
+
+class Batch(MutableMapping[str, str]):
+    """Pending writes to a databag, an empty value deletes the key as in Juju."""
+
+    def __init__(self, content: MutableMapping[str, str]):
+        self.content = content
+        self.pending: dict[str, str] = {}
+        self.writes = 0
+
+    def __getitem__(self, key: str) -> str:
+        """Return the pending value, else the databag's, KeyError if deleted."""
+        value = self.pending[key] if key in self.pending else self.content[key]
+        if value == "":
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: str):
+        """Set the key on commit, an empty value deletes it."""
+        self.pending[key] = value
+        self.writes += 1
+
+    def __delitem__(self, key: str):
+        """Delete the key on commit."""
+        if key not in self:
+            raise KeyError(key)
+        self[key] = ""
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the keys as they will be after the commit."""
+        keys = dict.fromkeys([*self.content, *self.pending])
+        return (k for k in keys if self.pending.get(k, self.content.get(k)) != "")
+
+    def __len__(self) -> int:
+        """Count the keys as they will be after the commit."""
+        return sum(1 for _ in self)
+
+    def changes(self) -> dict[str, str]:
+        """Return the pending values that differ from the databag."""
+        return {k: v for k, v in self.pending.items() if self.content.get(k, "") != v}
+
+    def commit(self):
+        """Send the changes in one go and count the writes."""
+        changes = self.changes()
+        if changes:
+            self.content.update(changes)
+            dispatch.traffic(written=size(changes))
+        if self.writes:
+            count(self.writes, self.writes - len(changes), int(bool(changes)))
+        self.pending = {}
+        self.writes = 0
+
+    def __enter__(self) -> "Batch":
+        """Collect the writes of the `with` block."""
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """Commit, unless the block raised."""
+        if exc_type is None:
+            self.commit()
+
+
+def size(data: Mapping[str, str]) -> int:
+    return sum(len(k) + len(v) for k, v in data.items())
+
+
+class Reader:
+    """The charm's access to relation data, for one hook.
+
+    `ops` loads each databag once per hook, on first use, so each one's
+    size goes to the hook trace the first time it's read.
+    """
+
+    def __init__(self):
+        self.seen: set[tuple[int, str]] = set()
+
+    def __call__(
+        self, relation: "ops.Relation", entity: "ops.Unit | ops.Application"
+    ) -> "ops.RelationDataContent":
+        """Return the unit's or app's databag in the relation."""
+        content = relation.data[entity]
+        if (key := (relation.id, entity.name)) not in self.seen:
+            self.seen.add(key)
+            if dispatch.tracing():
+                dispatch.traffic(read=size(content))
+        return content
+
+
+def count(writes: int, suppressed: int, commits: int, path: str = STATS):
+    """Add a hook's writes to the stats file."""
+    stats = written(path)
+    totals = stats.setdefault(dispatch.hook_name(), {"writes": 0, "suppressed": 0, "commits": 0})
+    totals["writes"] += writes
+    totals["suppressed"] += suppressed
+    totals["commits"] += commits
+    with open(path + ".tmp", "w") as f:
+        json.dump(stats, f)
+    os.replace(path + ".tmp", path)
+
+
+def written(path: str = STATS) -> dict[str, dict[str, int]]:
+    """Return the writes, suppressed writes and relation-set calls so far, per hook."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,291 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Hashlife engine for very long runs.
+
+Boards use the same "0"/"1" row by row string as the coordinator's `INIT`
+and `board`, the caller supplies the width.
+
+Hashlife plays on an infinite plane, whereas the distributed board has
+dead edges. The two agree for as long as nothing lives past the edges,
+so `HashLife.advance` jumps no further than the live cells can spread
+without leaving the board and steps cells at the edges one generation at
+a time. Only Conway's B3/S23 rule with the Moore neighbourhood is supported.
+
+Run this module to benchmark it against the NumPy stepper.
+"""
+
+from __future__ import annotations
+
+import collections
+
+
+class Node:
+    """Quadtree node of a 2**level square, canonical within one `HashLife`."""
+
+    __slots__ = ("nw", "ne", "sw", "se", "level", "population", "memo")
+
+    def __init__(self, nw, ne, sw, se, level: int, population: int):
+        self.nw: Node = nw
+        self.ne: Node = ne
+        self.sw: Node = sw
+        self.se: Node = se
+        self.level = level
+        self.population = population
+        # RESULT for each jump size: {j: centre advanced 2**j generations}
+        self.memo: dict[int, Node] = {}
+
+
+DEAD = Node(None, None, None, None, 0, 0)
+ALIVE = Node(None, None, None, None, 0, 1)
+
+
+class HashLife:
+    """Node factory with a bounded LRU cache of canonical nodes.
+
+    Evicted nodes stay valid, they just stop being shared, so that
+    memory is bounded at the cost of recomputing evicted results.
+    """
+
+    def __init__(self, max_nodes: int = 1 << 20, max_history: int = 1 << 12):
+        self.max_nodes = max_nodes
+        # Boards remembered to spot one that comes back, see `advance`
+        self.max_history = max_history
+        self.nodes: collections.OrderedDict[tuple[Node, ...], Node] = (
+            collections.OrderedDict()
+        )
+        self.empties = [DEAD]
+        self.hits = self.misses = self.evictions = 0
+
+    def join(self, nw: Node, ne: Node, sw: Node, se: Node) -> Node:
+        """Canonical node with these four quadrants."""
+        key = (nw, ne, sw, se)
+        if (node := self.nodes.get(key)) is not None:
+            self.hits += 1
+            self.nodes.move_to_end(key)
+            return node
+        self.misses += 1
+        population = nw.population + ne.population + sw.population + se.population
+        node = self.nodes[key] = Node(nw, ne, sw, se, nw.level + 1, population)
+        if len(self.nodes) > self.max_nodes:
+            self.nodes.popitem(last=False)
+            self.evictions += 1
+        return node
+
+    def empty(self, level: int) -> Node:
+        """Return the canonical dead node of the given level."""
+        while len(self.empties) <= level:
+            e = self.empties[-1]
+            self.empties.append(self.join(e, e, e, e))
+        return self.empties[level]
+
+    def expand(self, node: Node) -> Node:
+        """Centre the pattern in a node twice the size."""
+        e = self.empty(node.level - 1)
+        return self.join(
+            self.join(e, e, e, node.nw),
+            self.join(e, e, node.ne, e),
+            self.join(e, node.sw, e, e),
+            self.join(node.se, e, e, e),
+        )
+
+    def centre(self, node: Node) -> Node:
+        """Return the centre half of the node."""
+        return self.join(node.nw.se, node.ne.sw, node.sw.ne, node.se.nw)
+
+    def successor(self, node: Node, j: int) -> Node:
+        """Centre half of the node advanced 2**j generations, j <= level - 2."""
+        if (rv := node.memo.get(j)) is not None:
+            return rv
+        if node.population == 0:
+            rv = self.empty(node.level - 1)
+        elif node.level == 2:
+            rv = self._life_4x4(node)
+        else:
+            rv = self._successor(node, j)
+        node.memo[j] = rv
+        return rv
+
+    def _successor(self, node: Node, j: int) -> Node:
+        join = self.join
+        nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+        # Nine overlapping sub-squares, each half the size of the node
+        n00 = nw
+        n01 = join(nw.ne, ne.nw, nw.se, ne.sw)
+        n02 = ne
+        n10 = join(nw.sw, nw.se, sw.nw, sw.ne)
+        n11 = join(nw.se, ne.sw, sw.ne, se.nw)
+        n12 = join(ne.sw, ne.se, se.nw, se.ne)
+        n20 = sw
+        n21 = join(sw.ne, se.nw, sw.se, se.sw)
+        n22 = se
+        subs = (n00, n01, n02, n10, n11, n12, n20, n21, n22)
+
+        if j == node.level - 2:
+            # Full speed: two half-jumps
+            c = [self.successor(s, j - 1) for s in subs]
+            k = j - 1
+        else:
+            c = [self.centre(s) for s in subs]
+            k = j
+        return join(
+            self.successor(join(c[0], c[1], c[3], c[4]), k),
+            self.successor(join(c[1], c[2], c[4], c[5]), k),
+            self.successor(join(c[3], c[4], c[6], c[7]), k),
+            self.successor(join(c[4], c[5], c[7], c[8]), k),
+        )
+
+    def _life_4x4(self, node: Node) -> Node:
+        """Step the centre 2x2 of a 4x4 node one generation, the base case."""
+        cells = [[0] * 4 for _ in range(4)]
+        for qy, qx, q in ((0, 0, node.nw), (0, 2, node.ne), (2, 0, node.sw), (2, 2, node.se)):
+            cells[qy][qx] = q.nw.population
+            cells[qy][qx + 1] = q.ne.population
+            cells[qy + 1][qx] = q.sw.population
+            cells[qy + 1][qx + 1] = q.se.population
+
+        def rule(y: int, x: int) -> Node:
+            n = sum(
+                cells[y + dy][x + dx]
+                for dy in (-1, 0, 1)
+                for dx in (-1, 0, 1)
+                if dy or dx
+            )
+            return ALIVE if n == 3 or (n == 2 and cells[y][x]) else DEAD
+
+        return self.join(rule(1, 1), rule(1, 2), rule(2, 1), rule(2, 2))
+
+    def build(self, live: list[tuple[int, int]], level: int) -> Node:
+        """Node of the given level from live (y, x) cells, 0 <= y, x < 2**level."""
+        layer: dict[tuple[int, int], Node] = dict.fromkeys(live, ALIVE)
+        for lvl in range(level):
+            e = self.empty(lvl)
+            parents: dict[tuple[int, int], list[Node]] = {}
+            for (y, x), n in layer.items():
+                parent = parents.setdefault((y >> 1, x >> 1), [e, e, e, e])
+                parent[(y & 1) * 2 + (x & 1)] = n
+            layer = {yx: self.join(*quads) for yx, quads in parents.items()}
+        return layer.get((0, 0)) or self.empty(level)
+
+    def cells(self, node: Node, y: int = 0, x: int = 0):
+        """Yield live (y, x) cells of the node, offset by y, x."""
+        if node.population == 0:
+            return
+        if node.level == 0:
+            yield y, x
+            return
+        half = 1 << (node.level - 1)
+        yield from self.cells(node.nw, y, x)
+        yield from self.cells(node.ne, y, x + half)
+        yield from self.cells(node.sw, y + half, x)
+        yield from self.cells(node.se, y + half, x + half)
+
+    def advance(self, board: str, width: int, generations: int) -> str:
+        """Return the board after so many generations, same format and size.
+
+        Nothing is born without live neighbours, so the live cells spread by
+        at most one cell per generation: a jump no longer than their distance
+        to the edges keeps them on the board all along, and there the infinite
+        plane and the dead edges agree. Cells at an edge are stepped one
+        generation, the cells born past the edge cleared. A board that comes
+        back skips whole periods, that's what makes long runs fast.
+        """
+        height = len(board) // width
+        live = [divmod(i, width) for i, c in enumerate(board) if c == "1"]
+        seen: dict[frozenset[tuple[int, int]], int] = {}
+        done = 0
+        while live and done < generations:
+            key = frozenset(live)
+            if (last := seen.get(key)) is not None:
+                done = generations - (generations - done) % (done - last)
+                seen.clear()
+                continue
+            if len(seen) >= self.max_history:
+                seen.clear()
+            seen[key] = done
+            margin = min(min(y, x, height - 1 - y, width - 1 - x) for y, x in live)
+            step = max(min(margin, generations - done), 1)
+            live = [
+                (y, x)
+                for y, x in self.jump(live, max(width, height), step)
+                if 0 <= y < height and 0 <= x < width
+            ]
+            done += step
+
+        rv = bytearray(b"0" * (width * height))
+        for y, x in live:
+            rv[y * width + x] = ord("1")
+        return rv.decode()
+
+    def jump(self, live: list[tuple[int, int]], size: int, generations: int):
+        """Yield the live (y, x) cells after so many generations on the infinite plane.
+
+        The cells start within a size x size square at the origin.
+        """
+        level = max(size - 1, 1).bit_length() + 1
+        node = self.build(live, level)
+        # Board coordinates of the node's top-left corner
+        top = left = 0
+
+        j = 0
+        while generations >> j:
+            if generations >> j & 1:
+                # Keep the pattern in the centre quarter, far enough from the edges
+                # that it can't escape the result in 2**j generations
+                while (
+                    node.level < j + 3
+                    or self.centre(self.centre(node)).population != node.population
+                ):
+                    shift = 1 << (node.level - 1)
+                    node = self.expand(node)
+                    top, left = top - shift, left - shift
+                shift = 1 << (node.level - 2)
+                node = self.successor(node, j)
+                top, left = top + shift, left + shift
+            j += 1
+        yield from self.cells(node, top, left)
+
+
+def advance(board: str, width: int, generations: int) -> str:
+    """Return the board after so many generations, see `HashLife.advance`."""
+    return HashLife().advance(board, width, generations)
+
+
+def benchmark():
+    """Compare with the NumPy stepper on periodic patterns."""
+    import time
+
+    import life
+
+    blinker = ["00000", "00000", "01110", "00000", "00000"]
+    toad = ["000000", "000000", "001110", "011100", "000000", "000000"]
+    block = ["0000", "0110", "0110", "0000"]
+    patterns = {"blinkers": blinker, "toads": toad, "blocks": block}
+
+    for name, tile in patterns.items():
+        reps = 8
+        rows = [row * reps for row in tile] * reps
+        width = len(rows[0])
+        board = "".join(rows)
+        hl = HashLife()
+        for generations in (10, 100, 1_000, 10_000, 1_000_000):
+            t0 = time.perf_counter()
+            fast = hl.advance(board, width, generations)
+            t1 = time.perf_counter()
+            if generations <= 10_000:
+                naive = life.to_string(
+                    life.advance(life.from_string(board, width), generations)
+                )
+                t2 = time.perf_counter()
+                assert fast == naive, (name, generations)
+                naive_time = f"{t2 - t1:9.4f}s"
+            else:
+                naive_time = "        -"
+            print(
+                f"{name:8} {width}x{width} gen {generations:>9}:"
+                f" hashlife {t1 - t0:9.4f}s naive {naive_time}"
+                f" nodes {len(hl.nodes)}"
+            )
+
+
+if __name__ == "__main__":
+    benchmark()
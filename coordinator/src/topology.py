@@ -0,0 +1,313 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Grid topology shared by the coordinator, worker and peer charms.
+
+This module is shared between the charms, keep the copies identical.
+
+The leader publishes a compact descriptor in the `topology` databag key:
+    {"version": 3, "width": 3, "height": 3, "wrap": false, "shape": "moore",
+     "radius": 1, "tile": 1, "digest": "...", "cells": [...]}
+
+Cells derive their own neighbours from it locally.
+In tile mode (tile > 1) every cell owns a tile x tile block of the board.
+The `version` is bumped only when the membership changes. Cells keep
+their grid position from one version to the next where they can, so a
+unit joining or leaving moves as few cells as possible, see `successor`.
+
+A ragged layout has fewer cells than width x height, the grid positions
+past the last cell are holes: they stay dead, like the board's edges.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import functools
+import hashlib
+import json
+import math
+from typing import Any
+
+SHAPES = ("moore", "von-neumann")
+LAYOUTS = ("square", "rectangle", "ragged")
+
+
+@functools.lru_cache(maxsize=32)
+def offsets(shape: str = "moore", radius: int = 1) -> tuple[tuple[int, int], ...]:
+    """Relative (dy, dx) positions of the neighbours, excluding the cell itself."""
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown neighbourhood shape {shape!r}")
+    if radius < 1:
+        raise ValueError(f"Neighbourhood radius must be positive, got {radius}")
+    span = range(-radius, radius + 1)
+    return tuple(
+        (dy, dx)
+        for dy in span
+        for dx in span
+        if (dy, dx) != (0, 0)
+        and (shape == "moore" or abs(dy) + abs(dx) <= radius)
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class Topology:
+    """Cells laid out row by row on a width x height grid.
+
+    The board is (width * tile) x (height * tile) cells, row by row.
+    """
+
+    cells: tuple[str, ...]
+    width: int
+    height: int
+    version: int = 0
+    wrap: bool = False
+    shape: str = "moore"
+    radius: int = 1
+    tile: int = 1
+
+    @classmethod
+    def square(cls, cells: list[str], version: int = 0, **kw) -> Topology:
+        """Largest square N x N grid of the sorted cells, extra cells are unused."""
+        N = int(len(cells) ** 0.5)  # noqa: N806
+        return cls(tuple(cells[: N * N]), N, N, version, **kw)
+
+    @classmethod
+    def rectangle(cls, cells: list[str], version: int = 0, **kw) -> Topology:
+        """All the sorted cells on the W x H grid closest to square, W >= H."""
+        n = len(cells)
+        height = max((h for h in range(1, math.isqrt(n) + 1) if n % h == 0), default=0)
+        return cls(tuple(cells), n // height if n else 0, height, version, **kw)
+
+    @classmethod
+    def ragged(cls, cells: list[str], version: int = 0, width: int = 0, **kw) -> Topology:
+        """All the sorted cells row by row, the last row may be short.
+
+        Near-square unless the width is given, see `holes`.
+        """
+        n = len(cells)
+        width = width or math.isqrt(n - 1) + 1 if n else 0
+        return cls(tuple(cells), width, -(-n // width) if n else 0, version, **kw)
+
+    @classmethod
+    def grid(
+        cls,
+        cells: list[str] | tuple[str, ...],
+        width: int = 0,
+        height: int = 0,
+        layout: str = "square",
+        **kw,
+    ) -> Topology:
+        """Sorted cells on a width x height grid, else as the `layout` has it.
+
+        Cached on the set of cells, leaders call this on every relation event,
+        only a new membership pays for the sort. Cells that don't fit are
+        unused, see `unused`.
+        """
+        return _grid(frozenset(cells), width, height, layout, tuple(sorted(kw.items())))
+
+    def unused(self, cells: list[str] | tuple[str, ...]) -> list[str]:
+        """Cells that didn't fit on the grid."""
+        return [cell for cell in cells if cell not in self._index]
+
+    @classmethod
+    def loads(cls, data: str) -> Topology:
+        """Parse the descriptor, ValueError if the digest doesn't match."""
+        d = json.loads(data)
+        rv = cls(
+            tuple(d["cells"]),
+            d["width"],
+            d["height"],
+            d["version"],
+            d.get("wrap", False),
+            d.get("shape", "moore"),
+            d.get("radius", 1),
+            d.get("tile", 1),
+        )
+        if d.get("digest") != rv.digest:
+            raise ValueError(f"Topology digest mismatch in version {rv.version}")
+        return rv
+
+    def dumps(self) -> str:
+        """Serialize to the descriptor published in the `topology` key."""
+        return json.dumps(
+            {
+                "version": self.version,
+                "width": self.width,
+                "height": self.height,
+                "wrap": self.wrap,
+                "shape": self.shape,
+                "radius": self.radius,
+                "tile": self.tile,
+                "digest": self.digest,
+                "cells": self.cells,
+            }
+        )
+
+    def successor(
+        self, previous: Topology | None, units: list[str] | tuple[str, ...] = ()
+    ) -> Topology:
+        """Return previous if the layout is the same, else the next version.
+
+        That's self, the grid for `units`, default the cells, with the cells
+        that were on the previous grid kept at the same row and column if
+        it's still on the board. The free positions go in order to the cells
+        that were moved off, then to the rest of the units, sorted.
+        """
+        if previous is None:
+            return self
+        rv = self.settle(previous, units or self.cells)
+        if dataclasses.replace(previous, version=rv.version) == rv:
+            return previous
+        return dataclasses.replace(rv, version=previous.version + 1)
+
+    def settle(self, previous: Topology, units: list[str] | tuple[str, ...]) -> Topology:
+        """Self with the cells placed as `successor` describes."""
+        present = set(units)
+        slots: list[str | None] = [None] * len(self.cells)
+        moved = []
+        for i, cell in enumerate(previous.cells):
+            if cell not in present:
+                continue
+            y, x = divmod(i, previous.width)
+            if x < self.width and (position := y * self.width + x) < len(slots):
+                slots[position] = cell
+            else:
+                moved.append(cell)
+        waiting = iter([*moved, *sorted(present - set(previous.cells))])
+        cells = tuple(cell or next(waiting) for cell in slots)
+        return dataclasses.replace(self, cells=cells)
+
+    @functools.cached_property
+    def digest(self) -> str:
+        """Short hash of the layout, guards the descriptor against corruption."""
+        layout = (
+            f"{self.width}x{self.height}:{self.wrap}:{self.shape}:{self.radius}:"
+            f"{self.tile}:"
+            + " ".join(self.cells)
+        )
+        return hashlib.sha256(layout.encode()).hexdigest()[:16]
+
+    @property
+    def board_width(self) -> int:
+        """Board columns, `tile` per grid column."""
+        return self.width * self.tile
+
+    @property
+    def board_height(self) -> int:
+        """Board rows, `tile` per grid row."""
+        return self.height * self.tile
+
+    @property
+    def board_size(self) -> int:
+        """Board cells, holes included."""
+        return self.board_width * self.board_height
+
+    @property
+    def holes(self) -> int:
+        """Grid positions past the last cell, 0 unless the layout is ragged."""
+        return self.width * self.height - len(self.cells)
+
+    @functools.cached_property
+    def _index(self) -> dict[str, int]:
+        return {cell: i for i, cell in enumerate(self.cells)}
+
+    def index(self, cell: str) -> int | None:
+        """Position of the cell on the board, None if the cell is unused."""
+        return self._index.get(cell)
+
+    def neighbour_indices(self, index: int) -> list[int]:
+        """Board positions of the neighbours of one cell, sorted."""
+        width, height = self.width, self.height
+        mey, mex = divmod(index, width)
+        rv = set()
+        for dy, dx in offsets(self.shape, self.radius):
+            ny, nx = mey + dy, mex + dx
+            if self.wrap:
+                ny %= height
+                nx %= width
+            elif not (0 <= ny < height and 0 <= nx < width):
+                continue
+            if ny * width + nx < len(self.cells):
+                rv.add(ny * width + nx)
+        rv.discard(index)
+        return sorted(rv)
+
+    def assemble(self, tiles: list[str]) -> str:
+        """Build the board from the cells' tiles, each a tile*tile string."""
+        k = self.tile
+        tiles = [*tiles, *["0" * k * k] * self.holes]
+        if k == 1:
+            return "".join(tiles)
+        return "".join(
+            tiles[ty * self.width + tx][r * k : r * k + k]
+            for ty in range(self.height)
+            for r in range(k)
+            for tx in range(self.width)
+        )
+
+    def tiles(self, board: str) -> list[str]:
+        """Split the board into the cells' tiles, the reverse of `assemble`."""
+        k = self.tile
+        if k == 1:
+            return list(board[: len(self.cells)])
+        w = self.board_width
+        return [
+            "".join(board[(ty * k + r) * w + tx * k :][:k] for r in range(k))
+            for ty in range(self.height)
+            for tx in range(self.width)
+        ][: len(self.cells)]
+
+    def trim(self, board: str) -> str:
+        """Return the board with the holes dead."""
+        return self.assemble(self.tiles(board)) if self.holes else board
+
+    def active(self, changed: list[int]) -> set[int]:
+        """Cells that have a changed board position within reach.
+
+        Only these can change in the next generation, every other cell sees
+        the same neighbourhood as in the last one. The reach is the cell's
+        tile and a `radius` wide halo around it, a square for either shape.
+        """
+        k, r = self.tile, self.radius
+        rv = set()
+        for i in changed:
+            y, x = divmod(i, self.board_width)
+            rows = range((y - r) // k, (y + r) // k + 1)
+            columns = range((x - r) // k, (x + r) // k + 1)
+            if self.wrap:
+                rows = {ty % self.height for ty in rows}
+                columns = {tx % self.width for tx in columns}
+            rv.update(
+                ty * self.width + tx
+                for ty in rows
+                if 0 <= ty < self.height
+                for tx in columns
+                if 0 <= tx < self.width
+            )
+        return {i for i in rv if i < len(self.cells)}
+
+    def neighbours(self, cell: str) -> list[str]:
+        """Neighbours of the cell, e.g. [unit/3, unit/4, ...]."""
+        index = self._index[cell]
+        return sorted(self.cells[i] for i in self.neighbour_indices(index))
+
+
+@functools.lru_cache(maxsize=8)
+def _grid(
+    members: frozenset[str],
+    width: int,
+    height: int,
+    layout: str,
+    kw: tuple[tuple[str, Any], ...],
+) -> Topology:
+    cells = tuple(sorted(members))
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout!r}")
+    if not (width and height):
+        if layout == "rectangle":
+            return Topology.rectangle(list(cells), **dict(kw))
+        if layout == "ragged":
+            return Topology.ragged(list(cells), width=width, **dict(kw))
+        return Topology.square(list(cells), **dict(kw))
+    if len(cells) < width * height:
+        raise ValueError(f"{len(cells)} cells can't fill a {width}x{height} board")
+    return Topology(cells[: width * height], width, height, **dict(kw))
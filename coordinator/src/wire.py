@@ -0,0 +1,216 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Wire formats for the board in the `board` databag key.
+
+This module is shared between the coordinator and worker charms and
+clean/extract.py, keep the copies identical.
+
+Formats:
+    text: "0001110..." one ASCII character per cell (legacy, untagged)
+    bits: "b1:<cells>:<base64>" cells packed 8 per byte, MSB first
+    sparse: "s1:<cells>:<gaps>" live cells only, comma separated base 36 gaps,
+        the dead cells before each live one, e.g. "s1:9:3,0,0" is "000111000"
+    auto: bits or sparse, whichever is shorter for the board
+
+Sparse boards scale with the population, mostly dead boards are far
+smaller than even bit-packed ones.
+
+Between keyframes the coordinator sends the board as a delta against the
+last full one, in the `delta` key, see `delta`.
+"""
+
+import base64
+import binascii
+import string
+import zlib
+
+BITS_V1 = "b1"
+SPARSE_V1 = "s1"
+DELTA_V1 = "d1"
+ENCODINGS = ("text", "bits", "sparse", "auto")
+DIGITS = string.digits + string.ascii_lowercase
+
+
+def encode(board: str, encoding: str = "text") -> str:
+    """Encode a "0"/"1" board string for the wire."""
+    if encoding == "text":
+        return board
+    elif encoding == "bits":
+        return f"{BITS_V1}:{len(board)}:{base64.b64encode(pack(board)).decode()}"
+    elif encoding == "sparse":
+        return f"{SPARSE_V1}:{len(board)}:{','.join(map(base36, gaps(live(board))))}"
+    elif encoding == "auto":
+        # Bits are N/6 characters, sparse at least 2 per live cell
+        if board.count("1") * 2 > len(board) / 6:
+            return encode(board, "bits")
+        return min(encode(board, "bits"), encode(board, "sparse"), key=len)
+    else:
+        raise ValueError(f"Unknown board encoding {encoding!r}")
+
+
+def decode(data: str) -> str:
+    """Decode any supported wire format into a "0"/"1" board string."""
+    return str(Board(data))
+
+
+def pack(board: str) -> bytes:
+    """Pack a "0"/"1" board string into bytes, MSB first."""
+    size = (len(board) + 7) // 8
+    if not size:
+        return b""
+    return int(board.ljust(size * 8, "0"), 2).to_bytes(size, "big")
+
+
+def live(board: str):
+    """Yield the indices of the live cells."""
+    index = board.find("1")
+    while index >= 0:
+        yield index
+        index = board.find("1", index + 1)
+
+
+def gaps(indices):
+    """Distances between increasing indices, less one, from -1."""
+    previous = -1
+    for index in indices:
+        yield index - previous - 1
+        previous = index
+
+
+def indices(payload: str):
+    """Inverse of `gaps`, with the base 36 digits still to parse."""
+    index = -1
+    try:
+        for gap in payload.split(",") if payload else ():
+            index += int(gap, 36) + 1
+            yield index
+    except ValueError as e:
+        raise ValueError(f"Corrupt board: {e}")
+
+
+def delta(keyframe: str, board: str) -> str:
+    """Encode the board as the cells that differ from the keyframe, and a checksum.
+
+    "d1:<crc32>:<gaps>", the gaps as in sparse boards, e.g. "d1:8e5d1a40:1,2,0"
+    flips cells 1, 4 and 5. Both are "0"/"1" strings of the same length.
+    """
+    if len(keyframe) != len(board):
+        raise ValueError("Board size changed")
+    flipped = format(int(keyframe or "0", 2) ^ int(board or "0", 2), f"0{len(board)}b")
+    return f"{DELTA_V1}:{checksum(board)}:{','.join(map(base36, gaps(live(flipped))))}"
+
+
+def apply(keyframe: str, data: str) -> str:
+    """Rebuild the board from the keyframe and a `delta`, ValueError if it doesn't check out."""
+    tag, crc, payload = data.split(":", 2)
+    if tag != DELTA_V1:
+        raise ValueError(f"Unknown delta format {data[:16]!r}...")
+    cells = bytearray(keyframe.encode())
+    for index in indices(payload):
+        if index >= len(cells):
+            raise ValueError(f"Delta doesn't fit the board {data[:16]!r}...")
+        cells[index] ^= 1  # "0" <-> "1"
+    board = cells.decode()
+    if checksum(board) != crc:
+        raise ValueError("Board checksum mismatch")
+    return board
+
+
+def checksum(board: str) -> str:
+    return f"{zlib.crc32(board.encode()):08x}"
+
+
+def base36(n: int) -> str:
+    rv = "" if n else "0"
+    while n:
+        n, digit = divmod(n, 36)
+        rv = DIGITS[digit] + rv
+    return rv
+
+
+def unpack(raw: bytes, length: int) -> str:
+    """Inverse of `pack`."""
+    if not length:
+        return ""
+    return bin(int.from_bytes(raw, "big"))[2:].zfill(len(raw) * 8)[:length]
+
+
+class Board:
+    """Read-only view of a board on the wire, decoded lazily.
+
+    Indexing returns 0 or 1. Bit-packed boards only decode the base64
+    quantum (4 characters, 3 bytes, 24 cells) that holds the requested cell,
+    sparse ones are read into a set of live cells up front.
+    """
+
+    def __init__(self, data: str):
+        self._data = data
+        self._chunks: dict[int, bytes] = {}
+        if data.startswith(f"{BITS_V1}:"):
+            _, length, self._payload = data.split(":", 2)
+            self.encoding = "bits"
+            self._length = int(length)
+            if len(self._payload) != 4 * ((self._length + 23) // 24):
+                raise ValueError(f"Truncated board {data[:16]!r}...")
+        elif data.startswith(f"{SPARSE_V1}:"):
+            _, length, payload = data.split(":", 2)
+            self.encoding = "sparse"
+            self._length = int(length)
+            self._live = set(indices(payload))
+            if self._live and max(self._live) >= self._length:
+                raise ValueError(f"Truncated board {data[:16]!r}...")
+        elif data[:1].isdigit() or not data:
+            self.encoding = "text"
+            self._length = len(data)
+        else:
+            raise ValueError(f"Unknown board format {data[:16]!r}...")
+
+    def __len__(self) -> int:
+        """Return the number of cells."""
+        return self._length
+
+    def __getitem__(self, index: int) -> int:
+        """Return one cell as 0 or 1, decoding only its quantum."""
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        if self.encoding == "text":
+            return int(self._data[index])
+        if self.encoding == "sparse":
+            return int(index in self._live)
+        quantum, bit = divmod(index, 24)
+        if (chunk := self._chunks.get(quantum)) is None:
+            try:
+                chunk = base64.b64decode(self._payload[quantum * 4 : quantum * 4 + 4])
+            except binascii.Error as e:
+                raise ValueError(f"Corrupt board: {e}")
+            self._chunks[quantum] = chunk
+        return chunk[bit // 8] >> (7 - bit % 8) & 1
+
+    def slice(self, start: int, stop: int) -> str:
+        """Cells [start:stop] as a "0"/"1" string, decoding only those quanta."""
+        start, stop, _ = slice(start, stop).indices(self._length)
+        if self.encoding == "text":
+            return self._data[start:stop]
+        if self.encoding == "sparse":
+            return "".join("01"[i in self._live] for i in range(start, stop))
+        if start >= stop:
+            return ""
+        first, last = start // 24, (stop - 1) // 24 + 1
+        try:
+            raw = base64.b64decode(self._payload[first * 4 : last * 4])
+        except binascii.Error as e:
+            raise ValueError(f"Corrupt board: {e}")
+        return unpack(raw, len(raw) * 8)[start - first * 24 : stop - first * 24]
+
+    def __str__(self) -> str:
+        """Return the whole board as a "0"/"1" string."""
+        if self.encoding == "text":
+            return self._data
+        if self.encoding == "sparse":
+            cells = ["0"] * self._length
+            for i in self._live:
+                cells[i] = "1"
+            return "".join(cells)
+        return unpack(base64.b64decode(self._payload), self._length)
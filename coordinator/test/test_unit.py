@@ -1,13 +1,20 @@
 """Test it."""
 
+import dataclasses
 import json
+import random
 from typing import NewType
 from unittest.mock import ANY
 
 import ops
-from ops.testing import Context, Relation, State
+import pytest
+from ops.testing import ActionFailed, Context, Relation, State
 
-from charm import JGOLCoordinatorCharm
+import dispatch
+import hashlife
+import wire
+from charm import INIT, JGOLCoordinatorCharm, reference, seed
+from topology import Topology
 
 JSON = NewType("JSON", str)
 
@@ -30,6 +37,13 @@ MAP_3X3 = {
 }
 
 
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run in a scratch directory, the charm writes its dispatch rules there."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
 def test_boot():
     """Leader with blank config, etc."""
     rel = Relation(
@@ -44,15 +58,21 @@ def test_boot():
     assert state.app_status == ops.WaitingStatus("Resetting... [....]")
     rel = state.get_relation(1)
     assert rel.local_app_data == {
-        "map": ANY,
+        "topology": ANY,
         "board": "0001",
         "round": "0",
     }
-    assert json.loads(rel.local_app_data["map"]) == {
-        "remote/0": ["remote/1", "remote/2", "remote/3"],
-        "remote/1": ["remote/0", "remote/2", "remote/3"],
-        "remote/2": ["remote/0", "remote/1", "remote/3"],
-        "remote/3": ["remote/0", "remote/1", "remote/2"],
+    topology = json.loads(rel.local_app_data["topology"])
+    assert topology == {
+        "version": 0,
+        "width": 2,
+        "height": 2,
+        "wrap": False,
+        "shape": "moore",
+        "radius": 1,
+        "tile": 1,
+        "digest": ANY,
+        "cells": ["remote/0", "remote/1", "remote/2", "remote/3"],
     }
 
 
@@ -74,13 +94,526 @@ def test_waiting():
     assert state.app_status == ops.ActiveStatus("7: [...0]")
     rel = state.get_relation(1)
     assert rel.local_app_data == {
-        "map": ANY,
+        "topology": ANY,
         "board": "0001",
         "round": "7",
     }
-    assert json.loads(rel.local_app_data["map"]) == {
-        "remote/0": ["remote/1", "remote/2", "remote/3"],
-        "remote/1": ["remote/0", "remote/2", "remote/3"],
-        "remote/2": ["remote/0", "remote/1", "remote/3"],
-        "remote/3": ["remote/0", "remote/1", "remote/2"],
+    topology = json.loads(rel.local_app_data["topology"])
+    assert topology == {
+        "version": 0,
+        "width": 2,
+        "height": 2,
+        "wrap": False,
+        "shape": "moore",
+        "radius": 1,
+        "tile": 1,
+        "digest": ANY,
+        "cells": ["remote/0", "remote/1", "remote/2", "remote/3"],
     }
+
+
+def test_bits_encoding():
+    """Board is published bit-packed when asked to."""
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "7", "board": "0001"},
+        remote_units_data={i: {"round": "7", "value": v} for i, v in enumerate("0110")},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    config = {"run": True, "board-encoding": "bits"}
+    state = State(leader=True, relations={rel}, config=config)
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    assert state.app_status == ops.ActiveStatus("7: [0110] --> 8")
+    rel = state.get_relation(1)
+    assert rel.local_app_data["board"] == "b1:4:YA=="
+    assert rel.local_app_data["round"] == "8"
+
+
+@pytest.mark.parametrize(
+    "encoding,payload", [("sparse", "s1:16:0"), ("auto", "s1:16:0"), ("bits", "b1:16:gAA=")]
+)
+def test_sparse_encoding(encoding: str, payload: str):
+    """A mostly dead board goes out, and shows, as its live cells."""
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "7", "board": "0" * 16},
+        remote_units_data={i: {"round": "7", "value": str(int(i == 0))} for i in range(16)},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    config = {"run": True, "board-encoding": encoding}
+    state = ctx.run(ctx.on.relation_changed(rel), State(leader=True, relations={rel}, config=config))
+    assert state.get_relation(1).local_app_data["board"] == payload
+    shown = "1000000000000000" if encoding == "bits" else payload
+    assert state.app_status == ops.ActiveStatus(f"7: [{shown}] --> 8")
+
+
+def test_wire_formats():
+    """Every encoding round-trips, sparse is the shortest for a sparse board."""
+    rng = random.Random(3)
+    for density in (0, 0.01, 0.5, 1):
+        board = "".join("01"[rng.random() < density] for _ in range(1000))
+        sizes = {}
+        for encoding in wire.ENCODINGS:
+            data = wire.encode(board, encoding)
+            sizes[encoding] = len(data)
+            assert wire.decode(data) == board
+            assert wire.Board(data).slice(990, 1010) == board[990:]
+        assert sizes["auto"] == min(sizes["bits"], sizes["sparse"])
+    assert sizes["sparse"] > sizes["bits"]
+    assert wire.encode("0" * 1000 + "1", "auto") == "s1:1001:rs"
+    with pytest.raises(ValueError):
+        wire.Board("s1:3:5")
+
+
+def test_delta_between_keyframes():
+    """Changes go out as a delta against the keyframe, a worker can ask for a new one."""
+    topology = Topology(tuple(f"remote/{i}" for i in range(100)), 10, 10)
+    before = "0" * 44 + "111" + "0" * 53
+    after = reference(before, topology)
+    app_data = {"round": "7", "board": before, "keyframe": "7", "topology": topology.dumps()}
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data=app_data,
+        remote_units_data={i: {"round": "7", "value": after[i]} for i in range(100)},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    config = {"run": True, "keyframe-interval": 4, "verify": True}
+    state = State(leader=True, relations={rel}, config=config)
+    state = ctx.run(ctx.on.relation_changed(rel, remote_unit=0), state)
+    assert state.app_status == ops.ActiveStatus(f"7: [{after}] --> 8")
+    app_data = state.get_relation(1).local_app_data
+    assert app_data["board"] == before and app_data["keyframe"] == "7"
+    assert wire.apply(before, app_data["delta"]) == after
+
+    # A worker that can't apply it gets a keyframe for the same round
+    workers = {i: {"round": "7", "value": after[i]} for i in range(100)}
+    workers[3] = {"round": "7", "value": "0", "resync": "8"}
+    rel = dataclasses.replace(state.get_relation(1), remote_units_data=workers)
+    state = ctx.run(ctx.on.relation_changed(rel, remote_unit=3), dataclasses.replace(state, relations={rel}))
+    app_data = state.get_relation(1).local_app_data
+    assert app_data["board"] == after and app_data["keyframe"] == "8"
+    assert "delta" not in app_data and app_data["round"] == "8"
+
+
+def test_activity_mask():
+    """Only cells within reach of the last changes step, the others keep their value."""
+    topology = Topology(tuple(f"remote/{i}" for i in range(100)), 10, 10)
+    before = "0" * 11 + "111" + "0" * 86
+    after = reference(before, topology)
+    app_data = {"round": "7", "board": before, "topology": topology.dumps()}
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data=app_data,
+        remote_units_data={i: {"round": "7", "value": after[i]} for i in range(100)},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True, "activity-mask": True})
+    state = ctx.run(ctx.on.relation_changed(rel, remote_unit=0), state)
+    assert state.app_status == ops.ActiveStatus(f"7: [{after}] --> 8, 18 active")
+    mask = wire.decode(state.get_relation(1).local_app_data["active"])
+    active = [i for i, a in enumerate(mask) if a == "1"]
+    assert active == [*range(0, 5), *range(10, 15), *range(20, 25), 31, 32, 33]
+
+    # The active cells report one by one, the rest have nothing to say
+    workers = {i: {"round": "8" if i in active else "7", "value": before[i]} for i in range(100)}
+    rel = dataclasses.replace(state.get_relation(1), remote_units_data=workers)
+    state = dataclasses.replace(state, relations={rel})
+    for i in active:
+        state = ctx.run(ctx.on.relation_changed(rel, remote_unit=i), state)
+    assert state.app_status == ops.ActiveStatus(f"8: [{before}] --> 9, 18 active")
+
+
+def test_activity_mask_still_life():
+    """With nothing left to step the mask would be empty, halt instead of waiting."""
+    topology = Topology(tuple(f"remote/{i}" for i in range(16)), 4, 4)
+    block = "0000011001100000"
+    app_data = {"round": "7", "board": block, "topology": topology.dumps()}
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data=app_data,
+        remote_units_data={i: {"round": "7", "value": block[i]} for i in range(16)},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True, "activity-mask": True})
+    for _ in range(2):
+        state = ctx.run(ctx.on.relation_changed(rel, remote_unit=0), state)
+        assert state.app_status == ops.ActiveStatus(f"7: [{block}] still life, halted")
+        assert state.get_relation(1).local_app_data == app_data
+
+
+def test_cycle_detection():
+    """The blinker repeats every other round, halt there or skip ahead."""
+    blinker = ("000111000", "010010010")
+    topology = Topology(tuple(f"remote/{i}" for i in range(9)), 3, 3)
+
+    def run(config: dict, generations: int) -> list[str]:
+        app_data = {"round": "0", "board": blinker[0], "topology": topology.dumps()}
+        rel = Relation(endpoint="world", id=1, local_app_data=app_data)
+        ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+        state = State(leader=True, relations={rel}, config={"run": True, "cycle-history": 8, **config})
+        statuses = []
+        for _ in range(generations):
+            rel = state.get_relation(1)
+            r = rel.local_app_data["round"]
+            workers = {i: {"round": r, "value": blinker[(int(r) + 1) % 2][i]} for i in range(9)}
+            rel = dataclasses.replace(rel, remote_units_data=workers)
+            state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, relations={rel}))
+            statuses.append(state.app_status.message)
+        return statuses
+
+    assert run({"on-cycle": "skip", "cycle-skip": 11}, 4) == [
+        "0: [010010010] --> 1",
+        "1: [000111000] --> 2",
+        "2: [010010010] --> 13, period 2, skipped 10",
+        "13: [000111000] --> 24, period 2, skipped 10",
+    ]
+    assert run({"on-cycle": "halt"}, 4)[2:] == ["2: [010010010] period 2, halted"] * 2
+    assert run({}, 3)[2] == "2: [010010010] --> 3, period 2"
+
+
+def test_tile_mode():
+    """Units report whole tiles, the board is assembled from them."""
+    tiles = ["b1:4:gA==", "b1:4:QA==", "b1:4:IA==", "b1:4:EA=="]  # one live cell each
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "7"},
+        remote_units_data={
+            i: {"round": "7", "value": tile} for i, tile in enumerate(tiles)
+        },
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    config = {"run": True, "tile": 2}
+    state = State(leader=True, relations={rel}, config=config)
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    assert state.app_status == ops.ActiveStatus("7: [4 live, 0 pending of 16] --> 8")
+    rel = state.get_relation(1)
+    assert wire.decode(rel.local_app_data["board"]) == "1001" "0000" "0000" "1001"
+    assert rel.local_app_data["board"].startswith("b1:")
+    assert json.loads(rel.local_app_data["topology"])["tile"] == 2
+
+
+def test_topology_rewritten_only_on_membership_change():
+    """Same units keep the same topology version, new units bump it."""
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    rel = Relation(endpoint="world", id=1, remote_units_data={0: {}, 1: {}, 2: {}, 3: {}})
+    state = ctx.run(ctx.on.relation_changed(rel), State(leader=True, relations={rel}))
+    descriptor = state.get_relation(1).local_app_data["topology"]
+
+    rel = state.get_relation(1)
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    assert state.get_relation(1).local_app_data["topology"] == descriptor
+
+    rel = dataclasses.replace(
+        state.get_relation(1),
+        remote_units_data={i: {} for i in range(9)},
+    )
+    state = ctx.run(ctx.on.relation_joined(rel), dataclasses.replace(state, relations={rel}))
+    topology = json.loads(state.get_relation(1).local_app_data["topology"])
+    assert topology["version"] == 1
+    assert (topology["width"], topology["height"]) == (3, 3)
+
+
+def neighbourhood(topology: Topology) -> dict[str, list[str]]:
+    return {cell: topology.neighbours(cell) for cell in topology.cells}
+
+
+def test_neighbourhood():
+    cells = [f"app/{i}" for i in range(9)]
+    assert neighbourhood(Topology.grid(cells)) == MAP_3X3
+    # extra cells don't fit the square board
+    topology = Topology.grid([*cells, "app/9"])
+    assert neighbourhood(topology) == MAP_3X3
+    assert topology.unused([*cells, "app/9"]) == ["app/9"]
+    # the same members in any order hit the cache, no sort needed
+    assert Topology.grid(["app/9", *reversed(cells)]) is topology
+
+
+def test_neighbourhood_shapes():
+    cells = list("abcdefghijkl")
+    # a b c d
+    # e f g h
+    # i j k l
+    vn = Topology.grid(cells, 4, 3, shape="von-neumann")
+    assert neighbourhood(vn)["f"] == list("begj")
+    torus = neighbourhood(Topology.grid(cells, 4, 3, wrap=True))
+    assert torus["a"] == list("bdefhijl")
+    assert all(len(v) == 8 for v in torus.values())
+    big = Topology.grid(cells, 4, 3, radius=2, wrap=True)
+    assert all(len(v) == 11 for v in neighbourhood(big).values())
+
+
+def test_neighbourhood_radius_beyond_width():
+    topology = Topology.grid(list("abc"), 1, 3, radius=2)
+    assert neighbourhood(topology) == {"a": ["b", "c"], "b": ["a", "c"], "c": ["a", "b"]}
+    with pytest.raises(ValueError):
+        Topology.grid(list("abc"), 2, 2)
+
+
+def test_fast_forward():
+    """The board jumps ahead without running the cells."""
+    topology = Topology(tuple(f"remote/{i}" for i in range(9)), 3, 3)
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "4", "board": "000111000", "topology": topology.dumps()},
+        remote_units_data={i: {"round": "4", "value": "1"} for i in range(9)},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True})
+    state = ctx.run(ctx.on.action("fast-forward", params={"generations": 5}), state)
+    assert ctx.action_results == {"round": 9, "population": 3}
+    rel = state.get_relation(1)
+    assert rel.local_app_data["board"] == "010010010"
+    assert rel.local_app_data["round"] == "9"
+
+
+def test_verify():
+    """Round results that don't match the reference engine are reported."""
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "4", "board": "000111000"},
+        remote_units_data={i: {"round": "4", "value": v} for i, v in enumerate("010010011")},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True, "verify": True})
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    assert state.app_status == ops.ActiveStatus(
+        "4: [010010011, 1 cells diverged] --> 5"
+    )
+
+
+def test_hashlife():
+    """Hashlife agrees with the NumPy engine, dead edges included."""
+    for side in (8, 20):
+        topology = Topology(("app/0",), 1, 1, tile=side)
+        board = seed(side * side)
+        for generations in (5, 6, 40, 500):
+            expected = reference(board, topology, generations)
+            assert hashlife.advance(board, side, generations) == expected
+    board = "0" * 32 + "00" + INIT[:28] + "00" + "0" * 32
+    board = "".join(board[i : i + 8] for i in range(0, len(board), 8)) * 2
+    for generations in (1, 2, 5, 40):
+        topology = Topology(("app/0",), 1, 1, tile=8)
+        expected = reference(board, topology, generations)
+        assert hashlife.advance(board, 8, generations) == expected
+    blinker = "00000" "00000" "01110" "00000" "00000"
+    assert hashlife.HashLife(max_nodes=1000).advance(blinker, 5, 10**6 + 1) == (
+        "00000" "00100" "00100" "00100" "00000"
+    )
+
+
+def test_fast_forward_hashlife():
+    topology = Topology(tuple(f"remote/{i}" for i in range(9)), 3, 3)
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "0", "board": "000111000", "topology": topology.dumps()},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True})
+    params = {"generations": 10**6 + 1, "engine": "hashlife"}
+    state = ctx.run(ctx.on.action("fast-forward", params=params), state)
+    assert state.get_relation(1).local_app_data["board"] == "010010010"
+
+
+@pytest.mark.parametrize(
+    "layout", [{"wrap": True}, {"shape": "von-neumann"}, {"radius": 2}]
+)
+def test_fast_forward_hashlife_refuses_other_rules(layout):
+    topology = Topology(tuple(f"remote/{i}" for i in range(9)), 3, 3, **layout)
+    app_data = {"round": "0", "board": "000111000", "topology": topology.dumps()}
+    rel = Relation(endpoint="world", id=1, local_app_data=app_data)
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True})
+    params = {"generations": 10, "engine": "hashlife"}
+    with pytest.raises(ActionFailed):
+        ctx.run(ctx.on.action("fast-forward", params=params), state)
+
+
+def test_stale_round_after_fast_forward():
+    """Workers still reporting the old round don't complete the new one."""
+    topology = Topology(tuple(f"remote/{i}" for i in range(9)), 3, 3)
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "4", "board": "000111000", "topology": topology.dumps()},
+        remote_units_data={i: {"round": "4", "value": "1"} for i in range(9)},
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True})
+    state = ctx.run(ctx.on.action("fast-forward", params={"generations": 2}), state)
+    rel = state.get_relation(1)
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    rel = state.get_relation(1)
+    assert rel.local_app_data["round"] == "6"
+    assert rel.local_app_data["board"] == "000111000"
+    assert state.app_status == ops.ActiveStatus("6: [.........]")
+
+
+@pytest.mark.parametrize("size,radius", [(2, 1), (3, 2), (4, 2)])
+def test_reference_small_torus(size: int, radius: int):
+    """The engine counts each neighbour once, like the per-cell topology."""
+    topology = Topology(tuple(f"c{i:02}" for i in range(size * size)), size, size, wrap=True, radius=radius)
+    rng = random.Random(size * 10 + radius)
+    for _ in range(50):
+        board = "".join(rng.choice("01") for _ in range(size * size))
+        expected = "".join(
+            str(
+                int(
+                    (n := sum(int(board[j]) for j in topology.neighbour_indices(i))) == 3
+                    or (n == 2 and board[i] == "1")
+                )
+            )
+            for i in range(size * size)
+        )
+        assert reference(board, topology) == expected
+
+
+def test_rectangular_config():
+    rel = Relation(endpoint="world", id=1, remote_units_data={i: {} for i in range(7)})
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"width": 3, "height": 2})
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    topology = Topology.loads(state.get_relation(1).local_app_data["topology"])
+    assert (topology.width, topology.height, len(topology.cells)) == (3, 2, 6)
+
+
+def test_layouts():
+    units = [f"u/{i:03}" for i in range(120)]
+    rectangle = Topology.grid(units, layout="rectangle")
+    assert (rectangle.width, rectangle.height, len(rectangle.cells)) == (12, 10, 120)
+    ragged = Topology.grid(units, layout="ragged")
+    assert (ragged.width, ragged.height, ragged.holes) == (11, 11, 1)
+    # The last row is one short, nothing lives past its end
+    assert ragged.neighbour_indices(109) == [97, 98, 108, 119]
+    assert ragged.trim("1" * 121) == "1" * 120 + "0"
+    assert Topology.grid(units[:7], width=4, layout="ragged").assemble(list("1111111")) == "11111110"
+    with pytest.raises(ValueError):
+        Topology.grid(units, layout="hexagonal")
+
+
+def test_ragged_config():
+    """Every unit gets a cell, the missing ones at the end stay dead."""
+    rel = Relation(endpoint="world", id=1, remote_units_data={i: {} for i in range(7)})
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"layout": "ragged"})
+    state = ctx.run(ctx.on.config_changed(), state)
+    app_data = state.get_relation(1).local_app_data
+    topology = Topology.loads(app_data["topology"])
+    assert (topology.width, topology.height, len(topology.cells)) == (3, 3, 7)
+    assert app_data["board"] == "000111000"
+
+    # The hole at the bottom would come to life with three live neighbours
+    board = "000110100"
+    after = reference(board, topology)
+    assert after == board
+    app_data = {**app_data, "round": "3", "board": board}
+    workers = {i: {"round": "3", "value": after[i]} for i in range(7)}
+    rel = dataclasses.replace(state.get_relation(1), local_app_data=app_data, remote_units_data=workers)
+    config = {"layout": "ragged", "run": True, "verify": True}
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, relations={rel}, config=config))
+    assert state.app_status == ops.ActiveStatus(f"3: [{after}] --> 4")
+
+
+def test_stable_placement():
+    """Units joining or leaving move as few cells as possible."""
+    units = [f"u/{i}" for i in range(9)]
+    square = Topology.grid(units)
+    # u/9 takes the place of u/4, nobody else moves
+    rest = [*units[:4], *units[5:], "u/9"]
+    after = Topology.grid(rest).successor(square, rest)
+    assert after.version == 1
+    assert after.cells == (*units[:4], "u/9", *units[5:])
+    assert after.neighbours("u/0") == ["u/1", "u/3", "u/9"]
+    assert Topology.grid(rest).successor(after, rest) is after
+    # Growing to 4x4 keeps every cell in its row and column
+    more = [*units, *(f"u/{i}" for i in range(10, 17))]
+    wider = Topology.grid(more).successor(square, more)
+    assert [wider.cells.index(u) for u in units] == [0, 1, 2, 4, 5, 6, 8, 9, 10]
+
+    # A ragged layout closes the gap with the last cell
+    rel = Relation(endpoint="world", id=1, remote_units_data={i: {} for i in range(7)})
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"layout": "ragged"})
+    state = ctx.run(ctx.on.config_changed(), state)
+    workers = {i: {"round": "0", "value": "0", "at": str(i)} for i in (0, 1, 3, 4, 5, 6)}
+    rel = dataclasses.replace(state.get_relation(1), remote_units_data=workers)
+    config = {"layout": "ragged", "run": True}
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, relations={rel}, config=config))
+    topology = Topology.loads(state.get_relation(1).local_app_data["topology"])
+    assert topology.cells == tuple(f"remote/{i}" for i in (0, 1, 6, 3, 4, 5))
+    # remote/6 stepped at its old position, that value doesn't count
+    assert "-->" not in state.app_status.message
+
+    workers[6]["at"] = "2"
+    rel = dataclasses.replace(state.get_relation(1), remote_units_data=workers)
+    config = {"layout": "ragged", "run": True}
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, relations={rel}, config=config))
+    assert state.app_status.message.endswith("--> 1")
+
+
+def test_dispatch_rules():
+    """The leader skips unused units, other units skip everything."""
+    rel = Relation(endpoint="world", id=1, remote_units_data={i: {} for i in range(5)})
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    ctx.run(ctx.on.relation_changed(rel), State(leader=True, relations={rel}))
+    env = {"JUJU_HOOK_NAME": "world-relation-changed", "JUJU_RELATION_ID": "world:1"}
+    assert dispatch.skip_reason({**env, "JUJU_REMOTE_UNIT": "remote/3"}) is None
+    assert dispatch.skip_reason({**env, "JUJU_REMOTE_UNIT": "remote/4"})
+
+    ctx.run(ctx.on.relation_changed(rel), State(leader=False, relations={rel}))
+    assert dispatch.skip_reason({**env, "JUJU_REMOTE_UNIT": "remote/3"})
+    assert dispatch.skip_reason({**env, "JUJU_HOOK_NAME": "leader-elected"}) is None
+
+
+def test_startup_profile(workdir):
+    """The config option turns the per-hook startup report on."""
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    ctx.run(ctx.on.config_changed(), State(config={"profile-startup": True}))
+    assert dispatch.read_settings(dispatch.RULES)["profile"] is True
+
+    dispatch.profile("imports")
+    dispatch.write_profile({"JUJU_HOOK_NAME": "config-changed"})
+    with open(dispatch.PROFILE) as f:
+        (record,) = map(json.loads, f)
+    assert record["hook"] == "config-changed"
+    assert 0 <= record["imports"] <= record["exit"]
+    assert record["modules"] > 0
+
+    ctx.run(ctx.on.config_changed(), State())
+    assert dispatch.read_settings(dispatch.RULES)["profile"] is False
+
+
+def test_round_completes_incrementally():
+    """Only the reporting worker is re-read, the round advances on the last one."""
+    topology = Topology(tuple(f"remote/{i}" for i in range(9)), 3, 3)
+    workers = {i: {"round": "0", "value": "000111000"[i]} for i in range(9)}
+    rel = Relation(
+        endpoint="world",
+        id=1,
+        local_app_data={"round": "0", "board": "000111000", "topology": topology.dumps()},
+        remote_units_data=workers,
+    )
+    ctx = Context(JGOLCoordinatorCharm, app_name="app", unit_id=0)
+    state = ctx.run(ctx.on.config_changed(), State(leader=True, relations={rel}, config={"run": True}))
+    assert state.app_status == ops.ActiveStatus("0: [000111000] --> 1")
+
+    # Workers move on one by one, each relation-changed reads only that one
+    rel = state.get_relation(1)
+    for i in range(9):
+        workers[i] = {"round": "1", "value": "010010010"[i]}
+        rel = dataclasses.replace(rel, remote_units_data=workers)
+        state = dataclasses.replace(state, relations={rel})
+        state = ctx.run(ctx.on.relation_changed(rel, remote_unit=i), state)
+        rel = state.get_relation(1)
+        if i == 7:
+            assert state.app_status == ops.ActiveStatus("1: [01001001.]")
+    assert rel.local_app_data["round"] == "2"
+    assert state.app_status == ops.ActiveStatus("1: [010010010] --> 2")
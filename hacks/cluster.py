@@ -0,0 +1,362 @@
+"""In-process cluster simulator driving the real charms with ops.testing.
+
+    python hacks/cluster.py peer 400 --generations 3 --jobs 4
+    python hacks/cluster.py cowo 100 --config tile=2 --generations 5
+
+"peer" runs N units of the peer charm on one peer relation, the leader is
+a cell as well. "cowo" runs one coordinator unit and N worker units.
+
+Databag writes are routed the way Juju would: a changed unit databag is a
+relation-changed, with that remote unit, for every unit that can see it,
+a changed app databag is one for every unit on the other side (the other
+peers). Pending events are coalesced per remote unit, as each hook sees the
+latest data anyway, and processed in waves: every unit with pending events
+runs them in one task, against the databags as they were at the start of the
+wave, and the writes are published when the wave is over.
+
+Units run in a process pool, ops.testing isn't thread safe. Each unit has its
+own working directory, where the dispatch rules the charm writes are honoured
+before running a hook, with the simulator's databags standing in for
+`relation-get`. Filtered hooks are counted but cost nothing, as in production.
+
+The board is reset first, with run=false, then run is switched on and
+hooks, skipped hooks, bytes written and wall time are reported per generation,
+and the charms' own count of databag writes they made and suppressed overall.
+With --traces DIR, the charms trace every hook, as with their `trace` option,
+and the traces are saved for `clean/traces.py`. Hooks run in-process, as in
+the resident, so there is no import time.
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import functools
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+RELATION_ID = 1
+ENDPOINT = "world"
+# Scenario adds these to every unit databag
+DEFAULT_KEYS = {"egress-subnets", "ingress-address", "private-address"}
+
+
+@functools.cache
+def load(charm: str, class_name: str) -> type:
+    """The charm class, the module is named after the charm, they're all `charm.py`."""
+    src = REPO / charm / "src"
+    if str(src) not in sys.path:
+        sys.path.append(str(src))
+    spec = importlib.util.spec_from_file_location(f"{charm}_charm", src / "charm.py")
+    assert spec and spec.loader
+    module = sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
+
+
+@dataclasses.dataclass
+class Unit:
+    name: str
+    kind: str  # "peer", "coordinator" or "worker"
+    config: dict
+    leader: bool = False
+    stored: frozenset = frozenset()
+
+    @property
+    def app(self) -> str:
+        return self.name.partition("/")[0]
+
+    @property
+    def id(self) -> int:
+        return int(self.name.partition("/")[2])
+
+
+CLASSES = {
+    "peer": ("peer", "JGOLPeerCharm"),
+    "coordinator": ("coordinator", "JGOLCoordinatorCharm"),
+    "worker": ("worker", "JGOLWorkerCharm"),
+}
+_contexts = {}
+
+
+def context(unit: Unit):
+    from ops.testing import Context
+
+    key = unit.kind, unit.name
+    if key not in _contexts:
+        _contexts[key] = Context(load(*CLASSES[unit.kind]), app_name=unit.app, unit_id=unit.id)
+    return _contexts[key]
+
+
+def relation(unit: Unit, view: dict):
+    """The unit's side of the relation from the databags it can see."""
+    from ops.testing import PeerRelation, Relation
+
+    local_app = view["apps"].get(unit.app, {}) if unit.leader or unit.kind == "peer" else {}
+    others = {
+        int(name.partition("/")[2]): data
+        for name, data in view["units"].items()
+        if name != unit.name
+    }
+    if unit.kind == "peer":
+        return PeerRelation(
+            endpoint=ENDPOINT,
+            id=RELATION_ID,
+            local_app_data=local_app,
+            local_unit_data=view["units"][unit.name],
+            peers_data=others,
+        )
+    return Relation(
+        endpoint=ENDPOINT,
+        id=RELATION_ID,
+        remote_app_name=view["remote_app"],
+        local_app_data=local_app,
+        local_unit_data=view["units"][unit.name],
+        remote_app_data=view["apps"].get(view["remote_app"], {}),
+        remote_units_data=others,
+    )
+
+
+def run_unit(unit: Unit, view: dict, events: list, workdir: str) -> dict:
+    """Run the unit's pending events, in a pool process.
+
+    `view` holds the databags the unit can see, `events` are ("config", None),
+    ("changed", remote unit) or ("app-changed", leader of the remote app).
+    """
+    from ops.testing import State
+
+    ctx = context(unit)  # puts the charm's src on sys.path
+    import dispatch
+
+    os.chdir(workdir)
+    view = json.loads(json.dumps(view))  # private copy to update
+    stats = {"hooks": 0, "skipped": 0, "bytes": 0, "errors": 0}
+    for kind, remote in events:
+        env = {"JUJU_HOOK_NAME": "config-changed", "JUJU_UNIT_NAME": unit.name}
+        traced = dispatch.restart()  # as the resident does
+        if kind != "config":
+            remote_app = remote.partition("/")[0]
+            env = {
+                "JUJU_HOOK_NAME": f"{ENDPOINT}-relation-changed",
+                "JUJU_RELATION_ID": f"{ENDPOINT}:{RELATION_ID}",
+                "JUJU_UNIT_NAME": unit.name,
+                # Juju leaves the remote unit out for app databag changes
+                "JUJU_REMOTE_UNIT": remote if kind == "changed" else "",
+                "JUJU_REMOTE_APP": remote_app,
+            }
+
+            def relation_get(environ, app, remote=remote, remote_app=remote_app):
+                return view["apps"].get(remote_app, {}) if app else view["units"].get(remote)
+
+            if dispatch.skip_reason(env, relation_get=relation_get):
+                stats["skipped"] += 1
+                if traced:
+                    dispatch.profile("skipped")
+                    dispatch.write_trace(env)
+                continue
+
+        rel = relation(unit, view)
+        state = State(
+            leader=unit.leader, relations={rel}, config=unit.config, stored_states=unit.stored
+        )
+        if kind == "config":
+            event = ctx.on.config_changed()
+        else:
+            event = ctx.on.relation_changed(rel, remote_unit=int(remote.partition("/")[2]))
+        try:
+            out = ctx.run(event, state)
+        except Exception:
+            stats["errors"] += 1
+            continue
+        if traced:
+            dispatch.write_trace(env)
+        stats["hooks"] += 1
+        unit.stored = out.stored_states
+        rel = out.get_relation(RELATION_ID)
+        written = {k: v for k, v in rel.local_unit_data.items() if k not in DEFAULT_KEYS}
+        stats["bytes"] += changed_bytes(view["units"][unit.name], written)
+        view["units"][unit.name] = written
+        if unit.leader:
+            app_data = dict(rel.local_app_data)
+            stats["bytes"] += changed_bytes(view["apps"].get(unit.app, {}), app_data)
+            view["apps"][unit.app] = app_data
+    return {
+        "unit": view["units"][unit.name],
+        "app": view["apps"].get(unit.app) if unit.leader else None,
+        "stored": unit.stored,
+        "stats": stats,
+    }
+
+
+def changed_bytes(before: dict, after: dict) -> int:
+    """Bytes a hook sends to the controller for the databag change."""
+    return sum(len(k) + len(v) for k, v in after.items() if before.get(k) != v) + sum(
+        len(k) for k in before.keys() - after.keys()
+    )
+
+
+class Cluster:
+    def __init__(self, mode: str, n: int, config: dict, jobs: int):
+        if mode == "peer":
+            self.units = [Unit(f"jgol/{i}", "peer", dict(config)) for i in range(n)]
+            self.god = self.units[0]
+        else:
+            self.god = Unit("coordinator/0", "coordinator", dict(config))
+            worker = {k: v for k, v in config.items() if k == "trace"}
+            self.units = [self.god] + [
+                Unit(f"jgol/{i}", "worker", dict(worker)) for i in range(n)
+            ]
+        self.god.leader = True
+        self.apps: dict[str, dict] = {}
+        self.data: dict[str, dict] = {u.name: {} for u in self.units}
+        self.pending: dict[str, dict] = {u.name: {("config", None): None} for u in self.units}
+        self.tmp = tempfile.TemporaryDirectory()
+        for u in self.units:
+            os.makedirs(self.workdir(u))
+        self.pool = concurrent.futures.ProcessPoolExecutor(jobs) if jobs > 1 else None
+
+    def workdir(self, unit: Unit) -> str:
+        return os.path.join(self.tmp.name, unit.name.replace("/", "-"))
+
+    def view(self, unit: Unit) -> dict:
+        """Databags visible to the unit: its own app's and the other side's."""
+        if unit.kind == "peer":
+            return {"apps": self.apps, "units": self.data, "remote_app": unit.app}
+        remote_app = "jgol" if unit.kind == "coordinator" else "coordinator"
+        units = {
+            name: data
+            for name, data in self.data.items()
+            if name == unit.name or name.startswith(remote_app + "/")
+        }
+        return {"apps": self.apps, "units": units, "remote_app": remote_app}
+
+    def watchers(self, writer: Unit) -> list[Unit]:
+        """Units that get relation-changed when the writer's databag changes."""
+        if writer.kind == "peer":
+            return [u for u in self.units if u is not writer]
+        return [u for u in self.units if u.app != writer.app]
+
+    def wave(self) -> dict:
+        """Run every unit with pending events once, then publish their writes."""
+        busy = [u for u in self.units if self.pending[u.name]]
+        jobs = [(u, self.view(u), list(self.pending[u.name]), self.workdir(u)) for u in busy]
+        for u in busy:
+            self.pending[u.name] = {}
+        if self.pool:
+            results = list(self.pool.map(run_unit, *zip(*jobs)))
+        else:
+            results = [run_unit(*job) for job in jobs]
+
+        totals = {"hooks": 0, "skipped": 0, "bytes": 0, "errors": 0}
+        for u, result in zip(busy, results):
+            u.stored = result["stored"]
+            for k, v in result["stats"].items():
+                totals[k] += v
+            if result["unit"] != self.data[u.name]:
+                self.data[u.name] = result["unit"]
+                for w in self.watchers(u):
+                    self.pending[w.name][("changed", u.name)] = None
+            if result["app"] is not None and result["app"] != self.apps.get(u.app):
+                self.apps[u.app] = result["app"]
+                for w in self.watchers(u):
+                    self.pending[w.name][("app-changed", u.name)] = None
+        return totals
+
+    def settle(self, limit: int = 1000) -> dict:
+        """Run waves until no events are pending."""
+        totals = {"hooks": 0, "skipped": 0, "bytes": 0, "errors": 0, "waves": 0}
+        while any(self.pending.values()) and totals["waves"] < limit:
+            for k, v in self.wave().items():
+                totals[k] += v
+            totals["waves"] += 1
+        return totals
+
+    def written(self) -> dict[str, int]:
+        """Databag writes the charms made, and suppressed, over all units and hooks."""
+        totals = {"writes": 0, "suppressed": 0, "commits": 0}
+        for u in self.units:
+            path = os.path.join(self.workdir(u), "databag-stats.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    for counts in json.load(f).values():
+                        for k in totals:
+                            totals[k] += counts[k]
+        return totals
+
+    def collect_traces(self, dest: str):
+        """Copy each unit's hook trace to `dest`/<unit>.jsonl."""
+        os.makedirs(dest, exist_ok=True)
+        for u in self.units:
+            path = os.path.join(self.workdir(u), "hook-trace.jsonl")
+            if os.path.exists(path):
+                shutil.copyfile(path, os.path.join(dest, u.name.replace("/", "-") + ".jsonl"))
+
+    def round(self) -> int:
+        return json.loads(self.apps.get(self.god.app, {}).get("round", "0"))
+
+    def configure(self, **options):
+        """Change the god's config, the peer charm reads run on every unit."""
+        for u in self.units:
+            if u.kind in ("peer", "coordinator"):
+                u.config.update(options)
+                self.pending[u.name][("config", None)] = None
+
+    def generations(self, count: int, limit: int = 1000):
+        """Yield stats for each completed generation."""
+        for _ in range(count):
+            start, target = time.perf_counter(), self.round() + 1
+            totals = {"hooks": 0, "skipped": 0, "bytes": 0, "errors": 0, "waves": 0}
+            while self.round() < target and any(self.pending.values()):
+                for k, v in self.wave().items():
+                    totals[k] += v
+                totals["waves"] += 1
+                if totals["waves"] >= limit:
+                    break
+            if self.round() < target:
+                return  # stalled
+            yield {"round": self.round(), **totals, "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", choices=("peer", "cowo"))
+    parser.add_argument("n", type=int, help="number of cell units")
+    parser.add_argument("--generations", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--config", action="append", default=[], help="key=value")
+    parser.add_argument("--traces", help="turn hook tracing on, save the traces here")
+    args = parser.parse_args()
+
+    config = {}
+    for item in args.config:
+        key, _, value = item.partition("=")
+        config[key] = json.loads(value) if value[:1].isdigit() or value in ("true", "false") else value
+    if args.traces:
+        config["trace"] = True
+
+    cluster = Cluster(args.mode, args.n, {**config, "run": False}, args.jobs)
+    t0 = time.perf_counter()
+    reset = cluster.settle()
+    print(f"reset: {reset['hooks']} hooks, {reset['skipped']} skipped,"
+          f" {reset['waves']} waves, {time.perf_counter() - t0:.1f}s")
+    cluster.configure(run=True)
+    for g in cluster.generations(args.generations):
+        print(
+            f"generation {g['round']}: {g['hooks']} hooks, {g['skipped']} skipped,"
+            f" {g['bytes']} bytes, {g['waves']} waves, {g['errors']} errors,"
+            f" {g['seconds']:.2f}s"
+        )
+    w = cluster.written()
+    print(f"databag writes: {w['writes']}, {w['suppressed']} suppressed, {w['commits']} commits")
+    if args.traces:
+        cluster.collect_traces(args.traces)
+
+
+if __name__ == "__main__":
+    main()
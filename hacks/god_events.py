@@ -0,0 +1,115 @@
+"""Per-event cost of the coordinator as the board grows.
+
+    python hacks/god_events.py [N ...] [--events 20]
+
+For each board of N workers, the coordinator first rescans the board on
+config-changed, then gets a relation-changed from a number of workers in turn,
+each reporting the current round. Reported per event kind: the unit databags
+read (`relation-get` calls for worker units) and the time spent in the charm's
+`god` handler, the median over the events.
+
+A rescan reads every worker, a report only the worker that sent it, so the
+report reads stay flat as N grows. What a report still does per cell is
+parsing the topology and joining the board string, a millisecond or so at
+N=1024. The ops.testing harness itself builds the N unit relation for every
+event, that is not included.
+"""
+
+import argparse
+import dataclasses
+import functools
+import math
+import statistics
+import time
+
+import cluster
+
+SIZES = (16, 64, 256, 1024)
+
+
+def measure(n: int, events: int) -> dict[str, tuple[float, float]]:
+    """(databags read, seconds in `god`) per event kind, medians."""
+    import ops
+    from ops.testing import Relation, State
+    from scenario.mocking import _MockModelBackend
+
+    unit = cluster.Unit("coordinator/0", "coordinator", {"run": True}, leader=True)
+    ctx = cluster.context(unit)
+    charm = cluster.load(*cluster.CLASSES["coordinator"])
+    from topology import Topology
+
+    side = math.isqrt(n)
+    topology = Topology(tuple(f"jgol/{i}" for i in range(side * side)), side, side)
+    workers = {i: {"round": "0", "value": "0"} for i in range(side * side)}
+    rel = Relation(
+        endpoint=cluster.ENDPOINT,
+        id=cluster.RELATION_ID,
+        remote_app_name="jgol",
+        local_app_data={"round": "1", "board": "0" * n, "topology": topology.dumps()},
+        remote_units_data=workers,
+    )
+    state = State(leader=True, relations={rel}, config=unit.config)
+
+    reads = [0]
+    spent = [0.0]
+    relation_get = _MockModelBackend.relation_get
+    god = charm.god
+
+    def counting_get(self, relation_id, member_name, is_app, **kwargs):
+        reads[0] += member_name.startswith("jgol/")
+        return relation_get(self, relation_id, member_name, is_app, **kwargs)
+
+    @functools.wraps(god)  # ops looks handlers up by name
+    def timed_god(self, event):
+        t0 = time.perf_counter()
+        try:
+            return god(self, event)
+        finally:
+            spent[0] += time.perf_counter() - t0
+
+    def run(event, state):
+        reads[0], spent[0] = 0, 0.0
+        state = ctx.run(event, state)
+        return state, (reads[0], spent[0])
+
+    _MockModelBackend.relation_get = counting_get
+    charm.god = timed_god
+    try:
+        state, rescan = run(ctx.on.config_changed(), state)
+        reports = []
+        for i in range(min(events, len(workers))):
+            workers[i] = {"round": "1", "value": "1"}
+            rel = dataclasses.replace(state.get_relation(cluster.RELATION_ID), remote_units_data=workers)
+            state = dataclasses.replace(state, relations={rel})
+            state, cost = run(ctx.on.relation_changed(rel, remote_unit=i), state)
+            reports.append(cost)
+        assert isinstance(state.app_status, ops.ActiveStatus), state.app_status
+    finally:
+        _MockModelBackend.relation_get = relation_get
+        charm.god = god
+    return {
+        "rescan": rescan,
+        "report": (
+            statistics.median(r for r, _ in reports),
+            statistics.median(s for _, s in reports),
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sizes", nargs="*", type=int, default=SIZES)
+    parser.add_argument("--events", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'n':>5} {'rescan reads':>12} {'rescan ms':>9} {'report reads':>12} {'report ms':>9}")
+    for n in args.sizes:
+        r = measure(n, args.events)
+        print(
+            f"{n:5} {r['rescan'][0]:12.0f} {r['rescan'][1] * 1000:9.2f}"
+            f" {r['report'][0]:12.0f} {r['report'][1] * 1000:9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Cold start latency of the charms, before and after a change.
+
+    python hacks/startup.py [--before REV] [--after REV] [-n 20] [--json out.json]
+
+Each revision's `<charm>/src` is exported with `git archive`, the working tree
+is used when no --after is given. The charm module is imported in a fresh
+interpreter with the environment of a steady state round hook, `ops.main`
+itself needs a Juju agent and is not run:
+
+* "relevant": world-relation-changed that the unit has to handle
+* "filtered": the same hook from a remote unit the dispatch rules exclude,
+  e.g. an unused cell on the coordinator, the bulk of hooks on large boards
+
+Revisions without the dispatch filter import everything in both cases.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+CHARMS = ("coordinator", "worker", "peer")
+REPO = Path(__file__).resolve().parent.parent
+ENV = {
+    "JUJU_HOOK_NAME": "world-relation-changed",
+    "JUJU_RELATION_ID": "world:1",
+    "JUJU_UNIT_NAME": "app/0",
+    "JUJU_REMOTE_UNIT": "remote/7",
+    "JUJU_REMOTE_APP": "remote",
+}
+RULES = {"rules": [{"hooks": ["world-relation-changed"], "remote_units": ["remote/1"]}]}
+
+
+def export(rev: str | None, charm: str, dest: Path) -> Path:
+    """Source directory of the charm at the revision, None for the working tree."""
+    if rev is None:
+        return REPO / charm / "src"
+    archive = subprocess.run(
+        ["git", "archive", rev, f"{charm}/src"], cwd=REPO, check=True, capture_output=True
+    ).stdout
+    target = dest / rev / charm
+    target.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryFile() as f:
+        f.write(archive)
+        f.seek(0)
+        with tarfile.open(fileobj=f) as tar:
+            tar.extractall(target, filter="data")
+    return target / charm / "src"
+
+
+def cold_start(src: Path, cwd: Path, runs: int) -> list[float]:
+    """Wall clock seconds to import the charm module in a new interpreter."""
+    env = {**os.environ, **ENV, "PYTHONPATH": str(src)}
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import charm"], cwd=cwd, env=env, check=True)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    root = subprocess.run(
+        ["git", "rev-list", "--max-parents=0", "HEAD"],
+        cwd=REPO,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()[0]
+    parser.add_argument("--before", default=root, help="git revision, default: first commit")
+    parser.add_argument("--after", default=None, help="git revision, default: working tree")
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument("--json", type=Path, help="write the results here as well")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for charm in CHARMS:
+            for label, rev in (("before", args.before), ("after", args.after)):
+                src = export(rev, charm, tmp / "src")
+                for scenario in ("relevant", "filtered"):
+                    cwd = tmp / "run" / label / charm / scenario
+                    cwd.mkdir(parents=True)
+                    if scenario == "filtered":
+                        (cwd / "dispatch-rules.json").write_text(json.dumps(RULES))
+                    times = cold_start(src, cwd, args.runs)
+                    results.append(
+                        {
+                            "charm": charm,
+                            "revision": rev or "working tree",
+                            "label": label,
+                            "scenario": scenario,
+                            "median": statistics.median(times),
+                            "min": min(times),
+                            "runs": len(times),
+                        }
+                    )
+                    r = results[-1]
+                    print(
+                        f"{charm:12} {label:7} {scenario:9}"
+                        f" median {r['median'] * 1000:7.1f} ms"
+                        f"  min {r['min'] * 1000:7.1f} ms"
+                    )
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
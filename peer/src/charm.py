@@ -2,32 +2,57 @@
 # Copyright 2025 dima.tisnek@canonical.com
 # See LICENSE file for licensing details.
 """Juju's Game of Life."""
-import os  # noqa
-if os.environ.get("JUJU_HOOK_NAME") == "world-relation-changed":
-    if os.path.exists("leader.txt") and os.path.exists("neighbours.txt"):
-        leader = open("leader.txt").read()
-        neighbours = set(open("neighbours.txt").read().split())
-        if os.environ.get("JUJU_UNIT_NAME") != leader:
-            if os.environ.get("JUJU_REMOTE_UNIT") not in (neighbours | {leader}):
-                raise SystemExit(0)
 
+# The dispatch filter and the resident hand-off run before the other imports,
+# ops alone takes longer to import than a skipped or served hook needs.
+# ruff: noqa: E402
+import dispatch
+
+dispatch.exit_if_irrelevant()
+import resident
+
+resident.exit_if_served()
+
+import hashlib
 import json
 import logging
-from pathlib import Path
-from typing import cast
+from collections.abc import Mapping
+from typing import Any, cast
 
 import ops
 
+import cycles
+import databag
+from topology import Topology
+
+dispatch.profile("imports")
+
 INIT = "0001110001010101111110001110010101010101001010101000111101010111" * 99
 
 
 class JGOLPeerCharm(ops.CharmBase):
     """Juju's Game of Life."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
+        resident.ensure(bool(self.config.get("resident")))
+        dispatch.set_profiling(bool(self.config.get("profile-startup")))
+        dispatch.set_tracing(bool(self.config.get("trace")))
+        self.read = databag.Reader()
+        self._stored.set_default(topology="", own_index=-1, neighbours=[], neighbour_indices=[])
+        # Leader's view of the cells' progress, see `board_state`
+        self._stored.set_default(cells="", latest={}, values={}, counts={})
+        # Recent board hashes, see `cycles`
+        self._stored.set_default(history={})
+        # The board of the current round, see `still`
+        self._stored.set_default(board="")
+        self._changed_unit: str | None = None
+        framework.observe(self.on["world"].relation_changed, self.changed)
         framework.observe(self.on.collect_unit_status, self.cell)
         framework.observe(self.on.collect_app_status, self.god)
+        dispatch.profile("init")
 
     def cell(self, _event: ops.EventBase):
         """Update this cell based on neighbours.
@@ -42,53 +67,160 @@ class JGOLPeerCharm(ops.CharmBase):
         * delete any outdated rounds
         * keep current round as is
         * post next round when all inputs are ready
+
+        With `async-window` set, cells don't wait for the leader, see `wavefront`.
+        Cells outside the leader's `active` mask sit the round out.
+        The rounds are tagged with the cell's position, `at`, a cell that
+        moved on the grid has no values for its new one until a reset.
         """
         try:
             world = self.model.get_relation("world")
             assert world, "waiting for peer relation"
-            run: bool = json.loads(world.data[self.app]["run"])
-            round_: int = json.loads(world.data[self.app]["round"])
-            neighbours: dict[str, list[str]] = json.loads(world.data[self.app]["map"])
-            init = INIT[: len(neighbours)]
-            if self.unit.name not in neighbours:
+            app_data = self.read(world, self.app)
+            run: bool = json.loads(app_data["run"])
+            round_: int = json.loads(app_data["round"])
+            dispatch.annotate(round=round_)
+            location = self.locate(app_data)
+            if location is None:
                 self.unit.status = ops.ActiveStatus("unused")
                 return
-            Path("leader.txt").write_text(world.data[self.app]["leader"])
-            Path("neighbours.txt").write_text(" ".join(neighbours[self.unit.name]))
-            own_index = list(neighbours).index(self.unit.name)
-            init_live = int(init[own_index])
+            own_index, neighbours = location
+            leader = app_data["leader"]
+            # Followers only care about their neighbours and the leader,
+            # app data changes have no remote unit, and with the activity mask
+            # the round can move on without the leader writing its own data
+            interesting = [*neighbours, leader]
+            if self.config.get("activity-mask"):
+                interesting.append("")
+            dispatch.write_rules(
+                [
+                    {
+                        "hooks": ["world-relation-changed"],
+                        "relation_ids": [world.id],
+                        "unless_unit": leader,
+                        "remote_units": interesting,
+                    }
+                ]
+            )
+            init_live = int(INIT[own_index])
 
+            data = databag.Batch(self.read(world, self.unit))
             if not run:
-                for k in list(world.data[self.unit]):
-                    del world.data[self.unit][k]
-                world.data[self.unit][str(round_)] = json.dumps(init_live)
+                for k in list(data):
+                    del data[k]
+                data[str(round_)] = json.dumps(init_live)
+                data["at"] = json.dumps(own_index)
+                data.commit()
                 self.unit.status = ops.ActiveStatus()
                 return
+            if not placed(data, own_index):
+                # Our rounds were stepped elsewhere, they'd land on the wrong cell
+                self.unit.status = ops.WaitingStatus("moved, waiting for a reset")
+                return
+            data["at"] = json.dumps(own_index)
 
-            live = json.loads(world.data[self.unit][str(round_)])
-            neighbours_alive = sum(
-                json.loads(world.data[self.model.get_unit(n)][str(round_)])
-                for n in neighbours[self.unit.name]
-            )
-            if live and neighbours_alive in (2, 3):
-                next_live = 1
-            elif live:
-                next_live = 0
-            elif neighbours_alive == 3:
-                next_live = 1
-            else:
-                next_live = 0
-            next_round = round_ + 1
-            world.data[self.unit][str(next_round)] = json.dumps(next_live)
-            # clean up stale rounds
-            for k in list(world.data[self.unit]):
-                if k.isdigit() and int(k) not in (round_, next_round):
-                    del world.data[self.unit][k]
+            if window := self.window():
+                latest = self.wavefront(world, data, neighbours, round_, window)
+                dispatch.annotate(round=latest)
+                data.commit()
+                self.unit.status = ops.ActiveStatus(f"{latest}")
+                return
+
+            if not active(app_data, own_index):
+                # Nothing changed within reach, the value stands for this round too
+                self.unit.status = ops.ActiveStatus("still")
+                return
+            self.step(world, data, neighbours, round_)
+            data.commit()
 
             self.unit.status = ops.ActiveStatus()
         except Exception as e:
             self.unit.status = ops.WaitingStatus(repr(e))
 
+    def step(
+        self, world: ops.Relation, data: databag.Batch, neighbours: dict[str, int], round_: int
+    ):
+        """Post the next round, keep this one and drop the older ones."""
+        live = json.loads(value(data, round_))
+        # Neighbours read this round from us, even if we sat still until now
+        data[str(round_)] = json.dumps(live)
+        neighbours_alive = sum(
+            json.loads(value(d, round_)) for d in self.inputs(world, neighbours)
+        )
+        next_live = int(gol_step(bool(live), neighbours_alive))
+        next_round = round_ + 1
+        data[str(next_round)] = json.dumps(next_live)
+        # clean up stale rounds
+        for k in list(data):
+            if k.isdigit() and int(k) not in (round_, next_round):
+                del data[k]
+
+    def wavefront(
+        self,
+        world: ops.Relation,
+        data: databag.Batch,
+        neighbours: dict[str, int],
+        floor: int,
+        window: int,
+    ) -> int:
+        """Step as far as the neighbours allow, returns the latest round posted.
+
+        Round r+1 needs the neighbours' round r, so a cell is never more than
+        one round ahead of its neighbours, and slow units only hold up the
+        cells around them. `floor` is the round the leader last reported,
+        the newest one every cell has reached: cells keep their rounds from
+        there on, for lagging neighbours and for the leader's board, and
+        don't go more than `window` rounds past it.
+        """
+        latest = max(int(k) for k in data if k.isdigit())
+        inputs = self.inputs(world, neighbours)
+        while latest < floor + window:
+            try:
+                neighbours_alive = sum(json.loads(d[str(latest)]) for d in inputs)
+            except KeyError:
+                break  # a neighbour is behind
+            live = json.loads(data[str(latest)])
+            latest += 1
+            data[str(latest)] = json.dumps(int(gol_step(bool(live), neighbours_alive)))
+        for k in list(data):
+            if k.isdigit() and int(k) < floor:
+                del data[k]
+        return latest
+
+    def locate(self, app_data: ops.RelationDataContent) -> tuple[int, dict[str, int]] | None:
+        """Find own position and the neighbours' names and positions, None if unused.
+
+        Kept in unit-local state until the topology changes, so that steady
+        state hooks don't parse the topology.
+        """
+        raw = app_data["topology"]
+        digest = hashlib.sha256(raw.encode()).hexdigest()
+        if self._stored.topology != digest:
+            topology = Topology.loads(raw)
+            own_index = topology.index(self.unit.name)
+            indices = [] if own_index is None else topology.neighbour_indices(own_index)
+            neighbours = {topology.cells[i]: i for i in indices}
+            self._stored.own_index = -1 if own_index is None else own_index
+            self._stored.neighbours = sorted(neighbours)
+            self._stored.neighbour_indices = [neighbours[n] for n in sorted(neighbours)]
+            self._stored.topology = digest
+        if self._stored.own_index < 0:
+            return None
+        return self._stored.own_index, dict(
+            zip(self._stored.neighbours, self._stored.neighbour_indices)
+        )
+
+    def inputs(self, world: ops.Relation, neighbours: dict[str, int]) -> list[Mapping[str, str]]:
+        """Return the neighbours' data, empty for one whose rounds were stepped elsewhere."""
+        return [
+            data if placed(data := self.read(world, self.model.get_unit(n)), index) else {}
+            for n, index in neighbours.items()
+        ]
+
+    def changed(self, event: ops.RelationChangedEvent):
+        """Note which unit's data changed, the leader only re-reads that one."""
+        self._changed_unit = event.unit.name if event.unit else None
+
     def god(self, _event: ops.EventBase):
         """Play God with the cells."""
         if not self.unit.is_leader():
@@ -99,20 +231,34 @@ class JGOLPeerCharm(ops.CharmBase):
             assert world, "Waiting for peer relation to come up"
             run = bool(cast(bool | None, self.config.get("run")))
 
-            cells = sorted({unit.name for unit in world.units} | {self.unit.name})
-            neighbours = neighbourhood(cells)
-            assert len(neighbours) <= len(INIT), "Initial map is too small"
-            cells = cells[: len(neighbours)]
+            app_data = databag.Batch(self.read(world, self.app))
+            previous = app_data.get("topology")
+            units = [unit.name for unit in world.units] + [self.unit.name]
+            topology = Topology.grid(units, **self.layout()).successor(
+                Topology.loads(previous) if previous else None, units
+            )
+            if unused := topology.unused(units):
+                logging.warning("Units don't fit the board: %s", " ".join(unused))
+            assert len(topology.cells) <= len(INIT), "Initial map is too small"
+            cells = list(topology.cells)
 
-            curr_round = json.loads(world.data[self.app].get("round", "0"))
-            board, next_round = self.board_state(world, cells)
+            curr_round = json.loads(app_data.get("round", "0"))
+            board, next_round = self.board_state(world, cells, curr_round)
 
-            world.data[self.app]["run"] = json.dumps(run)
-            world.data[self.app]["map"] = json.dumps(neighbours)
-            world.data[self.app]["leader"] = self.unit.name
+            app_data["run"] = json.dumps(run)
+            if (descriptor := topology.dumps()) != previous:
+                app_data["topology"] = descriptor
+                logging.warning(
+                    "Topology version %d: %dx%d board",
+                    topology.version,
+                    topology.width,
+                    topology.height,
+                )
+            app_data["leader"] = self.unit.name
             if not run:
                 # Reset the board
-                world.data[self.app]["round"] = json.dumps(0)
+                app_data["round"] = json.dumps(0)
+                app_data.pop("active", None)
                 if next_round == 0:
                     self.app.status = ops.ActiveStatus(msg := f"Reset [{board}]")
                     logging.warning(msg)
@@ -122,79 +268,261 @@ class JGOLPeerCharm(ops.CharmBase):
                     self.app.status = ops.WaitingStatus(msg := f"Resetting... [{board}]")
                     logging.warning(msg)
                     # FIXME we could compare the map to initial...
-            elif next_round is not None:
-                # All units completed this step, kick off the next round
-                world.data[self.app]["round"] = json.dumps(next_round)
-                self.app.status = ops.ActiveStatus(
-                    msg := f"{curr_round}: [{board}] --> {next_round}"
-                )
+            elif self.window():
+                # Cells step on their own, report the newest board all of them reached
+                app_data.pop("active", None)
+                rounds = [int(r) for r in self._stored.counts]
+                # A cell without rounds for its position, new or moved, holds it up
+                reached = len(self._stored.latest) == len(cells)
+                if rounds and reached and (lowest := min(rounds)) > curr_round:
+                    board = "".join(
+                        self.read(world, self.model.get_unit(cell))[str(lowest)] for cell in cells
+                    )
+                    app_data["round"] = json.dumps(lowest)
+                    self.app.status = ops.ActiveStatus(
+                        msg := f"{curr_round}: [{board}] --> {lowest}"
+                    )
+                else:
+                    self.app.status = ops.ActiveStatus(
+                        msg := f"{curr_round}: [{board}] up to {max(rounds, default=0)}"
+                    )
                 logging.warning(msg)
+            elif next_round is not None:
+                # All units completed this step
+                self.complete(app_data, topology, board, curr_round, next_round)
             else:
                 # Still waiting for some units
                 self.app.status = ops.ActiveStatus(msg := f"{curr_round}: [{board}]")
                 logging.warning(msg)
+            app_data.commit()
         except Exception as e:
             self.app.status = ops.BlockedStatus(repr(e))
 
+    def complete(
+        self,
+        app_data: databag.Batch,
+        topology: Topology,
+        board: str,
+        curr_round: int,
+        next_round: int,
+    ):
+        """Kick off the next round, unless the board cycles and `on-cycle` says halt.
+
+        A board that stays the same under `activity-mask` halts too.
+        """
+        period = self.cycle(topology, board, curr_round, next_round)
+        idle = self.idle(board, curr_round, next_round)
+        if idle or (period and self.on_cycle() == "halt"):
+            # Nothing new will come of it, the cells wait for the next round
+            self.app.status = ops.ActiveStatus(
+                msg := f"{curr_round}: [{board}] {cycles.describe(1 if idle else period)}, halted"
+            )
+            logging.warning(msg)
+            return
+        note = f", {cycles.describe(period)}" if period else ""
+        if period and self.on_cycle() == "skip":
+            limit = int(cast(int, self.config.get("cycle-skip", 1000)))
+            if skip := cycles.jump(period, limit):
+                # The cells' values for this round stand for the target too
+                next_round += skip
+                cycles.shift(self._stored.history, skip)
+                note += f", skipped {skip}"
+        if next_round > curr_round and (
+            still := self.still(app_data, topology, board, curr_round, next_round)
+        ):
+            note += f", {len(topology.cells) - still} active"
+        app_data["round"] = json.dumps(next_round)
+        self.app.status = ops.ActiveStatus(
+            msg := f"{curr_round}: [{board}] --> {next_round}{note}"
+        )
+        logging.warning(msg)
+
+    def cycle(self, topology: Topology, board: str, curr_round: int, round_: int) -> int:
+        """Record the round's board, return the period it repeats with or 0.
+
+        Always 0 with `cycle-history` unset, periods longer than it go unnoticed.
+        A "completed" current round, before any cell stepped, isn't a new board.
+        """
+        size = int(cast(int, self.config.get("cycle-history", 0)))
+        if size <= 0 or round_ <= curr_round:
+            return 0
+        return cycles.History(self._stored.history, size, topology.digest).add(round_, board)
+
+    def on_cycle(self) -> str:
+        """Return what to do about a board that cycles: report, halt or skip."""
+        action = str(self.config.get("on-cycle", "report"))
+        if action not in ("report", "halt", "skip"):
+            raise ValueError(f"Unknown on-cycle action: {action}")
+        return action
+
+    def idle(self, board: str, curr_round: int, next_round: int) -> bool:
+        """Whether no cell would step on to `board`, a still life under `activity-mask`.
+
+        With every cell outside the mask none would post, the round would never end.
+        """
+        key = f"{self._stored.cells}:{curr_round}:"
+        return (
+            bool(self.config.get("activity-mask"))
+            and next_round > curr_round
+            and self._stored.board == key + board
+        )
+
+    def still(
+        self,
+        app_data: databag.Batch,
+        topology: Topology,
+        board: str,
+        curr_round: int,
+        next_round: int,
+    ) -> int:
+        """Publish the `active` mask for the next round, return how many sit it out.
+
+        A cell whose neighbourhood didn't change from the current round's
+        board to this one would compute the value it has, so it doesn't,
+        the value stays. Without `activity-mask`, or the current round's
+        board, every cell is active.
+        """
+        key = f"{self._stored.cells}:{curr_round}:"
+        previous = self._stored.board
+        self._stored.board = f"{self._stored.cells}:{next_round}:{board}"
+        if not self.config.get("activity-mask") or not previous.startswith(key):
+            app_data.pop("active", None)
+            return 0
+        previous = previous.removeprefix(key)
+        changed = [i for i, (a, b) in enumerate(zip(previous, board)) if a != b]
+        active = topology.active(changed)
+        if len(active) == len(topology.cells):
+            app_data.pop("active", None)
+            return 0
+        app_data["active"] = "".join("1" if i in active else "0" for i in range(len(board)))
+        return len(board) - len(active)
+
+    def window(self) -> int:
+        """Return how many rounds cells may run ahead of the last board, 0 for lock-step."""
+        return int(cast(int, self.config.get("async-window", 0)))
+
+    def layout(self) -> dict[str, Any]:
+        """Board layout and neighbourhood options from charm config."""
+        return {
+            "width": int(cast(int, self.config.get("width", 0))),
+            "height": int(cast(int, self.config.get("height", 0))),
+            "layout": str(self.config.get("layout", "square")),
+            "wrap": bool(self.config.get("wrap", False)),
+            "shape": str(self.config.get("neighbourhood", "moore")),
+            "radius": int(cast(int, self.config.get("radius", 1))),
+        }
+
     def board_state(
-        self, world: ops.Relation, cells: list[str]
+        self, world: ops.Relation, cells: list[str], curr_round: int
     ) -> tuple[str, int | None]:
         """Determine if all units have completed the current round.
 
         Returns current map, e.g. "...00..101...." and the target round.
+
+        Each cell's latest round and its value there are kept in unit-local
+        state, with the number of cells at each round. A relation-changed hook
+        re-reads only the remote unit and the leader itself, other hooks and
+        topology changes rescan every cell.
+
+        Cells outside the `active` mask are done with their latest value, with
+        none active the round is complete as it is. Cells behind the current
+        round, that haven't taken up a skip yet, don't complete a round.
+        Rounds a cell stepped at another position are none of its own.
         """
-        active_rounds = set()
-        board = ""
-        for cell in cells:
-            try:
-                data = world.data[self.model.get_unit(cell)]
-                rounds = [int(k) for k in data if k.isdigit()]
-                if rounds:
-                    active_rounds.add(max(int(k) for k in data if k.isdigit()))
-            except Exception as e:
-                raise ValueError(f"{cell}: {e}")
-
-        if not active_rounds:
+        digest = hashlib.sha256(" ".join(cells).encode()).hexdigest()
+        if self._stored.cells != digest or self._changed_unit is None:
+            latest: dict[str, int] = {}
+            values: dict[str, str] = {}
+            for index, cell in enumerate(cells):
+                self.track(world, cell, index, latest, values)
+            counts: dict[str, int] = {}
+            for round_ in latest.values():
+                counts[str(round_)] = counts.get(str(round_), 0) + 1
+            self._stored.cells = digest
+            self._stored.latest = latest
+            self._stored.values = values
+            self._stored.counts = counts
+        else:
+            latest = self._stored.latest
+            values = self._stored.values
+            counts = self._stored.counts
+            for cell in {self._changed_unit, self.unit.name} & set(cells):
+                if (old := latest.get(cell)) is not None:
+                    if counts[str(old)] == 1:
+                        del counts[str(old)]
+                    else:
+                        counts[str(old)] -= 1
+                self.track(world, cell, cells.index(cell), latest, values)
+                if (new := latest.get(cell)) is not None:
+                    counts[str(new)] = counts.get(str(new), 0) + 1
+
+        if not counts:
             return "." * len(cells), None
 
-        # FIXME imprecise, may happen to be current round if no unit computed yet
-        next_round = max(active_rounds)
-        for cell in cells:
-            v = world.data[self.model.get_unit(cell)].get(str(next_round))
-            # v could be "1", "0" or missing
-            board += v or "."
-
-        completed = len(active_rounds) == 1
-        return board, max(active_rounds) if completed else None
-
-
-def neighbourhood(cells: list[str]) -> dict[str, list[str]]:
-    """Compute the map of neighbours {unit/1: [unit/3, unit/4, ...], ...}."""
-    # Square N x N map
-    N = int(len(cells) ** 0.5)  # noqa: N806
-    cells = cells[: N * N]
-
-    rv: dict[int, set[int]] = {i: set() for i in range(len(cells))}
-    for index in range(len(cells)):
-        mey, mex = divmod(index, N)
-        # FIXME this can be more elegant if I used slices
-        for y in (-1, 0, 1):
-            for x in (-1, 0, 1):
-                ny = mey + y
-                nx = mex + x
-                if ny < 0 or ny >= N:
-                    continue
-                if nx < 0 or nx >= N:
-                    continue
-                if (ny, nx) == (mey, mex):
-                    continue
-                neighbour = ny * N + nx
-                rv[index].add(neighbour)
-
-    return {cells[k]: sorted(cells[vv] for vv in v) for k, v in rv.items()}
+        mask = self.read(world, self.app).get("active", "")
+        if still := {cell for cell, a in zip(cells, mask) if a == "0"}:
+            next_round = curr_round + 1
+            completed = all(
+                latest.get(cell) == next_round for cell in cells if cell not in still
+            )
+        else:
+            # FIXME imprecise, may happen to be current round if no unit computed yet
+            next_round = max(int(r) for r in counts)
+            completed = len(counts) == 1 and next_round >= curr_round
+        board = "".join(
+            values.get(cell, ".") if latest.get(cell) == next_round or cell in still else "."
+            for cell in cells
+        )
+        return board, next_round if completed else None
+
+    def track(self, world: ops.Relation, cell: str, index: int, latest, values):
+        """Record the cell's latest round and its value, forget cells without any.
+
+        Rounds stepped at another position than `index` don't count.
+        """
+        try:
+            data = self.read(world, self.model.get_unit(cell))
+            rounds = [int(k) for k in data if k.isdigit()]
+        except Exception as e:
+            raise ValueError(f"{cell}: {e}")
+        if rounds and placed(data, index):
+            latest[cell] = max(rounds)
+            values[cell] = data[str(latest[cell])]
+        else:
+            latest.pop(cell, None)
+            values.pop(cell, None)
+
+
+def active(app_data: ops.RelationDataContent, index: int) -> bool:
+    """Whether the cell steps this round, all do without a mask."""
+    mask = app_data.get("active")
+    return not mask or mask[index] == "1"
+
+
+def placed(data: Mapping[str, str], index: int) -> bool:
+    """Whether the cell's rounds were stepped at the position, untagged ones count."""
+    return json.loads(data.get("at", "null")) in (None, index)
+
+
+def value(data: Mapping[str, str], round_: int) -> str:
+    """Return a cell's value for the round, its latest before if it sat still or skipped."""
+    if str(round_) in data:
+        return data[str(round_)]
+    return data[str(max(int(k) for k in data if k.isdigit() and int(k) <= round_))]
+
+
+def gol_step(live: bool, neighbours_alive: int) -> bool:
+    if live and neighbours_alive in (2, 3):
+        return True
+    elif live:
+        return False
+    elif neighbours_alive == 3:
+        return True
+    else:
+        return False
 
 
 if __name__ == "__main__":
     # needs an extra handler to spit info out
     # logging.basicConfig(level="INFO")
-    ops.main(JGOLPeerCharm)  # type: ignore
+    resident.main(lambda: ops.main(JGOLPeerCharm))  # type: ignore
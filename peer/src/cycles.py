@@ -0,0 +1,69 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Still life and oscillator detection from recent board hashes.
+
+This module is shared between the coordinator and peer charms,
+keep the copies identical.
+
+The history lives in the charm's stored state as a plain dict: a ring of
+the last `size` board hashes, oldest first, the round of the newest one,
+and an index from hash to the last round it was seen in. A board that is
+in the index came up `period` rounds ago; Life is deterministic, so from
+then on the board cycles with that period, a still life has period 1.
+"""
+
+from collections.abc import MutableMapping
+
+import dispatch
+
+
+class History:
+    """View of the stored history, changes go straight to `state`."""
+
+    def __init__(self, state: MutableMapping, size: int, key: str):
+        """`key` identifies the board geometry, another one starts over."""
+        self.state = state
+        self.size = size
+        if state.get("key") != key:
+            self.clear(key)
+
+    def clear(self, key: str):
+        """Start over for the board geometry `key`."""
+        self.state.update(key=key, last=-1, ring=[], index={}, period=0)
+
+    def add(self, round_: int, board: str) -> int:
+        """Record the board of the round, the cycle period if it's been seen, or 0."""
+        state = self.state
+        if round_ == state["last"]:
+            return state["period"]  # the same round again, e.g. while halted
+        if round_ != state["last"] + 1:
+            # Fast-forward, reset or a gap, the old rounds don't lead here
+            self.clear(state["key"])
+        digest = dispatch.digest(board)
+        ring, index = state["ring"], state["index"]
+        period = round_ - index[digest] if digest in index else 0
+        ring.append(digest)
+        index[digest] = round_
+        while len(ring) > self.size:
+            oldest = ring.pop(0)
+            if index.get(oldest) == round_ - len(ring):
+                del index[oldest]
+        state["last"] = round_
+        state["period"] = period
+        return period
+
+
+def shift(state: MutableMapping, generations: int):
+    """Move the history `generations` rounds on, the board cycles."""
+    state["last"] += generations
+    state["index"] = {k: v + generations for k, v in state["index"].items()}
+
+
+def describe(period: int) -> str:
+    """Name the cycle for the status line."""
+    return "still life" if period == 1 else f"period {period}"
+
+
+def jump(period: int, limit: int) -> int:
+    """Return the generations to skip, whole periods only so that the board stays the same."""
+    return period * (limit // period)
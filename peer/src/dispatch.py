@@ -0,0 +1,325 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Early-exit dispatch filter, runs before `ops` is imported.
+
+This module is shared between the charms, keep the copies identical.
+Stick to the standard library, and the cheap parts of it.
+
+The charm describes which hooks it doesn't care about in `dispatch-rules.json`:
+
+    {"rules": [
+        {
+            "hooks": ["world-relation-changed"],  # required
+            "relation_ids": [7],                  # optional, any if missing
+            "unless_unit": "app/0",               # never skip on this unit
+            "remote_units": ["app/1", "app/3"],   # skip others
+            "remote_apps": ["coordinator"],       # skip others
+            "unchanged": {                        # skip if all values are the same
+                "app": true,
+                "values": {"round": "7", "topology": "sha256:..."}
+            }
+        }
+    ]}
+
+A hook is skipped if any matching rule says so.
+Skips are counted per hook in `dispatch-stats.json`.
+
+With `"profile": true` in the same file, each dispatch appends a line to
+`startup-profile.jsonl` with the seconds it took to reach each stage:
+
+    {"hook": "world-relation-changed", "time": 1760000000.0,
+     "interpreter": 0.02, "dispatch": 0.001, "imports": 0.25, "init": 0.26,
+     "exit": 0.31, "modules": 412}
+
+"interpreter" is the (approximate, clock tick resolution) time from process
+start until this module was imported, the other stages count from there.
+The charm marks its stages with `profile()`. Hooks run by the resident
+process are profiled as a whole, in the dispatch that hands them off.
+
+With `"trace": true`, every hook appends a record to `hook-trace.jsonl`,
+skipped ones included:
+
+    {"hook": "world-relation-changed", "unit": "jgol/3", "remote_unit": "jgol/2",
+     "time": 1760000000.0, "import": 0.25, "load": 0.01, "handler": 0.05,
+     "total": 0.31, "read": 812, "written": 20, "useful": true,
+     "skipped": false, "round": 42}
+
+"load" is `ops` loading the model plus the charm's `__init__`, "read" and
+"written" are relation data bytes the charm reported with `traffic()`,
+a hook is useful if it wrote any. Charms add fields such as the round
+with `annotate()`. Hooks run by the resident process are traced there.
+"""
+
+import json
+import os
+import time
+
+RULES = "dispatch-rules.json"
+STATS = "dispatch-stats.json"
+PROFILE = "startup-profile.jsonl"
+TRACE = "hook-trace.jsonl"
+DEFAULTS = {"rules": [], "profile": False, "trace": False}
+
+_marks = {"start": time.perf_counter()}
+_trace: dict | None = None  # this hook's trace record so far, None if not traced
+
+
+def write_rules(rules: list[dict], path: str = RULES):
+    """Replace the rules, called by the charm whenever its view changes."""
+    _update(path, rules=rules)
+
+
+def set_profiling(enabled: bool, path: str = RULES):
+    """Turn the startup report on or off for the following dispatches."""
+    _update(path, profile=enabled)
+
+
+def set_tracing(enabled: bool, path: str = RULES):
+    """Turn the per-hook trace on or off for the following dispatches."""
+    _update(path, trace=enabled)
+
+
+def _update(path: str, **changes):
+    """Rewrite the file if any of the settings change, atomically."""
+    settings = read_settings(path)
+    if all(settings.get(key, DEFAULTS[key]) == value for key, value in changes.items()):
+        return
+    settings = {**DEFAULTS, **settings, **changes}
+    with open(path + ".tmp", "w") as f:
+        json.dump(settings, f, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def read_settings(path: str = RULES) -> dict:
+    """Rules and options for the pre-`ops` code, empty if there are none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def skip_reason(environ=os.environ, path: str = RULES, relation_get=None) -> str | None:
+    """Why this dispatch can be skipped, None if it must run.
+
+    `relation_get(environ, app)` reads the remote databag, the hook tool by default.
+    """
+    return _skip_reason(environ, read_settings(path).get("rules", []), relation_get)
+
+
+def _skip_reason(environ, rules: list[dict], relation_get=None) -> str | None:
+    hook = environ.get("JUJU_HOOK_NAME")
+    if not hook:
+        return None
+
+    remote_unit = environ.get("JUJU_REMOTE_UNIT", "")
+    remote_app = environ.get("JUJU_REMOTE_APP", "") or remote_unit.partition("/")[0]
+    relation_id = environ.get("JUJU_RELATION_ID", "").rpartition(":")[2]
+    for rule in rules:
+        if hook not in rule.get("hooks", ()):
+            continue
+        if "relation_ids" in rule and relation_id not in map(str, rule["relation_ids"]):
+            continue
+        if "unless_unit" in rule and rule["unless_unit"] == environ.get("JUJU_UNIT_NAME"):
+            continue
+        if "remote_units" in rule and remote_unit not in rule["remote_units"]:
+            return f"remote unit {remote_unit!r} not of interest"
+        if "remote_apps" in rule and remote_app not in rule["remote_apps"]:
+            return f"remote app {remote_app!r} not of interest"
+        if "unchanged" in rule and unchanged(rule["unchanged"], environ, relation_get):
+            return "values unchanged"
+        if not rule.keys() - {"hooks", "relation_ids", "unless_unit"}:
+            return "hook not of interest"
+    return None
+
+
+def unchanged(check: dict, environ=os.environ, relation_get=None) -> bool:
+    """Compare the remote databag with expected values."""
+    data = (relation_get or _relation_get)(environ, bool(check.get("app")))
+    if data is None:
+        return False
+    return all(
+        same(data.get(key), expected) for key, expected in check["values"].items()
+    )
+
+
+def _relation_get(environ, app: bool) -> dict | None:
+    """Read the remote unit or app databag with the hook tool."""
+    import subprocess  # only paid for by rules that need it
+
+    remote = environ.get("JUJU_REMOTE_APP") if app else None
+    remote = remote or environ.get("JUJU_REMOTE_UNIT")
+    if not remote:
+        return None
+    cmd = ["relation-get", "--format=json", "-r", environ.get("JUJU_RELATION_ID", "")]
+    if app:
+        cmd.append("--app")
+    try:
+        return json.loads(subprocess.check_output([*cmd, "-", remote], timeout=10))
+    except Exception:
+        return None
+
+
+def same(value: str | None, expected: str) -> bool:
+    """Compare a value, "sha256:..." expectations compare the digest instead."""
+    if value is None:
+        return False
+    if expected.startswith("sha256:"):
+        return expected == digest(value)
+    return value == expected
+
+
+def digest(value: str) -> str:
+    """Short stand-in for large values in the rules file."""
+    import hashlib  # not needed to decide most dispatches
+
+    return "sha256:" + hashlib.sha256(value.encode()).hexdigest()
+
+
+def count_skip(hook: str, path: str = STATS):
+    try:
+        with open(path) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        stats = {}
+    skipped = stats.setdefault("skipped", {})
+    skipped[hook] = skipped.get(hook, 0) + 1
+    with open(path + ".tmp", "w") as f:
+        json.dump(stats, f)
+    os.replace(path + ".tmp", path)
+
+
+def skipped(path: str = STATS) -> dict[str, int]:
+    """How many dispatches were skipped, per hook."""
+    try:
+        with open(path) as f:
+            return json.load(f).get("skipped", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def profile(stage: str):
+    """Note the time this dispatch reached a stage, for the startup report."""
+    _marks[stage] = time.perf_counter()
+
+
+def write_profile(environ=os.environ, path: str = PROFILE):
+    """Append this dispatch's stage times to the startup report."""
+    import sys
+
+    start = _marks["start"]
+    now = time.perf_counter()
+    record = {
+        "hook": environ.get("JUJU_HOOK_NAME"),
+        "time": round(time.time(), 3),
+        "interpreter": _process_age(),
+        **{k: round(v - start, 4) for k, v in _marks.items() if k != "start"},
+        "exit": round(now - start, 4),
+        "modules": len(sys.modules),
+    }
+    if record["interpreter"] is not None:
+        record["interpreter"] = round(max(record["interpreter"] - (now - start), 0), 3)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def tracing() -> bool:
+    """Whether this hook is traced."""
+    return _trace is not None
+
+
+def start_trace():
+    global _trace
+    _trace = {"read": 0, "written": 0}
+
+
+def traffic(read: int = 0, written: int = 0):
+    """Count relation data bytes for the trace."""
+    if _trace is not None:
+        _trace["read"] += read
+        _trace["written"] += written
+
+
+def annotate(**fields):
+    """Add fields to this hook's trace record."""
+    if _trace is not None:
+        _trace.update(fields)
+
+
+def write_trace(environ=os.environ, path: str = TRACE):
+    """Append this hook's trace record."""
+    if _trace is None or "handoff" in _marks:
+        return  # the resident process writes it
+    start = _marks["start"]
+    now = time.perf_counter()
+    skipped = "skipped" in _marks
+    imports = _marks.get("imports", start)  # nothing to import in the resident
+    init = _marks.get("init")
+    record = {
+        "hook": hook_name(environ),
+        "unit": environ.get("JUJU_UNIT_NAME"),
+        "remote_unit": environ.get("JUJU_REMOTE_UNIT") or None,
+        "time": round(time.time(), 3),
+        "import": None if skipped else round(imports - start, 4),
+        "load": round(init - imports, 4) if init else None,
+        "handler": round(now - init, 4) if init else None,
+        "total": round(now - start, 4),
+        "read": _trace["read"],
+        "written": _trace["written"],
+        "useful": _trace["written"] > 0,
+        "skipped": skipped,
+        **{k: v for k, v in _trace.items() if k not in ("read", "written")},
+    }
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def restart() -> bool:
+    """Start over in the resident's child for a new hook, True if it is traced."""
+    global _trace
+    _marks.clear()
+    _marks["start"] = time.perf_counter()
+    _trace = None
+    if read_settings(RULES).get("trace"):
+        start_trace()
+    return tracing()
+
+
+def hook_name(environ=os.environ) -> str:
+    """Return the hook or action name, Juju leaves JUJU_HOOK_NAME empty for actions."""
+    return (
+        environ.get("JUJU_HOOK_NAME")
+        or os.path.basename(environ.get("JUJU_DISPATCH_PATH", ""))
+        or "unknown"
+    )
+
+
+def _process_age() -> float | None:
+    """Seconds since this process started, from /proc at clock tick resolution."""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def exit_if_irrelevant():
+    """Exit the process early if the rules say this dispatch is not needed."""
+    settings = read_settings(RULES)
+    if settings.get("profile") and os.environ.get("JUJU_HOOK_NAME"):
+        import atexit
+
+        atexit.register(write_profile)
+    if settings.get("trace") and os.environ.get("JUJU_DISPATCH_PATH"):
+        import atexit
+
+        start_trace()
+        atexit.register(write_trace)
+    if _skip_reason(os.environ, settings.get("rules", [])):
+        count_skip(os.environ["JUJU_HOOK_NAME"])
+        profile("skipped")
+        raise SystemExit(0)
+    profile("dispatch")
@@ -1,6 +1,7 @@
 """Test it."""
 
 # import concurrent.futures
+import dataclasses
 import json
 import re
 from types import MappingProxyType
@@ -11,7 +12,9 @@ import ops.testing
 import pytest
 from ops.testing import Context, PeerRelation, State
 
-from charm import JGOLPeerCharm
+import dispatch
+from charm import JGOLPeerCharm, value
+from topology import Topology
 
 JSON = NewType("JSON", str)
 
@@ -34,9 +37,16 @@ MAP_3X3 = {
 }
 
 
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run in a scratch directory, the charm writes its dispatch rules there."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
 @pytest.fixture
 def board():
-    return json.dumps(MAP_3X3)
+    return Topology(tuple(MAP_3X3), 3, 3).dumps()
 
 
 def test_boot():
@@ -67,7 +77,7 @@ def test_init_unit(board):
             "run": "false",
             "round": "0",
             "init": '"000111000"',
-            "map": board,
+            "topology": board,
             "leader": "app/42",
         },
         peers_data={},
@@ -77,10 +87,10 @@ def test_init_unit(board):
     state = ctx.run(ctx.on.update_status(), state)
     assert state.unit_status == ops.ActiveStatus()
     rel = state.get_relation(1)
-    assert rel.local_unit_data == {"0": "0"}
+    assert rel.local_unit_data == {"0": "0", "at": "1"}
 
 
-def exercise(units=20, rounds=20):
+def exercise(units=20, rounds=20, window=0):
     # About 1.5x faster with Python 3.15t
     # Needs a fix in venv ops re OPERATOR_DISPATCH
     # with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -142,7 +152,7 @@ def exercise(units=20, rounds=20):
 
         del rv[:]
 
-        config = {"run": True}
+        config = {"run": True, "async-window": window}
 
         while rounds:
             loop()
@@ -175,6 +185,16 @@ def test_run():
     assert len(set(boards[:4])) == 3
 
 
+def test_run_async():
+    """Cells run ahead of the leader, who reports every board they all reached."""
+    rv = exercise(11, rounds=12, window=3)
+    reports = [r for r in rv if "-->" in r]
+    rounds = [int(r.rpartition(" ")[2]) for r in reports]
+    assert rounds == sorted(set(rounds)) and len(rounds) > 1
+    for report, round_ in zip(reports, rounds):
+        assert board_from_status(report) == ("000111000", "010010010")[round_ % 2]
+
+
 def board_from_status(st: str) -> str | None:
     if match := re.search(r"\[(.*)\]", st):
         return match.groups()[0]
@@ -210,6 +230,207 @@ def step(
     return app_data, unit_data, app_message, unit_message
 
 
+def test_cell_caches_location(board, workdir):
+    """Neighbours are resolved once per topology."""
+    app_data = {"run": "false", "round": "0", "topology": board, "leader": "app/0"}
+    rel = PeerRelation(endpoint="world", id=1, local_app_data=app_data)
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=4)
+    state = ctx.run(ctx.on.update_status(), State(relations={rel}))
+    stored = state.get_stored_state("_stored", owner_path="JGOLPeerCharm")
+    assert stored.content["own_index"] == 4
+    assert stored.content["neighbours"] == MAP_3X3["app/4"]
+
+
+def test_dispatch_rules(board, workdir):
+    """Followers skip relation changes from units that aren't neighbours."""
+    app_data = {"run": "false", "round": "0", "topology": board, "leader": "app/0"}
+    rel = PeerRelation(endpoint="world", id=1, local_app_data=app_data)
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=8)
+    ctx.run(ctx.on.update_status(), State(relations={rel}))
+
+    env = {"JUJU_HOOK_NAME": "world-relation-changed", "JUJU_RELATION_ID": "world:1"}
+    env["JUJU_UNIT_NAME"] = "app/8"
+    assert dispatch.skip_reason({**env, "JUJU_REMOTE_UNIT": "app/7"}) is None
+    assert dispatch.skip_reason({**env, "JUJU_REMOTE_UNIT": "app/0"}) is None
+    assert dispatch.skip_reason({**env, "JUJU_REMOTE_UNIT": "app/1"})
+    assert dispatch.skip_reason({**env, "JUJU_RELATION_ID": "world:2", "JUJU_REMOTE_UNIT": "app/1"}) is None
+    # the leader sees everything
+    assert dispatch.skip_reason({**env, "JUJU_UNIT_NAME": "app/0", "JUJU_REMOTE_UNIT": "app/1"}) is None
+
+
+def test_leader_tracks_rounds_incrementally(board, workdir):
+    """The leader re-reads only the reporting unit, and advances on the last one."""
+    init = "000111000"
+    app_data = {"run": "true", "round": "0", "topology": board, "leader": "app/0"}
+    peers = {i: {"0": init[i]} for i in range(1, 9)}
+    rel = PeerRelation(
+        endpoint="world", id=1, local_app_data=app_data, local_unit_data={"0": "0"}, peers_data=peers
+    )
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=0)
+    state = ctx.run(
+        ctx.on.update_status(), State(leader=True, relations={rel}, config={"run": True})
+    )
+    assert state.app_status == ops.ActiveStatus("0: [000111000] --> 0")
+
+    # Every cell has moved on, the leader hears about them one by one
+    rel = state.get_relation(1)
+    peers = {i: {**peers[i], "1": "1" if i in (1, 4, 7) else "0"} for i in range(1, 9)}
+    rel = dataclasses.replace(rel, peers_data=peers)
+    state = dataclasses.replace(state, relations={rel})
+    for unit_id in range(1, 9):
+        state = ctx.run(ctx.on.relation_changed(rel, remote_unit=unit_id), state)
+        rel = state.get_relation(1)
+        if unit_id == 7:
+            assert state.app_status == ops.ActiveStatus("0: [01001001.]")
+    assert state.app_status == ops.ActiveStatus("0: [010010010] --> 1")
+
+
+def test_cell_waits_only_for_neighbours(board, workdir):
+    """A corner cell steps as far as its neighbours and the window allow."""
+    app_data = {"run": "true", "round": "1", "topology": board, "leader": "app/4"}
+    # Neighbours of app/0 are app/1, app/3 and app/4, the rest of the board is stuck
+    peers = {i: {"1": "1"} for i in range(1, 9)}
+    peers.update({i: {"1": "1", "2": "1", "3": "1", "4": "1"} for i in (1, 3, 4)})
+    rel = PeerRelation(
+        endpoint="world", id=1, local_app_data=app_data, local_unit_data={"0": "0", "1": "0"}, peers_data=peers
+    )
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=0)
+    state = ctx.run(
+        ctx.on.update_status(), State(relations={rel}, config={"run": True, "async-window": 2})
+    )
+    # Round 0 is behind the leader, three live neighbours bring the cell to life
+    assert state.get_relation(1).local_unit_data == {"1": "0", "2": "1", "3": "1", "at": "0"}
+    assert state.unit_status == ops.ActiveStatus("3")
+
+    peers[4] = {"1": "1"}
+    rel = dataclasses.replace(state.get_relation(1), peers_data=peers, local_app_data={**app_data, "round": "2"})
+    state = ctx.run(
+        ctx.on.update_status(), State(relations={rel}, config={"run": True, "async-window": 2})
+    )
+    assert state.get_relation(1).local_unit_data == {"2": "1", "3": "1", "at": "0"}
+
+
+def test_moved_cell(board, workdir):
+    """Rounds a unit stepped at its old position don't count at its new one."""
+    app_data = {"run": "true", "round": "1", "topology": board, "leader": "app/0"}
+    units = {i: {"1": "1", "at": str(i)} for i in range(9)}
+    units[1]["at"] = "7"
+
+    def run(unit_id: int, config: dict) -> State:
+        peers = {i: d for i, d in units.items() if i != unit_id}
+        rel = PeerRelation(
+            endpoint="world", id=1, local_app_data=app_data, local_unit_data=units[unit_id], peers_data=peers
+        )
+        ctx = Context(JGOLPeerCharm, app_name="app", unit_id=unit_id)
+        return ctx.run(ctx.on.update_status(), State(leader=not unit_id, relations={rel}, config=config))
+
+    # Its neighbours wait for it, it waits for a reset, the leader leaves it out
+    state = run(4, {"run": True})
+    assert isinstance(state.unit_status, ops.WaitingStatus)
+    assert "2" not in state.get_relation(1).local_unit_data
+    state = run(1, {"run": True})
+    assert state.unit_status == ops.WaitingStatus("moved, waiting for a reset")
+    assert run(0, {"run": True}).app_status.message.startswith("1: [1.1111111]")
+
+    app_data = {**app_data, "run": "false", "round": "0"}
+    assert run(1, {}).get_relation(1).local_unit_data == {"0": "0", "at": "1"}
+
+
+def run_blinker(config: dict, generations: int) -> list[str]:
+    """Return the leader's status after each round, all cells step in between."""
+    blinker = ("000111000", "010010010")
+    app_data = {"run": "true", "round": "0", "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(), "leader": "app/0"}
+    rel = PeerRelation(endpoint="world", id=1, local_app_data=app_data)
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=0)
+    state = State(leader=True, relations={rel}, config={"run": True, **config})
+    statuses = []
+    for _ in range(generations):
+        rel = state.get_relation(1)
+        r = json.loads(rel.local_app_data["round"])
+        data = {i: {str(r): blinker[r % 2][i], str(r + 1): blinker[(r + 1) % 2][i]} for i in range(9)}
+        rel = dataclasses.replace(rel, local_unit_data=data.pop(0), peers_data=data)
+        state = dataclasses.replace(state, relations={rel})
+        state = ctx.run(ctx.on.update_status(), state)
+        statuses.append(state.app_status.message)
+    return statuses
+
+
+def test_cycle_skip(workdir):
+    """The blinker comes round every other generation, the leader jumps ahead."""
+    statuses = run_blinker({"cycle-history": 8, "on-cycle": "skip", "cycle-skip": 101}, 4)
+    assert statuses == [
+        "0: [010010010] --> 1",
+        "1: [000111000] --> 2",
+        "2: [010010010] --> 103, period 2, skipped 100",
+        "103: [000111000] --> 204, period 2, skipped 100",
+    ]
+
+
+def test_cycle_halt(workdir):
+    statuses = run_blinker({"cycle-history": 8, "on-cycle": "halt"}, 4)
+    assert statuses[2:] == ["2: [010010010] period 2, halted"] * 2
+
+
+def test_activity_mask(workdir):
+    """Cells away from the blinker sit still, the leader counts them as done."""
+    names = [f"app/{i}" for i in range(36)]
+    topology = Topology.grid(names)
+    horizontal, vertical = {6, 7, 8}, {1, 7, 13}
+    blinker = ["".join(str(int(i in live)) for i in range(36)) for live in (horizontal, vertical)]
+    data = {cell: {"0": blinker[0][i]} for i, cell in enumerate(topology.cells)}
+    app_data = {"run": "true", "round": "0", "topology": topology.dumps(), "leader": "app/0"}
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=0)
+    config = {"run": True, "activity-mask": True}
+    state = State(leader=True, relations={PeerRelation(endpoint="world", id=1, local_app_data=app_data)}, config=config)
+    statuses = []
+    for _ in range(4):
+        rel = state.get_relation(1)
+        r = int(rel.local_app_data["round"])
+        mask = rel.local_app_data.get("active", "1" * 36)
+        for i, cell in enumerate(topology.cells):
+            if mask[i] == "1":
+                data[cell][str(r + 1)] = blinker[(r + 1) % 2][i]
+        units = {int(cell.split("/")[1]): dict(d) for cell, d in data.items()}
+        rel = dataclasses.replace(rel, local_unit_data=units.pop(0), peers_data=units)
+        state = ctx.run(ctx.on.update_status(), dataclasses.replace(state, relations={rel}))
+        statuses.append(state.app_status.message)
+    assert statuses == [
+        f"0: [{blinker[1]}] --> 1",
+        f"1: [{blinker[0]}] --> 2, 15 active",
+        f"2: [{blinker[1]}] --> 3, 15 active",
+        f"3: [{blinker[0]}] --> 4, 15 active",
+    ]
+
+
+def test_activity_mask_still_life(workdir):
+    """With nothing left to step the mask would be empty, halt instead of waiting."""
+    names = [f"app/{i}" for i in range(16)]
+    topology = Topology.grid(names)
+    block = "0000011001100000"
+    data = {cell: {"0": block[i]} for i, cell in enumerate(topology.cells)}
+    app_data = {"run": "true", "round": "0", "topology": topology.dumps(), "leader": "app/0"}
+    ctx = Context(JGOLPeerCharm, app_name="app", unit_id=0)
+    config = {"run": True, "activity-mask": True}
+    state = State(leader=True, relations={PeerRelation(endpoint="world", id=1, local_app_data=app_data)}, config=config)
+    statuses = []
+    for _ in range(3):
+        rel = state.get_relation(1)
+        r = int(rel.local_app_data["round"])
+        for i, cell in enumerate(topology.cells):
+            data[cell].setdefault(str(r + 1), block[i])
+        units = {int(cell.split("/")[1]): dict(d) for cell, d in data.items()}
+        rel = dataclasses.replace(rel, local_unit_data=units.pop(0), peers_data=units)
+        state = ctx.run(ctx.on.update_status(), dataclasses.replace(state, relations={rel}))
+        statuses.append(state.app_status.message)
+    assert statuses == [f"0: [{block}] --> 1", *[f"1: [{block}] still life, halted"] * 2]
+    assert "active" not in state.get_relation(1).local_app_data
+
+
+def test_value_stands_until_it_changes():
+    assert value({"3": "1", "7": "0"}, 7) == "0"
+    assert value({"3": "1", "7": "0"}, 6) == "1"
+
+
 if __name__ == "__main__":
     import sys
     args = map(int, sys.argv[0:])
@@ -3,20 +3,49 @@
 # See LICENSE file for licensing details.
 """Juju's Game of Life."""
 
+# The dispatch filter and the resident hand-off run before the other imports,
+# ops alone takes longer to import than a skipped or served hook needs.
+# ruff: noqa: E402
+import dispatch
+
+dispatch.exit_if_irrelevant()
+import resident
+
+resident.exit_if_served()
+
+import hashlib
 import json
+import logging
+from typing import Any
 
 import ops
 
+import databag
+import wire
+from topology import Topology, offsets
+
+dispatch.profile("imports")
+
 
 class JGOLWorkerCharm(ops.CharmBase):
     """Juju's Game of Life."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
+        resident.ensure(bool(self.config.get("resident")))
+        dispatch.set_profiling(bool(self.config.get("profile-startup")))
+        dispatch.set_tracing(bool(self.config.get("trace")))
+        self.read = databag.Reader()
+        self._stored.set_default(
+            topology="", own_index=-1, neighbour_indices=[], geometry={}
+        )
         framework.observe(self.on["world"].relation_joined, self.cell)
         framework.observe(self.on["world"].relation_changed, self.cell)
         framework.observe(self.on["world"].relation_departed, self.cell)
         framework.observe(self.on.config_changed, self.cell)
+        dispatch.profile("init")
 
     def cell(self, _event: ops.EventBase):
         """Update this cell based on neighbours.
@@ -31,34 +60,195 @@ class JGOLWorkerCharm(ops.CharmBase):
         * delete any outdated rounds
         * keep current round as is
         * post next round when all inputs are ready
+
+        Cells outside the coordinator's `active` mask sit the round out.
+        The posted value is tagged with the cell's position, `at`, as units
+        joining or leaving may move it on the grid.
         """
         try:
             world = self.model.get_relation("world")
             assert world, "waiting for peer relation"
 
-            round_: int = json.loads(world.data[world.app]["round"])
-            neighbours: dict[str, list[str]] = json.loads(world.data[world.app]["map"])
-            board: str = world.data[world.app]["board"]
+            app_data = self.read(world, world.app)
+            round_: int = json.loads(app_data["round"])
+            dispatch.annotate(round=round_)
+            location = self.locate(app_data)
 
-            if self.unit.name not in neighbours:
+            if location is None:
                 self.unit.status = ops.ActiveStatus("unused")
+                self.skip_until_changed(world, rounds=False)
                 return
 
-            own_index = list(neighbours).index(self.unit.name)
-            live = int(board[own_index])
-            neighbours_alive = sum(
-                int(board[list(neighbours).index(n)])
-                for n in neighbours[self.unit.name]
-            )
+            own_index, neighbour_indices = location
+            if not active(app_data, own_index):
+                # Nothing changed within reach, the coordinator keeps our value
+                self.unit.status = ops.ActiveStatus(f"{round_}: still")
+                self.skip_until_changed(world)
+                return
+            board = self.board(app_data)
+            if board is None:
+                # Ask for a keyframe, the coordinator waits for this cell anyway,
+                # and don't skip it when it comes in the same round
+                dispatch.write_rules([])
+                with databag.Batch(self.read(world, self.unit)) as data:
+                    data["resync"] = json.dumps(round_)
+                self.unit.status = ops.WaitingStatus(f"{round_}: board checksum mismatch")
+                return
+            if self._stored.geometry.get("tile", 1) > 1:
+                # Board geometry without the cell names, step_tile needs no more
+                topology = Topology((), **dict(self._stored.geometry))
+                tile = step_tile(board, topology, own_index)
+                # A coordinator that sends sparse boards reads sparse tiles
+                encoding = "auto" if board.encoding == "sparse" else "bits"
+                with databag.Batch(self.read(world, self.unit)) as data:
+                    data["value"] = wire.encode(tile, encoding)
+                    data["round"] = json.dumps(round_)
+                    data["at"] = json.dumps(own_index)
+                    data.pop("resync", None)
+                self.unit.status = ops.ActiveStatus(f"{round_}: {tile.count('1')} live")
+                self.skip_until_changed(world)
+                return
+
+            live = board[own_index]
+            neighbours_alive = sum(board[i] for i in neighbour_indices)
 
             next_live = int(gol_step(bool(live), neighbours_alive))
 
-            world.data[self.unit]["value"] = json.dumps(next_live)
-            world.data[self.unit]["round"] = json.dumps(round_)
+            with databag.Batch(self.read(world, self.unit)) as data:
+                data["value"] = json.dumps(next_live)
+                data["round"] = json.dumps(round_)
+                data["at"] = json.dumps(own_index)
+                data.pop("resync", None)
             self.unit.status = ops.ActiveStatus(f"{round_}: {next_live}")
+            self.skip_until_changed(world)
         except Exception as e:
             self.unit.status = ops.WaitingStatus(repr(e))
 
+    def board(self, app_data: ops.RelationDataContent) -> wire.Board | None:
+        """Return this round's board, None if the delta doesn't apply to the keyframe."""
+        if "delta" not in app_data:
+            return wire.Board(app_data["board"])
+        try:
+            return wire.Board(wire.apply(wire.decode(app_data["board"]), app_data["delta"]))
+        except ValueError as e:
+            logging.warning("Can't rebuild the board: %s", e)
+            return None
+
+    def skip_until_changed(self, world: ops.Relation, rounds: bool = True):
+        """Skip hooks until the coordinator moves on, this round is posted.
+
+        An unused cell has nothing to do until the topology changes.
+        """
+        app_data = self.read(world, world.app)
+        key = "topology" if "topology" in app_data else "map"
+        values = {key: dispatch.digest(app_data[key])}
+        if rounds:
+            values["round"] = app_data["round"]
+        dispatch.write_rules(
+            [
+                {
+                    "hooks": ["world-relation-changed"],
+                    "relation_ids": [world.id],
+                    "remote_apps": [world.app.name],
+                    "unchanged": {"app": True, "values": values},
+                }
+            ]
+        )
+
+    def locate(self, app_data: ops.RelationDataContent) -> tuple[int, list[int]] | None:
+        """Find own and neighbours' positions on the board, None if unused.
+
+        The result is kept in unit-local state until the topology changes,
+        so that steady state hooks don't parse the topology at all.
+        """
+        key = "topology" if "topology" in app_data else "map"
+        digest = f"{key}:" + hashlib.sha256(app_data[key].encode()).hexdigest()
+        if self._stored.topology != digest:
+            own_index, neighbour_indices, geometry = self._locate(app_data) or (-1, [], {})
+            self._stored.own_index = own_index
+            self._stored.neighbour_indices = neighbour_indices
+            self._stored.geometry = geometry
+            self._stored.topology = digest
+        if self._stored.own_index < 0:
+            return None
+        return self._stored.own_index, list(self._stored.neighbour_indices)
+
+    def _locate(
+        self, app_data: ops.RelationDataContent
+    ) -> tuple[int, list[int], dict[str, Any]] | None:
+        """Understands both the topology descriptor and the legacy full `map`."""
+        if "topology" in app_data:
+            topology = Topology.loads(app_data["topology"])
+            own_index = topology.index(self.unit.name)
+            if own_index is None:
+                return None
+            geometry = {
+                "width": topology.width,
+                "height": topology.height,
+                "wrap": topology.wrap,
+                "shape": topology.shape,
+                "radius": topology.radius,
+                "tile": topology.tile,
+            }
+            return own_index, topology.neighbour_indices(own_index), geometry
+
+        neighbours: dict[str, list[str]] = json.loads(app_data["map"])
+        if self.unit.name not in neighbours:
+            return None
+        cells = list(neighbours)
+        return (
+            cells.index(self.unit.name),
+            [cells.index(n) for n in neighbours[self.unit.name]],
+            {},
+        )
+
+
+def active(app_data: ops.RelationDataContent, index: int) -> bool:
+    """Whether the cell steps this round, all do without a mask."""
+    return "active" not in app_data or bool(wire.Board(app_data["active"])[index])
+
+
+def step_tile(board: wire.Board, topology: Topology, index: int) -> str:
+    """Next generation of the tile owned by the cell at index.
+
+    Only the tile and its halo, `radius` cells wide, are read from the board.
+    """
+    import life  # numpy is only needed in tile mode
+
+    k, r = topology.tile, topology.radius
+    ty, tx = divmod(index, topology.width)
+    if topology.wrap and min(topology.board_width, topology.board_height) <= 2 * r:
+        # The halo would wrap onto itself, step the whole (small) board instead
+        whole = life.from_string(str(board), topology.board_width)
+        whole = life.step(whole, True, offsets(topology.shape, r))
+        return life.to_string(whole[ty * k : ty * k + k, tx * k : tx * k + k])
+    side = k + 2 * r
+    rows = [
+        board_row(board, topology, y, tx * k - r, side)
+        for y in range(ty * k - r, ty * k + k + r)
+    ]
+    padded = life.from_string("".join(rows), side)
+    return life.to_string(life.step_padded(padded, offsets(topology.shape, r)))
+
+
+def board_row(board: wire.Board, topology: Topology, y: int, x: int, length: int) -> str:
+    """Cells [x, x + length) of row y, cells off the board are dead unless wrapping."""
+    width, height = topology.board_width, topology.board_height
+    if topology.wrap:
+        y %= height
+    elif not 0 <= y < height:
+        return "0" * length
+    start = y * width
+    left, right = max(-x, 0), max(x + length - width, 0)
+    middle = board.slice(start + max(x, 0), start + min(x + length, width))
+    if topology.wrap:
+        return (
+            board.slice(start + width - left, start + width)
+            + middle
+            + board.slice(start, start + right)
+        )
+    return "0" * left + middle + "0" * right
+
 
 def gol_step(live: bool, neighbours_alive: int) -> bool:
     if live and neighbours_alive in (2, 3):
@@ -72,4 +262,4 @@ def gol_step(live: bool, neighbours_alive: int) -> bool:
 
 
 if __name__ == "__main__":
-    ops.main(JGOLWorkerCharm)
+    resident.main(lambda: ops.main(JGOLWorkerCharm))
@@ -0,0 +1,231 @@
+# Copyright 2025 dima.tisnek@canonical.com
+# See LICENSE file for licensing details.
+"""Resident charm process, saves interpreter and `ops` startup on each hook.
+
+This module is shared between the charms, keep the copies identical.
+Stick to the standard library and `dispatch`, the shim runs before `ops` is imported.
+
+With the `resident` config option set, the charm starts `src/charm.py --resident`
+in the background, which imports everything once and listens on `resident.sock`.
+Each dispatch then connects, passes its environment and stdio file descriptors,
+and the resident forks a child to run the hook, so that no state leaks from
+one hook to the next. The dispatch waits and exits with the hook's exit code.
+
+Anything going wrong before the hook starts — no resident, stale code after
+an upgrade, a refused connection — falls back to running the hook cold,
+in the dispatch process itself, which also (re)starts the resident.
+"""
+
+import json
+import os
+import socket
+import sys
+
+import dispatch
+
+SOCKET = "resident.sock"
+LOG = "resident.log"
+TIMEOUT = 600  # Juju doesn't time hooks out, but a stuck unit is worse
+COLD_HOOKS = {"install", "upgrade-charm", "stop", "remove"}
+BUFSIZE = 1 << 20
+
+_serving = False
+_stopping = False  # a served hook turned the resident off
+
+
+def main(run):
+    """Charm entry point, serves hooks with `--resident`, otherwise runs this one."""
+    if "--resident" in sys.argv:
+        serve(run)
+    else:
+        run()
+
+
+def exit_if_served(environ=os.environ, path: str = SOCKET):
+    """Exit with the hook's exit code if the resident process ran it."""
+    if "--resident" not in sys.argv and (code := handoff(environ, path=path)) is not None:
+        dispatch.profile("handoff")
+        raise SystemExit(code)
+
+
+def handoff(environ=os.environ, fds=(0, 1, 2), path: str = SOCKET) -> int | None:
+    """Run this dispatch in the resident process, None if it has to run cold."""
+    if environ.get("JUJU_HOOK_NAME") in COLD_HOOKS or not os.path.exists(path):
+        return None
+    request = {"env": dict(environ), "cwd": os.getcwd(), "argv": sys.argv}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as s:
+        try:
+            s.connect(path)
+            socket.send_fds(s, [json.dumps(request).encode()], list(fds))
+            if not json.loads(s.recv(BUFSIZE) or b"{}").get("started"):
+                return None
+        except (OSError, ValueError):
+            return None
+        # The hook has started, it must not run again
+        try:
+            return json.loads(s.recv(BUFSIZE) or b"{}").get("exit", 1)
+        except (OSError, ValueError):
+            return 1
+
+
+def ensure(enabled: bool, path: str = SOCKET):
+    """Start or stop the resident process to match the config.
+
+    Only cold hooks get this far without the resident, so any resident
+    still around is stale or unresponsive and is replaced. A hook that the
+    resident runs can only turn it off: the socket goes at once, so that
+    the next hook runs cold, and the resident exits when this one is done.
+    """
+    global _stopping
+    if _serving:
+        if not enabled:
+            _stopping = True
+            _unlink(path)
+        return
+    stop(path)
+    if enabled and os.environ.get("JUJU_HOOK_NAME") not in {"stop", "remove"}:
+        import subprocess
+
+        env = {k: v for k, v in os.environ.items() if not k.startswith("JUJU_")}
+        with open(LOG, "a") as log:
+            subprocess.Popen(
+                [sys.executable, sys.argv[0], "--resident"],
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+
+def stop(path: str = SOCKET):
+    """Ask the resident process to exit, wait until it has let go of the socket."""
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as s:
+        try:
+            s.connect(path)
+            s.send(json.dumps({"stop": True}).encode())
+            s.recv(BUFSIZE)
+        except OSError:
+            _unlink(path)
+
+
+def serve(main, path: str = SOCKET, timeout: float = TIMEOUT):
+    """Run hooks with `main()` in forked children until told to stop."""
+    global _serving
+    _serving = True
+    stop(path)
+    _unlink(path)
+    mtimes = _mtimes()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as server:
+        server.bind(path)
+        server.listen()
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    msg, fds, _, _ = socket.recv_fds(conn, BUFSIZE, 3)
+                    request = json.loads(msg)
+                except (OSError, ValueError):
+                    continue
+                try:
+                    if request.get("stop") or _mtimes() != mtimes:
+                        # Let go of the socket before replying, see `stop`
+                        _unlink(path)
+                        conn.send(b"{}")
+                        return
+                    if _run(server, conn, request, fds, main, timeout):
+                        _unlink(path)
+                        return
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+
+
+def _run(server, conn, request: dict, fds: list[int], main, timeout: float) -> bool:
+    """Run one hook in a forked child, True if the hook turned the resident off."""
+    import select
+    import signal
+
+    conn.send(json.dumps({"started": True}).encode())
+    stopping, stop = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.close(stopping)
+            server.close()
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            sys.argv[:] = request["argv"]
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            traced = dispatch.restart()
+            code = _exit_code(main)
+            if traced:
+                dispatch.write_trace()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if _stopping:
+                    os.write(stop, b"1")
+                conn.send(json.dumps({"exit": code}).encode())
+            finally:
+                os._exit(code)
+
+    os.close(stop)
+    pidfd = os.pidfd_open(pid)
+    try:
+        finished, _, _ = select.select([pidfd], [], [], timeout)
+        if not finished:
+            os.kill(pid, signal.SIGKILL)
+        _, status = os.waitpid(pid, 0)
+        # The child is gone, so is the write end: this doesn't block
+        rv = bool(os.read(stopping, 1))
+    finally:
+        os.close(pidfd)
+        os.close(stopping)
+    if not finished:
+        os.write(fds[2], f"Hook timed out after {timeout}s\n".encode())
+        conn.send(json.dumps({"exit": 124}).encode())
+    elif (code := os.waitstatus_to_exitcode(status)) < 0:
+        # Killed before it could report, e.g. by the OOM killer
+        conn.send(json.dumps({"exit": 128 - code}).encode())
+    return rv
+
+
+def _exit_code(main) -> int:
+    """Run the hook, exit code as the interpreter would have it."""
+    import traceback
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def _mtimes() -> dict[str, float]:
+    """Modification times of the charm code, the resident must not outlive it."""
+    src = os.path.dirname(os.path.abspath(__file__))
+    return {
+        entry.name: entry.stat().st_mtime
+        for entry in os.scandir(src)
+        if entry.name.endswith(".py")
+    }
+
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -1,11 +1,24 @@
 from __future__ import annotations
 
+import dataclasses
 import json
+import os
+import subprocess
+import sys
+import time
+import unittest.mock
 
+import numpy as np
 import pytest
 from ops.testing import Context, Relation, State
 
+import databag
+import dispatch
+import life
+import resident
+import wire
 from charm import JGOLWorkerCharm
+from topology import Topology
 
 # 3x3 map:
 # --------
@@ -26,6 +39,13 @@ MAP_3X3 = {
 }
 
 
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run in a scratch directory, the charm writes its dispatch rules there."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
 @pytest.fixture
 def ctx() -> Context[JGOLWorkerCharm]:
     return Context(JGOLWorkerCharm, app_name="app", unit_id=4)
@@ -91,3 +111,375 @@ def test_worker_with_incomplete_state(ctx: Context):
     state = State(relations={rel})
     state = ctx.run(ctx.on.relation_changed(rel), state)
     rel = state.get_relation(rel.id)
+
+
+@pytest.mark.parametrize("board", ["010110010", "b1:9:WQA=", "s1:9:1,1,0,2"])
+def test_worker_reads_any_board_encoding(ctx: Context, board: str):
+    """Legacy text, bit-packed and sparse boards give the same result."""
+    rel = Relation(
+        endpoint="world",
+        remote_app_name="coordinator",
+        id=1,
+        remote_app_data={
+            "round": "0",
+            "map": json.dumps(MAP_3X3),
+            "board": board,
+        },
+    )
+    state = State(relations={rel})
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    rel = state.get_relation(rel.id)
+    # centre cell is alive with 3 live neighbours: survives
+    assert rel.local_unit_data["value"] == "1"
+    assert rel.local_unit_data["round"] == "0"
+
+
+def test_worker_applies_delta(ctx: Context, workdir):
+    """The board is the keyframe with the delta applied, a bad delta asks for a keyframe."""
+    keyframe, board = "000111000", "010010010"
+    app_data = {
+        "round": "1",
+        "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(),
+        "board": keyframe,
+        "keyframe": "0",
+        "delta": wire.delta(keyframe, board),
+    }
+    rel = Relation(endpoint="world", remote_app_name="coordinator", id=1, remote_app_data=app_data)
+    ctx = Context(JGOLWorkerCharm, app_name="app", unit_id=3)
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    # app/3 is dead with three live neighbours in round 1
+    assert state.get_relation(1).local_unit_data["value"] == "1"
+
+    app_data["delta"] = wire.delta(keyframe, board).replace(":1,", ":2,")
+    rel = dataclasses.replace(state.get_relation(1), remote_app_data=app_data)
+    state = ctx.run(ctx.on.relation_changed(rel), dataclasses.replace(state, relations={rel}))
+    assert state.get_relation(1).local_unit_data["resync"] == "1"
+    assert dispatch.read_settings()["rules"] == []
+
+    app_data = {**app_data, "board": board, "keyframe": "1"}
+    del app_data["delta"]
+    rel = dataclasses.replace(state.get_relation(1), remote_app_data=app_data)
+    state = ctx.run(ctx.on.relation_changed(rel), dataclasses.replace(state, relations={rel}))
+    assert "resync" not in state.get_relation(1).local_unit_data
+
+
+def test_worker_sits_still(workdir):
+    """A cell outside the active mask writes nothing, the others step as usual."""
+    app_data = {
+        "round": "1",
+        "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(),
+        "board": "000111000",
+        "active": wire.encode("111111000", "auto"),
+    }
+    rel = Relation(endpoint="world", remote_app_name="coordinator", id=1, remote_app_data=app_data)
+    unit_data = {"round": "0", "value": "0"}
+    rel = dataclasses.replace(rel, local_unit_data=unit_data)
+    ctx = Context(JGOLWorkerCharm, app_name="app", unit_id=7)
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    assert state.get_relation(1).local_unit_data == unit_data
+    assert state.unit_status.message == "1: still"
+
+    ctx = Context(JGOLWorkerCharm, app_name="app", unit_id=1)
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    assert state.get_relation(1).local_unit_data == {"round": "1", "value": "1", "at": "1"}
+
+
+def test_worker_reads_topology(ctx: Context):
+    """Neighbours are derived from the topology descriptor."""
+    rel = Relation(
+        endpoint="world",
+        remote_app_name="coordinator",
+        id=1,
+        remote_app_data={
+            "round": "3",
+            "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(),
+            "board": "010010010",
+        },
+    )
+    state = State(relations={rel})
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    rel = state.get_relation(rel.id)
+    assert rel.local_unit_data["value"] == "1"
+    assert rel.local_unit_data["round"] == "3"
+
+
+def test_topology_neighbours():
+    topology = Topology(tuple(MAP_3X3), 3, 3)
+    assert {cell: topology.neighbours(cell) for cell in MAP_3X3} == MAP_3X3
+
+
+def test_worker_caches_location(ctx: Context):
+    """Own and neighbour positions are reused until the topology changes."""
+    topology = Topology(tuple(MAP_3X3), 3, 3)
+    rel = Relation(
+        endpoint="world",
+        remote_app_name="coordinator",
+        id=1,
+        remote_app_data={
+            "round": "3",
+            "topology": topology.dumps(),
+            "board": "010010010",
+        },
+    )
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    stored = state.get_stored_state("_stored", owner_path="JGOLWorkerCharm")
+    assert stored.content["own_index"] == 4
+    assert stored.content["neighbour_indices"] == [0, 1, 2, 3, 5, 6, 7, 8]
+
+    # A tampered cache is trusted for as long as the topology is the same
+    stored = dataclasses.replace(
+        stored, content={**stored.content, "neighbour_indices": [0, 2]}
+    )
+    rel = state.get_relation(1)
+    state = dataclasses.replace(
+        state, stored_states={s for s in state.stored_states if s.name != "_stored"} | {stored}
+    )
+    state = ctx.run(ctx.on.relation_changed(rel), state)
+    assert state.get_relation(1).local_unit_data["value"] == "0"
+
+
+@pytest.mark.parametrize("wrap", [False, True])
+def test_worker_tile_mode(ctx: Context, wrap: bool):
+    """The unit steps its own 2x2 tile of the 6x6 board."""
+    topology = Topology(tuple(MAP_3X3), 3, 3, wrap=wrap, tile=2)
+    board = np.random.default_rng(42).integers(0, 2, (6, 6), dtype=np.uint8)
+    rel = Relation(
+        endpoint="world",
+        remote_app_name="coordinator",
+        id=1,
+        remote_app_data={
+            "round": "5",
+            "topology": topology.dumps(),
+            "board": wire.encode(life.to_string(board), "bits"),
+        },
+    )
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    rel = state.get_relation(rel.id)
+    expected = life.step_padded(np.pad(board, 1, mode="wrap" if wrap else "constant"))
+    assert wire.decode(rel.local_unit_data["value"]) == life.to_string(expected[2:4, 2:4])
+    assert rel.local_unit_data["round"] == "5"
+
+
+def test_worker_tile_mode_corner():
+    """A corner tile wraps around the torus."""
+    ctx = Context(JGOLWorkerCharm, app_name="app", unit_id=0)
+    topology = Topology(tuple(MAP_3X3), 3, 3, wrap=True, tile=2)
+    board = np.random.default_rng(7).integers(0, 2, (6, 6), dtype=np.uint8)
+    rel = Relation(
+        endpoint="world",
+        remote_app_name="coordinator",
+        id=1,
+        remote_app_data={
+            "round": "5",
+            "topology": topology.dumps(),
+            "board": life.to_string(board),
+        },
+    )
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    rel = state.get_relation(rel.id)
+    expected = life.step_padded(np.pad(board, 1, mode="wrap"))
+    assert wire.decode(rel.local_unit_data["value"]) == life.to_string(expected[0:2, 0:2])
+
+
+def test_worker_tile_mode_small_torus():
+    """One 2x2 tile on a 2x2 torus plays the same game as the reference."""
+    ctx = Context(JGOLWorkerCharm, app_name="app", unit_id=0)
+    topology = Topology(("app/0",), 1, 1, wrap=True, tile=2)
+    board = "1101"
+    rel = Relation(
+        endpoint="world",
+        remote_app_name="coordinator",
+        id=1,
+        remote_app_data={"round": "0", "topology": topology.dumps(), "board": board},
+    )
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    rel = state.get_relation(rel.id)
+    expected = life.step(life.from_string(board, 2), wrap=True)
+    # each cell has 3 distinct neighbours on a 2x2 torus
+    assert wire.decode(rel.local_unit_data["value"]) == life.to_string(expected) == "1111"
+
+
+def test_worker_tile_mode_uses_cache(ctx: Context):
+    """Steady state tile hooks don't parse the topology."""
+    topology = Topology(tuple(MAP_3X3), 3, 3, tile=2)
+    board = "0" * 36
+    app_data = {"round": "1", "topology": topology.dumps(), "board": board}
+    rel = Relation(endpoint="world", remote_app_name="coordinator", id=1, remote_app_data=app_data)
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    stored = state.get_stored_state("_stored", owner_path="JGOLWorkerCharm")
+    assert stored.content["geometry"]["tile"] == 2
+
+    with unittest.mock.patch.object(Topology, "loads", side_effect=AssertionError):
+        rel = state.get_relation(1)
+        state = ctx.run(ctx.on.relation_changed(rel), state)
+    assert wire.decode(state.get_relation(1).local_unit_data["value"]) == "0000"
+
+
+def test_worker_skips_until_round_changes(ctx: Context, workdir):
+    """Once the round is posted, coordinator changes are skipped until it moves."""
+    app_data = {
+        "round": "0",
+        "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(),
+        "board": "010110010",
+    }
+    rel = Relation(endpoint="world", remote_app_name="coordinator", id=1, remote_app_data=app_data)
+    ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+
+    tool = workdir / "relation-get"
+    env = {
+        "JUJU_HOOK_NAME": "world-relation-changed",
+        "JUJU_RELATION_ID": "world:1",
+        "JUJU_REMOTE_APP": "coordinator",
+        "PATH": f"{workdir}:{os.environ['PATH']}",
+    }
+    tool.write_text(f"#!/bin/sh\necho '{json.dumps(app_data)}'\n")
+    tool.chmod(0o755)
+    with unittest.mock.patch.dict(os.environ, env):
+        assert dispatch.skip_reason(env) == "values unchanged"
+        tool.write_text(f"#!/bin/sh\necho '{json.dumps({**app_data, 'round': '1'})}'\n")
+        assert dispatch.skip_reason(env) is None
+
+
+def test_repeated_writes_are_suppressed(ctx: Context, workdir):
+    """A hook that posts what the unit already posted doesn't call relation-set."""
+    app_data = {
+        "round": "0",
+        "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(),
+        "board": "010110010",
+    }
+    rel = Relation(endpoint="world", remote_app_name="coordinator", id=1, remote_app_data=app_data)
+    state = ctx.run(ctx.on.relation_changed(rel), State(relations={rel}))
+    assert databag.written() == {
+        "world-relation-changed": {"writes": 3, "suppressed": 0, "commits": 1}
+    }
+
+    with unittest.mock.patch("ops.model._ModelBackend.update_relation_data") as relation_set:
+        state = ctx.run(ctx.on.relation_changed(state.get_relation(1)), state)
+    relation_set.assert_not_called()
+    assert state.get_relation(1).local_unit_data["value"] == "1"
+    assert databag.written() == {
+        "world-relation-changed": {"writes": 6, "suppressed": 3, "commits": 1}
+    }
+
+
+def test_trace(ctx: Context, workdir, monkeypatch):
+    """One record per hook, a hook that only repeats its post is no use."""
+    app_data = {
+        "round": "0",
+        "topology": Topology(tuple(MAP_3X3), 3, 3).dumps(),
+        "board": "010110010",
+    }
+    rel = Relation(endpoint="world", remote_app_name="coordinator", id=1, remote_app_data=app_data)
+    state = State(relations={rel})
+    env = {"JUJU_HOOK_NAME": "world-relation-changed", "JUJU_UNIT_NAME": "app/4"}
+    for _ in range(2):
+        monkeypatch.setattr(dispatch, "_marks", {"start": time.perf_counter()})
+        dispatch.start_trace()
+        dispatch.profile("imports")
+        state = ctx.run(ctx.on.relation_changed(state.get_relation(1)), state)
+        dispatch.write_trace(env)
+    monkeypatch.setattr(dispatch, "_trace", None)
+
+    first, second = map(json.loads, (workdir / dispatch.TRACE).read_text().splitlines())
+    assert first == {
+        "hook": "world-relation-changed",
+        "unit": "app/4",
+        "remote_unit": None,
+        "time": unittest.mock.ANY,
+        "import": unittest.mock.ANY,
+        "load": unittest.mock.ANY,
+        "handler": unittest.mock.ANY,
+        "total": unittest.mock.ANY,
+        "read": unittest.mock.ANY,
+        "written": len("value1round0at4"),
+        "useful": True,
+        "skipped": False,
+        "round": 0,
+    }
+    # The app databag is read several times, and counted once, as is the unit's
+    read = {**app_data, **rel.local_unit_data}
+    assert first["read"] == sum(len(k) + len(v) for k, v in read.items())
+    # Each is rounded to 0.1 ms
+    assert first["import"] + first["load"] + first["handler"] <= first["total"] + 0.0002
+    assert second["written"] == 0 and not second["useful"]
+
+
+def test_batch():
+    """Reads see pending writes, deleting and restoring a key is no change."""
+    content = {"a": "1", "b": "2"}
+    data = databag.Batch(content)
+    del data["a"]
+    data["c"] = "3"
+    assert dict(data) == {"b": "2", "c": "3"}
+    data["a"] = "1"
+    data["b"] = "2"
+    assert data.changes() == {"c": "3"}
+    with pytest.raises(KeyError):
+        del data["d"]
+
+
+RESIDENT_MAIN = """
+import os, sys, time
+import resident
+
+def hook():
+    print(os.environ["JUJU_HOOK_NAME"], flush=True)
+    if "RESIDENT" in os.environ:
+        resident.ensure(bool(int(os.environ["RESIDENT"])))
+    time.sleep(float(os.environ.get("SLEEP", 0)))
+    sys.exit(int(os.environ.get("CODE", 0)))
+
+resident.serve(hook, timeout=1)
+"""
+
+
+def start_resident() -> subprocess.Popen:
+    src = os.path.dirname(resident.__file__)
+    server = subprocess.Popen(
+        [sys.executable, "-c", RESIDENT_MAIN], env={**os.environ, "PYTHONPATH": src}
+    )
+    for _ in range(500):
+        if os.path.exists(resident.SOCKET):
+            break
+        time.sleep(0.01)
+    return server
+
+
+def run(**env) -> tuple[int | None, str]:
+    r, w = os.pipe()
+    code = resident.handoff(env, fds=(0, w, w))
+    os.close(w)
+    with os.fdopen(r) as f:
+        return code, f.read()
+
+
+def test_resident_runs_hooks(workdir):
+    """Hooks run in the resident process, exit codes and output come back."""
+    server = start_resident()
+    try:
+        assert run(JUJU_HOOK_NAME="update-status") == (0, "update-status\n")
+        assert run(JUJU_HOOK_NAME="config-changed", CODE="3") == (3, "config-changed\n")
+        code, output = run(JUJU_HOOK_NAME="update-status", SLEEP="5")
+        assert code == 124 and "timed out" in output
+        # Some hooks always run cold
+        assert run(JUJU_HOOK_NAME="upgrade-charm") == (None, "")
+
+        resident.stop()
+        assert server.wait(5) == 0
+        assert run(JUJU_HOOK_NAME="update-status") == (None, "")
+    finally:
+        server.kill()
+
+
+def test_resident_turned_off_by_served_hook(workdir):
+    """A hook the resident runs can turn it off, the next hook runs cold."""
+    server = start_resident()
+    try:
+        assert run(JUJU_HOOK_NAME="config-changed", RESIDENT="1") == (0, "config-changed\n")
+        assert os.path.exists(resident.SOCKET)
+        assert run(JUJU_HOOK_NAME="config-changed", RESIDENT="0") == (0, "config-changed\n")
+        assert not os.path.exists(resident.SOCKET)
+        assert server.wait(5) == 0
+        assert run(JUJU_HOOK_NAME="update-status") == (None, "")
+    finally:
+        server.kill()